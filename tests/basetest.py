@@ -66,9 +66,9 @@ class DummyHandler(handler.Handler):
 		self.ex = None
 		self.allow_downloads = False
 
-	def get_download(self, url, force = False, hint = None, factory = None):
+	def get_download(self, url, force = False, hint = None, factory = None, expected_size = None):
 		if self.allow_downloads:
-			return handler.Handler.get_download(self, url, force, hint, factory)
+			return handler.Handler.get_download(self, url, force, hint, factory, expected_size)
 		raise model.SafeException("DummyHandler: " + url)
 
 	def wait_for_blocker(self, blocker):
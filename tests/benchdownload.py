@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Time fetching files from the local test server (tests/server.py), using a
+separate helper process for each download (as we used to for every URL, and
+still do for ftp:) and using the in-process HTTP client.
+Usage: benchdownload.py [N_SMALL [LARGE_MB]]"""
+import sys, os, tempfile, shutil, subprocess, time
+
+sys.path.insert(0, os.path.abspath('..'))
+for var in ('http_proxy', 'HTTP_PROXY'):
+	os.environ.pop(var, None)
+
+from zeroinstall.support import tasks
+from zeroinstall.injector import download, handler
+import server
+
+n_small = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+large_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+child_script = os.path.join(os.path.dirname(os.path.abspath(download.__file__)), '_download_child.py')
+base_url = 'http://localhost:8000/'
+
+def via_helper(leaf):
+	stream = tempfile.TemporaryFile()
+	child = subprocess.Popen([sys.executable, '-u', child_script, base_url + leaf], stdout = stream)
+	assert child.wait() == 0
+	return stream
+
+def in_process(h, leaf):
+	dl = h.get_download(base_url + leaf)
+	stream = dl.tempfile
+	tasks.wait_for_blocker(dl.downloaded)
+	return stream
+
+def start_server(*script):
+	# (the server logs every request; send that to /dev/null)
+	sys.stdout.flush()
+	saved = os.dup(1)
+	null = os.open(os.devnull, os.O_WRONLY)
+	os.dup2(null, 1)
+	try:
+		return server.handle_requests(*script)
+	finally:
+		os.dup2(saved, 1)
+		os.close(saved)
+		os.close(null)
+
+def timed(leaf, n, fetch):
+	server_pid = start_server(*([leaf] * n))
+	try:
+		start = time.time()
+		for i in range(n):
+			stream = fetch(leaf)
+		taken = time.time() - start
+	finally:
+		os.waitpid(server_pid, 0)
+	stream.seek(0, 2)
+	assert stream.tell() == os.path.getsize(leaf)
+	return taken
+
+old_dir = os.getcwd()
+tmp = tempfile.mkdtemp(prefix = 'bench-download-')
+try:
+	os.chdir(tmp)
+	stream = file('small.xml', 'w')
+	stream.write('<?xml version="1.0" ?>\n' + '<!-- padding -->\n' * 256)
+	stream.close()
+
+	block = os.urandom(1024 * 1024)
+	stream = file('large.bin', 'w')
+	for i in range(large_mb):
+		stream.write(block)
+	stream.close()
+
+	h = handler.Handler()
+	fetch_in_process = lambda leaf: in_process(h, leaf)
+
+	print "%-28s %14s %14s" % ("", "Helper (s)", "In-process (s)")
+	print "%-28s %14.3f %14.3f" % ("%d x %d byte feed" % (n_small, os.path.getsize('small.xml')),
+		timed('small.xml', n_small, via_helper), timed('small.xml', n_small, fetch_in_process))
+	print "%-28s %14.3f %14.3f" % ("1 x %d MB archive" % large_mb,
+		timed('large.bin', 1, via_helper), timed('large.bin', 1, fetch_in_process))
+finally:
+	os.chdir(old_dir)
+	shutil.rmtree(tmp)
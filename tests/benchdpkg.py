@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Time looking up installed packages in a large synthetic dpkg status file:
+building the index, looking packages up in it (new and saved), and, for
+comparison, running dpkg-query once per package (if it is installed).
+Usage: benchdpkg.py [N_PACKAGES [N_LOOKUPS]]"""
+import sys, os, tempfile, shutil, random, time, subprocess
+
+os.environ['XDG_CACHE_HOME'] = cache_home = tempfile.mkdtemp(prefix = 'bench-cache-')
+os.environ['XDG_CACHE_DIRS'] = ''
+
+sys.path.insert(0, '..')
+from zeroinstall.injector import distro
+
+n_packages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+n_lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+admin_dir = tempfile.mkdtemp(prefix = 'bench-dpkg-')
+status_file = os.path.join(admin_dir, 'status')
+
+def write_status():
+	rand = random.Random(1)
+	stream = file(status_file, 'w')
+	for i in range(n_packages):
+		stream.write("Package: package%d\n" % i)
+		stream.write("Status: %s\n" % rand.choice(['install ok installed'] * 9 + ['deinstall ok config-files']))
+		stream.write("Priority: optional\nSection: libs\nInstalled-Size: %d\n" % rand.randint(10, 10000))
+		stream.write("Maintainer: Someone <someone@example.com>\n")
+		stream.write("Architecture: %s\n" % rand.choice(['amd64', 'amd64', 'all', 'i386']))
+		stream.write("Version: %d:%d.%d-%dubuntu%d\n" % (rand.randint(0, 2), rand.randint(0, 9), rand.randint(0, 99), rand.randint(1, 9), rand.randint(1, 3)))
+		stream.write("Depends: libc6 (>= 2.11), package%d (= 1.0)\n" % rand.randint(0, n_packages))
+		stream.write("Description: synthetic package %d\n" % i)
+		for line in range(rand.randint(1, 15)):
+			stream.write(" A line of the long description of a package used for benchmarking.\n")
+		stream.write("\n")
+	stream.close()
+
+def time_lookups(host, packages):
+	start = time.time()
+	for package in packages:
+		host._get_dpkg_info(package)
+	return time.time() - start
+
+try:
+	write_status()
+	os.mkdir(os.path.join(admin_dir, 'info'))
+	os.mkdir(os.path.join(admin_dir, 'updates'))
+	packages = random.Random(2).sample(['package%d' % i for i in range(n_packages)], n_lookups)
+
+	start = time.time()
+	host = distro.DebianDistribution(status_file, None)
+	build = time.time() - start
+	lookups = time_lookups(host, packages)
+
+	start = time.time()
+	host = distro.DebianDistribution(status_file, None)
+	load = time.time() - start
+	saved_lookups = time_lookups(host, packages)
+
+	print "%d packages in a %d KB status file; %d lookups" % (n_packages, os.path.getsize(status_file) / 1024, n_lookups)
+	print "Build index:                 %.3f s" % build
+	print "Lookups in new index:        %.3f s" % lookups
+	print "Open saved index:            %.3f s" % load
+	print "Lookups in saved index:      %.3f s" % saved_lookups
+
+	try:
+		start = time.time()
+		for package in packages:
+			child = subprocess.Popen(["dpkg-query", "--admindir=" + admin_dir, "-W",
+						  "--showformat=${Version}\t${Architecture}\t${Status}\n", "--", package],
+						stdout = subprocess.PIPE)
+			child.communicate()
+		print "dpkg-query for each package: %.3f s" % (time.time() - start)
+	except OSError as ex:
+		print "dpkg-query for each package: (skipped: %s)" % ex
+finally:
+	shutil.rmtree(cache_home)
+	shutil.rmtree(admin_dir)
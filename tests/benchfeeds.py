@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Compare the time taken to load cached feeds with and without the parsed-feed cache.
+Usage: benchfeeds.py [N_FEEDS [N_IMPLS]]"""
+import sys, os, tempfile, shutil, time
+
+os.environ['XDG_CACHE_HOME'] = cache_home = tempfile.mkdtemp(prefix = 'bench-cache-')
+os.environ['XDG_CACHE_DIRS'] = ''
+
+sys.path.insert(0, '..')
+from zeroinstall.injector import reader, model
+from zeroinstall.injector.namespaces import config_site
+from zeroinstall.support import basedir
+
+n_feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+n_impls = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+def make_feed(i):
+	impls = []
+	for v in range(n_impls):
+		impls.append("""
+  <group arch='Linux-x86_64' license='OSI Approved :: GNU GPL'>
+   <requires interface='http://example.com/lib%d'>
+    <version not-before='%d'/>
+    <environment name='LIB%d' insert='lib'/>
+   </requires>
+   <command name='run' path='bin/prog'/>
+   <implementation id='sha1new=%040x' released='2011-01-01' version='1.%d' stability='stable'>
+    <manifest-digest sha256='%064x'/>
+    <archive href='http://example.com/prog-%d-1.%d.tar.bz2' size='%d'/>
+   </implementation>
+  </group>""" % (i + 1, v, i + 1, i * n_impls + v, v, i * n_impls + v, i, v, 1000 + v))
+	return """<?xml version="1.0" ?>
+<interface uri='http://example.com/prog%d' xmlns='http://zero-install.sourceforge.net/2004/injector/interface'>
+  <name>prog%d</name>
+  <summary>a program</summary>
+  <description>A program used for benchmarking.</description>
+  %s
+</interface>""" % (i, i, ''.join(impls))
+
+urls = ['http://example.com/prog%d' % i for i in range(n_feeds)]
+
+try:
+	iface_dir = basedir.save_cache_path(config_site, 'interfaces')
+	for i, url in enumerate(urls):
+		stream = file(os.path.join(iface_dir, model.escape(url)), 'w')
+		stream.write(make_feed(i))
+		stream.close()
+
+	def timed(fn):
+		start = time.time()
+		for url in urls:
+			feed = fn(url)
+			assert len(feed.implementations) == n_impls
+		return time.time() - start
+
+	parse = timed(lambda url: reader.load_feed(basedir.load_first_cache(config_site, 'interfaces', model.escape(url))))
+	first = timed(reader.load_feed_from_cache)
+	warm = timed(reader.load_feed_from_cache)
+
+	print "%d feeds with %d implementations each" % (n_feeds, n_impls)
+	print "Parsing XML:                      %.3f s" % parse
+	print "First load (parse + save copy):   %.3f s" % first
+	print "Loading parsed copies:            %.3f s" % warm
+finally:
+	shutil.rmtree(cache_home)
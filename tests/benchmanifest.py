@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Time manifest generation for a tree with many small files and a few huge ones,
+hashing the files serially and with a pool of worker threads.
+Usage: benchmanifest.py [N_SMALL [N_HUGE [HUGE_MB]]]"""
+import sys, os, tempfile, shutil, time
+
+sys.path.insert(0, '..')
+from zeroinstall.zerostore import manifest
+
+n_small = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+n_huge = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+huge_mb = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+
+root = tempfile.mkdtemp(prefix = 'bench-manifest-')
+try:
+	for i in range(n_small):
+		subdir = os.path.join(root, 'dir%d' % (i % 50))
+		if not os.path.isdir(subdir):
+			os.mkdir(subdir)
+		stream = file(os.path.join(subdir, 'file%d' % i), 'w')
+		stream.write(('small file %d\n' % i) * (i % 300))
+		stream.close()
+
+	block = os.urandom(1024 * 1024)
+	for i in range(n_huge):
+		stream = file(os.path.join(root, 'huge%d' % i), 'w')
+		for mb in range(huge_mb):
+			stream.write(block)
+		stream.close()
+
+	alg = manifest.get_algorithm('sha256')
+
+	def timed(workers):
+		manifest.max_workers = workers
+		start = time.time()
+		lines = list(alg.generate_manifest(root))
+		return time.time() - start, lines
+
+	serial_time, serial = timed(1)
+	parallel_time, parallel = timed(None)
+	assert serial == parallel, "Manifests differ!"
+
+	print "%d small files, %d files of %d MB, %d CPUs" % (n_small, n_huge, huge_mb, manifest._get_n_workers())
+	print "Serial:   %.3f s" % serial_time
+	print "Parallel: %.3f s" % parallel_time
+finally:
+	shutil.rmtree(root)
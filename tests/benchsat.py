@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Time the SAT solver on synthetic dependency graphs of increasing size.
+Each interface has several versions; each version except the oldest depends
+on a range of versions of some later interfaces, and the newest versions of a
+few interfaces conflict with each other, so the solver has to backtrack.
+Usage: benchsat.py [N_IFACES [N_VERSIONS]]"""
+import sys, random, time
+
+sys.path.insert(0, '..')
+from zeroinstall.injector import sat
+
+max_ifaces = int(sys.argv[1]) if len(sys.argv) > 1 else 800
+n_versions = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+def solve(n_ifaces):
+	rand = random.Random(n_ifaces)	# Same problem every time
+	problem = sat.SATProblem()
+
+	# versions[i] = variables for interface i, best first
+	versions = [[problem.add_variable((i, v)) for v in range(n_versions - 1, -1, -1)]
+			for i in range(n_ifaces)]
+	groups = [problem.at_most_one(vs) for vs in versions]
+	problem.add_clause(versions[0])		# We must select something for the root
+
+	for i in range(n_ifaces - 1):
+		for impl in versions[i][:-1]:		# (the oldest version has no dependencies)
+			deps = rand.sample(range(i + 1, n_ifaces), min(3, n_ifaces - i - 1))
+			for dep in deps:
+				lo = rand.randint(0, n_versions - 1)
+				problem.add_clause([sat.neg(impl)] + versions[dep][lo:])
+
+		# Occasionally, the newest version of this interface can't be used
+		# with the newest version of a random later one
+		if i % 10 == 0:
+			other = rand.randint(i + 1, n_ifaces - 1)
+			problem.add_clause([sat.neg(versions[i][0]), sat.neg(versions[other][0])])
+
+	def decide():
+		for group in groups:
+			if group.current is None:
+				lit = group.best_undecided()
+				if lit is not None:
+					return lit
+		for var, info in enumerate(problem.assigns):
+			if info.value is None:
+				return sat.neg(var)
+		assert 0
+
+	start = time.time()
+	ready = problem.run_solver(decide)
+	return time.time() - start, ready
+
+print "%d versions per interface" % n_versions
+print "%10s %10s %10s" % ("Interfaces", "Variables", "Time (s)")
+n = 25
+while n <= max_ifaces:
+	taken, ready = solve(n)
+	print "%10d %10d %10.3f%s" % (n, n * n_versions, taken, "" if ready else " (no solution)")
+	n *= 2
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Time SATSolver.solve on a large synthetic set of cached feeds: the first solve,
+solving again with nothing changed, and solving again after one feed is updated
+or one interface's stability policy is changed (as solve_with_downloads and the
+GUI do).
+Usage: benchsolver.py [N_IFACES [N_VERSIONS [N_REPEATS]]]"""
+import sys, os, tempfile, shutil, random, time
+
+os.environ['XDG_CACHE_HOME'] = cache_home = tempfile.mkdtemp(prefix = 'bench-cache-')
+os.environ['XDG_CACHE_DIRS'] = ''
+os.environ['XDG_CONFIG_HOME'] = config_home = tempfile.mkdtemp(prefix = 'bench-config-')
+os.environ['XDG_CONFIG_DIRS'] = ''
+
+sys.path.insert(0, '..')
+from zeroinstall.injector import model, arch, solver, config
+from zeroinstall.injector.namespaces import config_site
+from zeroinstall.support import basedir
+
+n_ifaces = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+n_versions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+n_repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+urls = ['http://example.com/prog%d' % i for i in range(n_ifaces)]
+
+def make_feed(i, rand, last_modified):
+	impls = []
+	for v in range(n_versions):
+		deps = []
+		if i + 1 < n_ifaces:
+			for dep in rand.sample(range(i + 1, n_ifaces), min(3, n_ifaces - i - 1)):
+				deps.append("<requires interface='%s'><version not-before='1.%d'/></requires>" %
+						(urls[dep], rand.randint(0, n_versions // 2)))
+		impls.append("""
+  <group arch='*-*'>
+   %s
+   <command name='run' path='bin/prog'/>
+   <implementation id='sha1new=%040x' released='2011-01-01' version='1.%d' stability='%s'>
+    <archive href='http://example.com/prog-%d-1.%d.tar.bz2' size='%d'/>
+   </implementation>
+  </group>""" % (''.join(deps), i * n_versions + v, v, rand.choice(['stable', 'stable', 'testing']), i, v, 1000 + v))
+	return """<?xml version="1.0" ?>
+<interface last-modified='%d' uri='%s' xmlns='http://zero-install.sourceforge.net/2004/injector/interface'>
+  <name>prog%d</name>
+  <summary>a program</summary>
+  <description>A program used for benchmarking.</description>
+  %s
+</interface>""" % (last_modified, urls[i], i, ''.join(impls))
+
+def write_feed(i, last_modified):
+	stream = file(os.path.join(iface_dir, model.escape(urls[i])), 'w')
+	stream.write(make_feed(i, random.Random(i), last_modified))
+	stream.close()
+
+try:
+	iface_dir = basedir.save_cache_path(config_site, 'interfaces')
+	for i in range(n_ifaces):
+		write_feed(i, 1000)
+
+	conf = config.load_config()
+	iface_cache = conf.iface_cache
+	s = solver.SATSolver(conf)
+	host_arch = arch.get_host_architecture()
+
+	def timed():
+		start = time.time()
+		s.solve(urls[0], host_arch)
+		assert s.ready
+		return time.time() - start
+
+	first = timed()
+	unchanged = min(timed() for i in range(n_repeats))
+
+	def update_feed():
+		# Replace a feed near the bottom of the graph, as a download would
+		write_feed(n_ifaces - 2, 2000)
+		iface_cache.get_feed(urls[n_ifaces - 2], force = True)
+		return timed()
+	updated = min(update_feed() for i in range(n_repeats))
+
+	iface = iface_cache.get_interface(urls[n_ifaces // 2])
+	def change_policy():
+		iface.set_stability_policy(iface.stability_policy is model.testing and model.stable or model.testing)
+		return timed()
+	policy = min(change_policy() for i in range(n_repeats))
+
+	print "%d interfaces with %d versions each" % (n_ifaces, n_versions)
+	print "First solve:                  %.3f s" % first
+	print "Re-solve, nothing changed:    %.3f s" % unchanged
+	print "Re-solve after feed update:   %.3f s" % updated
+	print "Re-solve after policy change: %.3f s" % policy
+finally:
+	shutil.rmtree(cache_home)
+	shutil.rmtree(config_home)
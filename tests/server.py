@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import os, sys, urlparse
+import os, sys, urlparse, hashlib
 import BaseHTTPServer
 import traceback
 
@@ -15,6 +15,19 @@ class Give404:
 	def __repr__(self):
 		return "404 on " + self.path
 
+class DropAfter:
+	"""Send only the first n bytes of the response body and then close the connection,
+	as if the network had failed."""
+	def __init__(self, path, n):
+		self.path = path
+		self.n = n
+
+	def __str__(self):
+		return self.path
+
+	def __repr__(self):
+		return "drop %s after %d bytes" % (self.path, self.n)
+
 class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 	def do_GET(self):
 		parsed = urlparse.urlparse(self.path)
@@ -39,9 +52,31 @@ class MyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 			self.wfile.write('<key-lookup><item vote="good">Approved for testing</item></key-lookup>')
 			self.wfile.close()
 		elif os.path.exists(leaf) and not isinstance(resp, Give404):
-			self.send_response(200)
+			data = file(leaf).read()
+			etag = '"%s"' % hashlib.sha1(data).hexdigest()
+			if self.headers.get('If-None-Match', None) == etag:
+				self.send_response(304)
+				self.end_headers()
+				self.wfile.close()
+				return
+			start = 0
+			requested = self.headers.get('Range', '')
+			if requested.startswith('bytes=') and requested.endswith('-'):
+				start = int(requested[6:-1])
+			if start:
+				self.send_response(206)
+				self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+				self.send_header('Content-Length', str(len(data) - start))
+			else:
+				self.send_response(200)
+				self.send_header('ETag', etag)
+				if isinstance(resp, DropAfter):
+					self.send_header('Content-Length', str(len(data)))
 			self.end_headers()
-			self.wfile.write(file(leaf).read())
+			if isinstance(resp, DropAfter):
+				self.wfile.write(data[start:start + resp.n])
+			else:
+				self.wfile.write(data[start:])
 			self.wfile.close()
 		else:
 			self.send_error(404, "Missing: %s" % leaf)
@@ -8,7 +8,7 @@ sys.path.insert(0, '..')
 
 from zeroinstall.injector import model, gpg, namespaces, reader, run, fetch
 from zeroinstall.injector.policy import Policy
-from zeroinstall.support import basedir
+from zeroinstall.support import basedir, tasks
 import data
 
 foo_iface_uri = 'http://foo'
@@ -406,5 +406,57 @@ class TestAutoPolicy(BaseTest):
 		recalculate(policy)
 		assert policy.implementation[bar_iface].id == 'sha1=150'
 
+	def testPrefetch(self):
+		# Feeds on the "network", each needing the next one
+		feeds = {}
+		def chain(uri, requires, extra = ''):
+			feeds[uri] = """<?xml version="1.0" ?>
+<interface last-modified="1110752708"
+ uri="%s"
+ xmlns="http://zero-install.sourceforge.net/2004/injector/interface">
+  <name>Chain</name>
+  <summary>Chain</summary>
+  <description>Chain</description>
+  <group main='dummy'>
+   %s
+   <implementation id='sha1=%d' version='1.0'>
+    <archive href='foo' size='10'/>
+   </implementation>
+  </group>
+  %s
+</interface>""" % (uri, requires and "<requires interface='%s'/>" % requires or '', len(feeds), extra)
+		chain(foo_iface_uri, 'http://b')
+		chain('http://b', 'http://c', "<implementation id='sha1=99' version='2.0' arch='Nowhere-*'>"
+						 "<requires interface='http://unused'/><archive href='foo' size='10'/></implementation>")
+		chain('http://c', None, "<implementation id='sha1=98' version='0.5'><command name='test' path='test'>"
+					"<requires interface='http://hang'/></command><archive href='foo' size='10'/></implementation>")
+
+		cache_iface = self.cache_iface
+		class Fetcher:
+			requested = []
+			def download_and_import_feed(self, url, iface_cache):
+				self.requested.append(url)
+				if url == 'http://hang':
+					return tasks.Blocker("never finishes")
+				@tasks.async
+				def fetch():
+					yield tasks.TimeoutBlocker(0.01, "network delay")
+					cache_iface(url, feeds[url])
+					iface_cache.get_feed(url, force = True)
+				return fetch()
+		self.config.fetcher = Fetcher()
+		self.config.network_use = model.network_full
+
+		policy = Policy(foo_iface_uri, config = self.config)
+		solves = []
+		policy.watchers.append(lambda: solves.append(policy.ready))
+		tasks.wait_for_blocker(policy.solve_with_downloads())
+
+		assert policy.ready
+		# http://hang was prefetched, but the solver doesn't need it, so we don't wait for it
+		self.assertEquals([foo_iface_uri, 'http://b', 'http://c', 'http://hang'], Fetcher.requested)
+		# Once to find we need the root feed, and again as each feed it needs arrives
+		self.assertEquals([False, False, False, True], solves)
+
 if __name__ == '__main__':
 	unittest.main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from basetest import BaseTest, empty_feed, DummyPackageKit
-import sys, os, tempfile
+import sys, os, tempfile, shutil
 from StringIO import StringIO
 import unittest
 
@@ -53,6 +53,76 @@ class TestDistro(BaseTest):
 		finally:
 			src.close()
 
+	def testCacheLog(self):
+		src = tempfile.NamedTemporaryFile()
+		try:
+			cache = distro.Cache('test-cache', src.name, 1)
+			cache.max_log = 10
+			cache_path = os.path.join(cache.cache_dir, 'test-cache')
+			for i in range(9):
+				cache.put('key%d' % i, 'value\t%d' % i)
+			cache.put('key0', 'new value')
+			# The log was compacted into a table
+			self.assertEquals(0, cache._log_records)
+			self.assertEquals({}, cache._log)
+			self.assertEquals('new value', cache.get('key0'))
+			for i in range(1, 9):
+				self.assertEquals('value\t%d' % i, cache.get('key%d' % i))
+			self.assertEquals(None, cache.get('key'))
+			self.assertEquals(None, cache.get('key9'))
+			self.assertEquals(9, file(cache_path).read().split('\n\n', 1)[1].count('\n'))
+
+			# A record that was cut short is ignored, and doesn't affect the next one
+			cache.put('key1', 'updated')
+			stream = file(cache_path, 'a')
+			stream.write('01234567\tkey2\tpartial')
+			stream.close()
+			cache.put('key3', 'updated')
+
+			cache = distro.Cache('test-cache', src.name, 1)
+			self.assertEquals(3, cache._log_records)
+			self.assertEquals('updated', cache.get('key1'))
+			self.assertEquals('value\t2', cache.get('key2'))
+			self.assertEquals('updated', cache.get('key3'))
+			self.assertEquals('new value', cache.get('key0'))
+
+			# An old-format cache is flushed
+			stream = file(cache_path, 'w')
+			stream.write('mtime=%d\nsize=0\nformat=1\n\nkey0=old\n' % int(os.stat(src.name).st_mtime))
+			stream.close()
+			cache = distro.Cache('test-cache', src.name, 1)
+			self.assertEquals(None, cache.get('key0'))
+		finally:
+			src.close()
+
+	def testPackageIndex(self):
+		src = tempfile.NamedTemporaryFile()
+		try:
+			names = ['pkg%d' % i for i in range(0, 1000, 3)] + ['a', 'z' * 200]
+			def generate():
+				for name in names:
+					yield name, 'info for ' + name
+				yield 'a', 'duplicate'
+			index = distro.PackageIndex('test-index', src.name, 1, generate)
+			for name in names:
+				self.assertEquals('info for ' + name, index.get(name))
+			for name in ['', 'A', 'b', 'pkg1', 'pkg10', 'pkg9999', 'zzz', '~']:
+				self.assertEquals(None, index.get(name))
+
+			src.write("hi")
+			src.flush()
+			names = ['b']
+			self.assertEquals(None, index.get('pkg0'))
+			self.assertEquals('info for b', index.get('b'))
+			self.assertEquals('duplicate', index.get('a'))
+
+			# new index... (format change)
+			names = []
+			index = distro.PackageIndex('test-index', src.name, 2, generate)
+			self.assertEquals(None, index.get('b'))
+		finally:
+			src.close()
+
 	def make_factory(self, distro):
 		def factory(id, only_if_missing = False, installed = True):
 			assert not only_if_missing
@@ -117,6 +187,98 @@ class TestDistro(BaseTest):
 		self.assertEquals('0.3.1-1', libxcomposite.get_version())
 		self.assertEquals('i386', libxcomposite.machine)
 	
+	def testAptCacheBatch(self):
+		# All the candidates are looked up with a single apt-cache command
+		dpkgdir = os.path.join(os.path.dirname(__file__), 'dpkg')
+		host = distro.DebianDistribution(
+				os.path.join(dpkgdir, 'status'),
+				os.path.join(dpkgdir, 'pkgcache.bin'))
+		host._packagekit = DummyPackageKit()
+
+		log = tempfile.NamedTemporaryFile()
+		os.environ['APT_CACHE_LOG'] = log.name
+		try:
+			master_feed = parse_impls("""<package-implementation package='python-bittorrent'/>
+						     <package-implementation package='python-gobject'/>
+						     <package-implementation package='gimp'/>""")
+			h = handler.Handler()
+			candidates = host.fetch_candidates(master_feed)
+			# A second request while the first is running waits for it
+			candidates2 = host.fetch_candidates(master_feed)
+			h.wait_for_blocker(candidates)
+			h.wait_for_blocker(candidates2)
+			self.assertEquals(['show --no-all-versions -- python-bittorrent python-gobject gimp'],
+					file(log.name).read().splitlines())
+
+			self.assertEquals({'version': '3.4.2-11.1', 'arch': '*', 'size': 53142}, host.apt_cache['python-bittorrent'])
+			self.assertEquals({'version': '2.28.6-10', 'arch': 'x86_64', 'size': 78324}, host.apt_cache['python-gobject'])
+			self.assertEquals(None, host.apt_cache['gimp'])
+
+			# Packages we already know about aren't looked up again
+			candidates = host.fetch_candidates(master_feed)
+			if candidates:
+				h.wait_for_blocker(candidates)
+			self.assertEquals(1, len(file(log.name).read().splitlines()))
+
+			factory = self.make_factory(host)
+			host.get_package_info('python-gobject', factory)
+			self.assertEquals(['package:deb:python-gobject:2.28.6-10:x86_64'], sorted(self.feed.implementations))
+		finally:
+			del os.environ['APT_CACHE_LOG']
+
+	def testDpkgIndex(self):
+		# Installed packages are looked up in an index of the status file, without running dpkg-query
+		os.environ['PATH'] = '/does-not-exist'
+		statusdir = tempfile.mkdtemp()
+		status_file = os.path.join(statusdir, 'status')
+		def write_status(extra):
+			stream = file(status_file, 'w')
+			stream.write(file(os.path.join(os.path.dirname(__file__), 'dpkg', 'status')).read() +
+				"Package: old-lib\n"
+				"Status: deinstall ok config-files\n"
+				"Architecture: amd64\n"
+				"Version: 1.0-1\n"
+				"\n"
+				"Package: multi\n"
+				"Status: install ok installed\n"
+				"Version: 2:4.5-2\n"
+				"Description: Has a description\n"
+				" Package: not-a-package\n"
+				"Architecture: amd64\n"
+				+ extra)
+			stream.close()
+		write_status("")
+		try:
+			host = distro.DebianDistribution(status_file, None)
+			host._packagekit = DummyPackageKit()
+
+			def get_impls(package):
+				self.feed = model.ZeroInstallFeed(empty_feed, local_path = '/empty.xml')
+				host.get_package_info(package, self.make_factory(host))
+				return sorted(self.feed.implementations)
+
+			self.assertEquals(['package:deb:python-bittorrent:3.4.2-10:*'], get_impls('python-bittorrent'))
+			self.assertEquals(['package:deb:libxcomposite-dev:0.3.1-1:i386'], get_impls('libxcomposite-dev'))
+			self.assertEquals(['package:deb:multi:4.5-2:x86_64'], get_impls('multi'))
+			self.assertEquals([], get_impls('old-lib'))
+			self.assertEquals([], get_impls('not-a-package'))
+			self.assertEquals([], get_impls('gimp'))
+			self.assertEquals([], get_impls('zzz'))
+
+			# The index is rebuilt when the status file changes
+			write_status("\nPackage: gimp\nStatus: install ok installed\nVersion: 2.6.8-2\nArchitecture: i386\n")
+			os.utime(status_file, (0, 0))
+			self.assertEquals(['package:deb:gimp:2.6.8-2:i386'], get_impls('gimp'))
+			self.assertEquals(['package:deb:multi:4.5-2:x86_64'], get_impls('multi'))
+
+			# A new DebianDistribution uses the saved index
+			host = distro.DebianDistribution(status_file, None)
+			host._packagekit = DummyPackageKit()
+			host.dpkg_index.generate = None
+			self.assertEquals(['package:deb:gimp:2.6.8-2:i386'], get_impls('gimp'))
+		finally:
+			shutil.rmtree(statusdir)
+
 	def testRPM(self):
 		rpmdir = os.path.join(os.path.dirname(__file__), 'rpm')
 		os.environ['PATH'] = rpmdir + ':' + self.old_path
@@ -217,6 +379,50 @@ class TestDistro(BaseTest):
 		self.assertEquals('0.41-2', impl.get_version())
 		self.assertEquals(distro.host_machine, impl.machine)
 
+	def testPackageDirIndex(self):
+		# Package directories are scanned once, to build an index
+		tmpdir = tempfile.mkdtemp()
+		try:
+			slackdir = os.path.join(tmpdir, 'packages')
+			shutil.copytree(os.path.join(os.path.dirname(__file__), 'slack', 'packages'), slackdir)
+			gentoodir = os.path.join(tmpdir, 'gentoo')
+			shutil.copytree(os.path.join(os.path.dirname(__file__), 'gentoo'), gentoodir)
+
+			slack = distro.SlackDistribution(slackdir)
+			ebuilds = distro.GentooDistribution(gentoodir)
+
+			def get_impls(host, package):
+				self.feed = model.ZeroInstallFeed(empty_feed, local_path = '/empty.xml')
+				host.get_package_info(package, self.make_factory(host))
+				return sorted(self.feed.implementations)
+
+			real_listdir = os.listdir
+			def no_listdir(path):
+				raise Exception("Scanned " + path)
+			os.listdir = no_listdir
+			try:
+				self.assertEquals(['package:slack:infozip:5.52-2:i486'], get_impls(slack, 'infozip'))
+				self.assertEquals([], get_impls(slack, 'gimp'))
+				self.assertEquals(['package:gentoo:sys-kernel/gentoo-sources:2.6.30-4:i686',
+						   'package:gentoo:sys-kernel/gentoo-sources:2.6.32:x86_64'],
+						  get_impls(ebuilds, 'sys-kernel/gentoo-sources'))
+				self.assertEquals([], get_impls(ebuilds, 'sys-kernel'))
+				self.assertEquals([], get_impls(ebuilds, 'media-gfx/gimp'))
+
+				# A new instance uses the saved index
+				self.assertEquals(['package:slack:infozip:5.52-2:i486'],
+						  get_impls(distro.SlackDistribution(slackdir), 'infozip'))
+			finally:
+				os.listdir = real_listdir
+
+			# Installing a package invalidates the index
+			file(os.path.join(slackdir, 'gimp-2.6.8-i486-1'), 'w').close()
+			os.utime(slackdir, (0, 0))
+			self.assertEquals(['package:slack:gimp:2.6.8-1:i486'], get_impls(slack, 'gimp'))
+			self.assertEquals(['package:slack:infozip:5.52-2:i486'], get_impls(slack, 'infozip'))
+		finally:
+			shutil.rmtree(tmpdir)
+
 	def testCleanVersion(self):
 		self.assertEquals('0.3.1-1', distro.try_cleanup_distro_version('1:0.3.1-1'))
 		self.assertEquals('0.3.1-1', distro.try_cleanup_distro_version('0.3.1-1ubuntu0'))
@@ -425,6 +425,48 @@ class TestDownload(BaseTest):
 		finally:
 			sys.stdout = old_out
 
+	def testNotModified(self):
+		iface_cache = self.config.iface_cache
+		url = 'http://example.com:8000/Hello.xml'
+		self.child = server.handle_requests('Hello.xml', 'Hello.xml')
+
+		# Get the feed, noting its validators
+		dl = self.config.handler.get_download(url)
+		with output_suppressed():
+			tasks.wait_for_blocker(dl.downloaded)
+		etag, last_modified = dl.validators
+		assert etag.startswith('"'), etag
+
+		mtime = int(os.stat('Hello.xml').st_mtime)
+		iface_cache.update_feed_from_network(url, file('Hello.xml').read(), mtime)
+		iface_cache.set_feed_validators(url, etag, last_modified)
+		self.assertEquals((etag, last_modified), iface_cache.get_feed_validators(url))
+
+		feed = iface_cache.get_feed(url)
+		feed.last_checked = 100
+		from zeroinstall.injector import writer
+		writer.save_feed(feed)
+
+		# The server says we already have it, so there's nothing to parse or check
+		def no_gpg(*args):
+			raise Exception("Checked signatures again!")
+		real_check_stream = gpg.check_stream
+		gpg.check_stream = no_gpg
+		try:
+			with output_suppressed():
+				refreshed = self.config.fetcher.download_and_import_feed(url, iface_cache)
+				tasks.wait_for_blocker(refreshed)
+		finally:
+			gpg.check_stream = real_check_stream
+		feed = iface_cache.get_feed(url, force = True)
+		assert feed.last_checked > 100, feed.last_checked
+		self.assertEquals((etag, last_modified), iface_cache.get_feed_validators(url))
+
+		# Validators are ignored once the cached copy is replaced
+		mtime = int(os.stat('Hello-new.xml').st_mtime)
+		iface_cache.update_feed_from_network(url, file('Hello-new.xml').read(), mtime + 10000)
+		self.assertEquals(None, iface_cache.get_feed_validators(url))
+
 	def testBackground(self, verbose = False):
 		p = Policy('http://example.com:8000/Hello.xml', config = self.config)
 		self.import_feed(p.root, 'Hello.xml')
@@ -480,5 +522,160 @@ class TestDownload(BaseTest):
 	def testBackgroundVerbose(self):
 		self.testBackground(verbose = True)
 
+	def testScheduler(self):
+		scheduler = download.DownloadScheduler(max_downloads = 3, max_downloads_per_host = 2)
+		a1, a2, a3, b1, c1, c2 = [scheduler.get_slot(url) for url in [
+			'http://a/1', 'http://a/2', 'http://a/3',
+			'http://b/1', 'http://c/1', 'http://c/2']]
+
+		# a3 must wait for one of the others from a; c1 is over the global limit
+		self.assertEquals([True, True, False, True, False, False],
+				  [s.happened for s in (a1, a2, a3, b1, c1, c2)])
+
+		# Giving up on a queued download doesn't release anything
+		scheduler.release_slot(c2)
+		assert not c1.happened
+
+		# Oldest request first, within the limits
+		scheduler.release_slot(a1)
+		assert a3.happened and not c1.happened
+		scheduler.release_slot(b1)
+		assert c1.happened
+
+	def testKeepAlive(self):
+		# (tests/server.py is HTTP/1.0, so use a server that supports keep-alive)
+		import BaseHTTPServer, threading
+		connections = []
+		class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			def setup(self):
+				BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+				connections.append(self.client_address)
+			def do_GET(self):
+				self.send_response(200)
+				self.send_header('Content-Length', str(len(self.path)))
+				self.end_headers()
+				self.wfile.write(self.path)
+			def log_message(self, *args):
+				pass
+		httpd = BaseHTTPServer.HTTPServer(('localhost', 8001), KeepAliveHandler)
+		thread = threading.Thread(target = httpd.serve_forever)
+		thread.daemon = True
+		thread.start()
+		old_proxy = os.environ.pop('http_proxy')
+		try:
+			for path in ['/one', '/two']:
+				dl = self.config.handler.get_download('http://localhost:8001' + path)
+				stream = dl.tempfile
+				tasks.wait_for_blocker(dl.downloaded)
+				stream.seek(0)
+				self.assertEquals(path, stream.read())
+			self.assertEquals(1, len(connections))
+		finally:
+			os.environ['http_proxy'] = old_proxy
+			self.config.handler.scheduler.connections.close_all()
+			httpd.shutdown()
+
+	def testResume(self):
+		url = 'http://example.com:8000/HelloWorld.tgz'
+		data = file('HelloWorld.tgz').read()
+
+		# The connection drops part way through, but we carry on from there
+		self.child = server.handle_requests(server.DropAfter('HelloWorld.tgz', 100), 'HelloWorld.tgz')
+		dl = self.config.handler.get_download(url, expected_size = len(data))
+		partial = dl.partial
+		assert partial is not None
+		stream = dl.tempfile
+		tasks.wait_for_blocker(dl.downloaded)
+		stream.seek(0)
+		self.assertEquals(data, stream.read())
+		assert not os.path.exists(partial)
+		os.waitpid(self.child, 0)
+		self.child = None
+
+		# This time it fails completely, but we keep what we got...
+		self.child = server.handle_requests(server.DropAfter('HelloWorld.tgz', 100), server.Give404('HelloWorld.tgz'))
+		dl = self.config.handler.get_download(url, expected_size = len(data))
+		self.assertEquals(partial, dl.partial)
+		try:
+			tasks.wait_for_blocker(dl.downloaded)
+			assert False
+		except download.DownloadError as ex:
+			assert '404' in str(ex), ex
+		self.assertEquals(data[:100], file(partial).read())
+		os.waitpid(self.child, 0)
+		self.child = None
+
+		# ... and only ask for the rest next time
+		stream = file(partial, 'r+b')
+		stream.write('X' * 100)
+		stream.close()
+		self.child = server.handle_requests('HelloWorld.tgz')
+		dl = self.config.handler.get_download(url, expected_size = len(data))
+		stream = dl.tempfile
+		tasks.wait_for_blocker(dl.downloaded)
+		stream.seek(0)
+		self.assertEquals('X' * 100 + data[100:], stream.read())
+		assert not os.path.exists(partial)
+
+		# A different size means a different version, so it doesn't use the old data
+		dl = self.config.handler.get_download(url, expected_size = len(data) + 1)
+		other = dl.partial
+		assert other not in (None, partial)
+		dl.abort()
+		try:
+			tasks.wait_for_blocker(dl.downloaded)
+			assert False
+		except download.DownloadAborted:
+			pass
+		assert not os.path.exists(other)		# (we didn't get anything worth keeping)
+
+	def testStreamDownload(self):
+		import BaseHTTPServer, threading
+		body = 'first half|second half'
+		first_half_read = threading.Event()
+		class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			def do_GET(self):
+				self.send_response(200)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body[:11])
+				self.wfile.flush()
+				# Don't send the rest until the client has seen the start
+				first_half_read.wait(10)
+				self.wfile.write(body[11:])
+			def log_message(self, *args):
+				pass
+		httpd = BaseHTTPServer.HTTPServer(('localhost', 8001), SlowHandler)
+		thread = threading.Thread(target = httpd.serve_forever)
+		thread.daemon = True
+		thread.start()
+		old_proxy = os.environ.pop('http_proxy')
+		try:
+			dl = self.config.handler.get_download('http://localhost:8001/archive')
+			dl.expected_size = len(body)
+			stream = dl.open_stream(skip = 6)
+			received = []
+
+			@tasks.async
+			def read_stream():
+				while True:
+					yield tasks.InputBlocker(stream, 'read stream')
+					data = os.read(stream.fileno(), 100)
+					if not data: break
+					received.append(data)
+					if ''.join(received).endswith('|'):
+						assert not dl.downloaded.happened
+						first_half_read.set()
+			tasks.wait_for_blocker(read_stream())
+			tasks.check(dl.downloaded)
+			self.assertEquals('half|second half', ''.join(received))
+		finally:
+			first_half_read.set()
+			os.environ['http_proxy'] = old_proxy
+			self.config.handler.scheduler.connections.close_all()
+			httpd.shutdown()
+
 if __name__ == '__main__':
 	unittest.main()
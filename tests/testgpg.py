@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from basetest import BaseTest
-import sys, tempfile
+import sys, tempfile, os
 import unittest
 import warnings
 
@@ -140,6 +140,45 @@ class TestGPG(BaseTest):
 	def testGoodXMLSig(self):
 		self.assertEquals(good_xml_sig, self.check_good(good_xml_sig))
 	
+	def testVerificationCache(self):
+		def check(sig):
+			stream = tempfile.TemporaryFile()
+			stream.write(sig)
+			stream.seek(0)
+			data, sigs = gpg.check_stream(stream)
+			self.assertEquals(sig, data.read())
+			return [(s.__class__, s.status) for s in sigs]
+
+		good = check(good_xml_sig)
+		bad = check(bad_xml_sig)
+		keys = gpg.load_keys([THOMAS_FINGERPRINT])
+
+		# Now we know the answers, so we don't need gpg any more
+		real_run_gpg = gpg._run_gpg
+		def no_gpg(*args, **kwargs):
+			raise Exception("Ran gpg!")
+		gpg._run_gpg = no_gpg
+		try:
+			self.assertEquals(good, check(good_xml_sig))
+			self.assertEquals(bad, check(bad_xml_sig))
+			self.assertEquals(keys[THOMAS_FINGERPRINT].name, gpg.load_keys([THOMAS_FINGERPRINT])[THOMAS_FINGERPRINT].name)
+
+			# The cache is kept on disk for next time
+			gpg._cache = gpg._VerificationCache()
+			self.assertEquals(good, check(good_xml_sig))
+
+			# If the keyring changes, we must check again
+			home, files = gpg._get_keyring_state()
+			os.utime(os.path.join(home, files[0][0]), (0, 0))
+			try:
+				check(good_xml_sig)
+				assert False
+			except Exception as ex:
+				assert 'Ran gpg' in str(ex), ex
+		finally:
+			gpg._run_gpg = real_run_gpg
+		self.assertEquals(good, check(good_xml_sig))
+
 	def check_good(self, sig):
 		stream = tempfile.TemporaryFile()
 		stream.write(sig)
@@ -160,6 +199,31 @@ class TestGPG(BaseTest):
 			self.fail("Missing name")
 		return data.read()
 	
+	def testCheckStreams(self):
+		feeds = [good_xml_sig, bad_xml_sig, err_sig, bad_xml_main, good_xml_sig]
+		streams = []
+		for feed in feeds:
+			stream = tempfile.TemporaryFile()
+			stream.write(feed)
+			stream.seek(0)
+			streams.append(stream)
+		results = gpg.check_streams(streams, max_children = 2)
+		self.assertEquals(len(feeds), len(results))
+
+		assert isinstance(results[3], model.SafeException)
+		assert 'No signature block' in str(results[3])
+
+		for i in [0, 1, 2, 4]:
+			data, sigs = results[i]
+			self.assertEquals(feeds[i], data.read())
+			streams[i].seek(0)
+			expected_data, expected_sigs = gpg.check_stream(streams[i])
+			self.assertEquals([(s.__class__, s.status) for s in expected_sigs],
+					  [(s.__class__, s.status) for s in sigs])
+		assert isinstance(results[0][1][0], gpg.ValidSig)
+		assert isinstance(results[1][1][0], gpg.BadSig)
+		assert isinstance(results[2][1][0], gpg.ErrSig)
+
 	def testNoSig(self):
 		stream = tempfile.TemporaryFile()
 		stream.write("Hello")
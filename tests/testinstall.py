@@ -297,6 +297,23 @@ class TestInstall(BaseTest):
 		assert not out, out
 		assert 'Trusting DE937DD411906ACF7C263B396FCF121BE2390E0B for example.com:8000' in err, out
 
+	def testImportMany(self):
+		stream = file('6FCF121BE2390E0B.gpg')
+		gpg.import_key(stream)
+		stream.close()
+		sys.stdin = Reply('Y\n')
+		out, err = self.run_0install(['import', 'Hello.xml', 'Native.xml'])
+		assert not out, out
+		self.assertEquals(1, err.count('Trusting DE937DD411906ACF7C263B396FCF121BE2390E0B for example.com:8000'))
+
+		out, err = self.run_0install(['list'])
+		assert not err, err
+		self.assertEquals('http://example.com:8000/Hello.xml\n'
+				  'http://example.com:8000/Native.xml\n', out)
+
+		out, err = self.run_0install(['import', 'Hello.xml', 'Missing.xml'])
+		assert "File 'Missing.xml' does not exist" in str(err), err
+
 	def testList(self):
 		out, err = self.run_0install(['list', 'foo', 'bar'])
 		assert out.lower().startswith("usage:")
@@ -104,6 +104,43 @@ class PackageKit05:
 				self.signals['Finished']("success", 100)
 			later()
 
+class PackageKitBatch(PackageKit05):
+	"""Records the Resolve queries. Only gimp and inkscape exist."""
+	def __init__(self):
+		self.queries = []
+
+	class Resolver(PackageKit05.Tid):
+		def __init__(self, pk):
+			PackageKit05.Tid.__init__(self)
+			self.pk = pk
+
+		def Resolve(self, query, package_names):
+			self.pk.queries.append(package_names)
+			@tasks.async
+			def later():
+				yield
+				result = "success"
+				for package_name in package_names:
+					if package_name in ('gimp', 'inkscape'):
+						self.signals['Package']("available", "%s;1.0-1;amd64;Ubuntu" % package_name, "summary")
+					else:
+						self.signals['ErrorCode']("package-not-found", "Package name %s could not be resolved" % package_name)
+						result = "failed"
+				yield
+				self.signals['Finished'](result, 100)
+			later()
+
+	class Details(PackageKit05.Tid):
+		def GetDetails(self, package_ids):
+			@tasks.async
+			def later():
+				yield
+				for package_id in package_ids:
+					self.signals['Details'](package_id, "GPL", "Graphics", "detail", "http://foo", 100)
+				yield
+				self.signals['Finished']("success", 100)
+			later()
+
 class TestPackageKit(BaseTest):
 	def setUp(self):
 		BaseTest.setUp(self)
@@ -187,5 +224,44 @@ class TestPackageKit(BaseTest):
 		tasks.wait_for_blocker(b)
 		tasks.check(b)
 
+	def testBatch(self):
+		batch = PackageKitBatch()
+		dbus.system_services['org.freedesktop.PackageKit'] = {
+			'/org/freedesktop/PackageKit': batch,
+			'/tid/1': PackageKitBatch.Resolver(batch),
+			'/tid/2': PackageKitBatch.Details(),
+		}
+		reload(packagekit)
+		pk = packagekit.PackageKit()
+		assert pk.available
+
+		# Requests made together are resolved in a single transaction,
+		# even if one of the packages doesn't exist. Whichever order the tasks
+		# run in, the second one shares a package with the first and adds a new one.
+		blockers = [pk.fetch_candidates(["gimp", "inkscape"]),
+			    pk.fetch_candidates(["gimp", "nosuchpackage"]),
+			    pk.fetch_candidates(["gimp"])]
+		for blocker in blockers:
+			tasks.wait_for_blocker(blocker)
+			tasks.check(blocker)
+		self.assertEquals(1, len(batch.queries))
+		self.assertEquals(["gimp", "inkscape", "nosuchpackage"], sorted(batch.queries[0]))
+		self.assertEquals(2, batch.x)
+
+		impls = []
+		def factory(impl_id, only_if_missing, installed):
+			impl = model.DistributionImplementation(None, impl_id, self)
+			impls.append(impl_id)
+			return impl
+		for package in ["gimp", "inkscape", "nosuchpackage"]:
+			pk.get_candidates(package, factory, 'package:test')
+		self.assertEquals(["package:test:gimp:1.0-1:x86_64",
+				   "package:test:inkscape:1.0-1:x86_64"], impls)
+
+		# Known packages aren't resolved again
+		blocker = pk.fetch_candidates(["gimp", "nosuchpackage"])
+		tasks.wait_for_blocker(blocker)
+		self.assertEquals(1, len(batch.queries))
+
 if __name__ == '__main__':
 	unittest.main()
@@ -7,6 +7,8 @@ import os
 sys.path.insert(0, '..')
 
 from zeroinstall.injector import model, gpg, reader
+from zeroinstall.injector.namespaces import config_site, config_prog
+from zeroinstall.support import basedir
 import data
 
 foo_iface_uri = 'http://foo'
@@ -287,6 +289,40 @@ class TestReader(BaseTest):
 		self.assertEquals('fr', feed.implementations['sha1=124'].langs)
 		self.assertEquals('fr en-GB', feed.implementations['sha1=234'].langs)
 		self.assertEquals('', feed.implementations['sha1=345'].langs)
-	
+
+	def testParsedCache(self):
+		cache_dir = basedir.save_cache_path(config_site, 'interfaces')
+		cached = os.path.join(cache_dir, model.escape(foo_iface_uri))
+		tmp = self.write_with_bindings('<environment name="FOO" insert="."/>')
+		file(cached, 'w').write(file(tmp.name).read())
+
+		feed = reader.load_feed_from_cache(foo_iface_uri)
+		assert basedir.load_first_cache(config_site, config_prog, 'parsed-feeds', model.escape(foo_iface_uri))
+
+		# The second load must not parse the XML again
+		old_load_feed = reader.load_feed
+		def no_parsing(*args, **kwargs):
+			assert 0, "Feed parsed again!"
+		reader.load_feed = no_parsing
+		try:
+			parsed = reader.load_feed_from_cache(foo_iface_uri)
+		finally:
+			reader.load_feed = old_load_feed
+
+		assert parsed is not feed
+		self.assertEquals(feed.url, parsed.url)
+		self.assertEquals(feed.last_modified, parsed.last_modified)
+		impl = parsed.implementations['sha1=123']
+		assert impl.feed is parsed
+		assert impl.upstream_stability is model.testing
+		self.assertEquals(model.parse_version('1'), impl.version)
+		self.assertEquals('FOO', impl.requires[0].bindings[0].name)
+
+		# Changing the cached feed invalidates the parsed copy
+		tmp = self.write_with_version('')
+		file(cached, 'w').write(file(tmp.name).read())
+		feed = reader.load_feed_from_cache(foo_iface_uri)
+		self.assertEquals({}, feed.implementations)
+
 if __name__ == '__main__':
 	unittest.main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from basetest import BaseTest
-import sys
+import sys, random
 import unittest
 
 sys.path.insert(0, '..')
@@ -296,6 +296,71 @@ class TestSAT(BaseTest):
 			'libc': None
 		}, selected)
 	
+	def testFailureReason(self):
+		# The reason comes from the conflict, without a second solve
+		s = assertSelection("prog-FAIL", """
+			prog: 1
+			liba: 1
+			libb: 1
+			libc: 1 2
+			libd: 1
+			prog[1] => liba 1 1
+			prog[1] => libb 1 1
+			prog[1] => libd 1 1
+			liba[1] => libc 1 1
+			libb[1] => libc 2 3
+			""")
+		assert s._closest_match_args is not None
+		self.assertEquals("Can't find all required implementations:\n"
+			"- http://localhost/tests/prog must be selected (usable versions: 1)\n"
+			"- http://localhost/tests/prog 1 requires http://localhost/tests/libb (restriction: 1 <= version < 2) (usable versions: 1)\n"
+			"- http://localhost/tests/libb 1 requires http://localhost/tests/libc (restriction: 2 <= version < 4) (usable versions: 1, 2)\n"
+			"- http://localhost/tests/prog 1 requires http://localhost/tests/liba (restriction: 1 <= version < 2) (usable versions: 1)\n"
+			"- http://localhost/tests/liba 1 requires http://localhost/tests/libc (restriction: 1 <= version < 2) (usable versions: 1, 2)\n"
+			"- only one version of http://localhost/tests/libc can be selected",
+			str(s.get_failure_reason()))
+
+		# The closest match is still available if wanted
+		self.assertEquals(None, s.selections.selections['http://localhost/tests/libb'])
+		assert s._closest_match_args is None
+		assert "only one version of http://localhost/tests/libc" in str(s.get_failure_reason())
+
+	def testExplainFailure(self):
+		# The clauses given as the reason for a failure can't be satisfied on their own
+		rand = random.Random(1)
+		def make_problem(n_vars, clauses):
+			problem = sat.SATProblem()
+			variables = [problem.add_variable(i) for i in range(n_vars)]
+			for i, (kind, lits) in enumerate(clauses):
+				if kind == 'one':
+					problem.at_most_one(lits, i)
+				else:
+					problem.add_clause(lits, i)
+			def decide():
+				for v in variables:
+					if problem.lit_value(v) is None:
+						return v
+			return problem, problem.run_solver(decide)
+
+		failures = 0
+		for x in range(200):
+			n_vars = rand.randint(3, 12)
+			clauses = []
+			for c in range(rand.randint(1, n_vars * 3)):
+				lits = rand.sample(range(n_vars), rand.randint(1, min(3, n_vars)))
+				if rand.randint(0, 3) == 0:
+					clauses.append(('one', lits))
+				else:
+					clauses.append(('some', [rand.choice([l, sat.neg(l)]) for l in lits]))
+			problem, ready = make_problem(n_vars, clauses)
+			if ready: continue
+			failures += 1
+			core = problem.explain_failure()
+			assert core
+			core_problem, ready = make_problem(n_vars, [clauses[i] for i in sorted(core)])
+			assert not ready, (clauses, core)
+		assert failures > 20, failures
+
 	def testWatch(self):
 		solver = sat.SATProblem()
 
@@ -319,6 +384,26 @@ class TestSAT(BaseTest):
 
 		assert solver.assigns[a].value == True
 
+	def testLargeLiterals(self):
+		# Python only shares small int objects, so literals must be
+		# compared by value, not identity.
+		solver = sat.SATProblem()
+
+		variables = [solver.add_variable(str(i)) for i in range(300)]
+		a, b = variables[-2:]
+		solver.at_most_one([a, b])
+
+		def decide():
+			if solver.lit_value(b) is None:
+				return sat.neg(sat.neg(b))	# Same value, different object
+			for v in variables:
+				if solver.lit_value(v) is None:
+					return sat.neg(v)
+
+		assert solver.run_solver(decide)
+		assert solver.assigns[b].value == True
+		assert solver.assigns[a].value == False
+
 	def testOverbacktrack(self):
 		# After learning that prog-3 => m0 we backtrack all the way up to the prog-3
 		# assignment, unselecting liba-3, and then select it again.
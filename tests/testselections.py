@@ -143,5 +143,41 @@ class TestSelections(BaseTest):
 		dep_impl = s2.selections[dep_impl_uri]
 		assert dep_impl.id == 'sha1=256'
 
+	def testSavedSelections(self):
+		from zeroinstall.injector import selections_cache, requirements
+		import shutil
+
+		iface = os.path.join(self.config_home, "Local.xml")
+		shutil.copyfile(os.path.join(mydir, "Local.xml"), iface)
+
+		r = requirements.Requirements(iface)
+		assert selections_cache.load_selections(self.config, r) is None
+
+		p = policy.Policy(config = self.config, requirements = r)
+		p.need_download()
+		assert p.ready
+		selections_cache.save_selections(self.config, r, p.solver)
+
+		s = selections_cache.load_selections(self.config, r)
+		assert s is not None
+		self.assertEquals(iface, s.interface)
+		self.assertEquals('sha1=256', s.selections[iface].id)
+		self.assertEquals(self.config_home, s.selections[iface].local_path)
+
+		# Different requirements
+		r2 = requirements.Requirements(iface)
+		r2.command = None
+		assert selections_cache.load_selections(self.config, r2) is None
+
+		# Different settings
+		self.config.help_with_testing = True
+		assert selections_cache.load_selections(self.config, r) is None
+		self.config.help_with_testing = False
+		assert selections_cache.load_selections(self.config, r) is not None
+
+		# Feed changed
+		os.utime(iface, (0, 0))
+		assert selections_cache.load_selections(self.config, r) is None
+
 if __name__ == '__main__':
 	unittest.main()
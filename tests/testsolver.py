@@ -4,7 +4,7 @@ import sys, os, locale
 import unittest
 
 sys.path.insert(0, '..')
-from zeroinstall.injector import solver, arch
+from zeroinstall.injector import solver, arch, model
 
 import logging
 logger = logging.getLogger()
@@ -208,6 +208,101 @@ class TestSolver(BaseTest):
 		finally:
 			locale.setlocale(locale.LC_ALL, '')
 
+	def testAvailabilityChecks(self):
+		# Each implementation is only looked up in the stores once per solve
+		lookups = []
+		class CountingStores:
+			def lookup_maybe(self, digests):
+				lookups.extend(digests)
+				return '/'
+		self.config.stores = CountingStores()
+		self.config.network_use = model.network_offline
+
+		s = solver.DefaultSolver(self.config)
+		s.langs = ['en']
+		s.record_details = True
+		iface = self.config.iface_cache.get_interface('http://foo/Langs.xml')
+		self.import_feed(iface.uri, 'Langs.xml')
+		s.solve('http://foo/Langs.xml', arch.get_architecture(None, 'arch_2'))
+		assert s.ready
+		self.assertEquals('sha1=6', s.selections[iface].id)
+
+		self.assertEquals(18, len(lookups))
+		self.assertEquals(18, len(set(lookups)))
+
+	def testReuseEncodings(self):
+		iface_cache = self.config.iface_cache
+		s = solver.DefaultSolver(self.config)
+
+		foo = iface_cache.get_interface('http://foo/Binary.xml')
+		self.import_feed(foo.uri, 'Binary.xml')
+		foo_src = iface_cache.get_interface('http://foo/Source.xml')
+		self.import_feed(foo_src.uri, 'Source.xml')
+		compiler = iface_cache.get_interface('http://foo/Compiler.xml')
+		self.import_feed(compiler.uri, 'Compiler.xml')
+
+		binary_arch = arch.Architecture({None: 1}, {None: 1})
+		def solve():
+			s.solve(foo.uri, arch.SourceArchitecture(binary_arch), command_name = 'compile')
+			assert s.ready, s.get_failure_reason()
+			self.assertEquals('sha1=234', s.selections[foo].id)
+			self.assertEquals('sha1=345', s.selections[compiler].id)
+			return dict((uri, encoding) for (uri, arch_key), encoding in s._encodings.items())
+
+		first = solve()
+		self.assertEquals(set([foo.uri, compiler.uri]), set(first))
+
+		# Nothing changed, so nothing is encoded again
+		second = solve()
+		for uri in first:
+			assert first[uri] is second[uri], uri
+
+		# Changing a preference only affects that interface
+		compiler.set_stability_policy(model.developer)
+		third = solve()
+		assert third[foo.uri] is first[foo.uri]
+		assert third[compiler.uri] is not first[compiler.uri]
+
+		# As does a new copy of a feed
+		self.import_feed(compiler.uri, 'Compiler.xml')
+		fourth = solve()
+		assert fourth[foo.uri] is first[foo.uri]
+		assert fourth[compiler.uri] is not third[compiler.uri]
+
+		# Using a different host architecture encodes everything again
+		s.solve(foo.uri, arch.get_architecture('Linux', 'x86_64'))
+		for encoding in s._encodings.values():
+			assert encoding not in fourth.values()
+
+	def testRestrictionRanges(self):
+		class Impl:
+			def __init__(self, version):
+				self.version = model.parse_version(version)
+		versions = ['0.9', '1.0-pre', '1.0', '1.0', '1.0-post', '1.1', '2.0-rc1', '2.0', '10']
+		impls = [Impl(v) for v in versions]
+		encoding = solver._IfaceEncoding(None, None, [solver.ImplInfo(None, impl, None) for impl in impls])
+
+		class OddOnly(model.Restriction):
+			def meets_restriction(self, impl):
+				return impls.index(impl) % 2 == 1
+
+		def check(*restrictions):
+			expected = set(impl for impl in impls
+					if all(r.meets_restriction(impl) for r in restrictions))
+			self.assertEquals(expected, encoding.get_meeting(restrictions))
+
+		check()
+		for v in versions + ['0.1', '1.0.1', '3', '11']:
+			pv = model.parse_version(v)
+			check(model.VersionRestriction(pv))
+			check(model.VersionRangeRestriction(pv, None))
+			check(model.VersionRangeRestriction(None, pv))
+			check(model.VersionRangeRestriction(model.parse_version('2.0'), pv), OddOnly())
+			for v2 in versions:
+				check(model.VersionRangeRestriction(model.parse_version(v2), pv))
+				check(model.VersionRangeRestriction(None, pv), model.VersionRestriction(model.parse_version(v2)))
+		check(OddOnly())
+
 	def testDecideBug(self):
 		s = solver.DefaultSolver(self.config)
 		watch_xml = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'watchdog.xml')
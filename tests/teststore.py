@@ -38,6 +38,32 @@ class TestStore(BaseTest):
 		assert os.path.isdir(self.store.dir)
 		self.assertEquals([], os.listdir(self.store.dir))
 
+	def testLookupListing(self):
+		digest = 'sha1=' + '1' * 40
+		other = 'sha1=' + '2' * 40
+		item = os.path.join(self.store.dir, digest)
+		os.mkdir(item)
+		os.utime(self.store.dir, (100, 100))
+
+		self.assertEquals(item, self.store.lookup(digest))
+		assert self.store.lookup(other) is None
+
+		# Further lookups use the listing
+		os.rmdir(item)
+		os.mkdir(os.path.join(self.store.dir, other))
+		os.utime(self.store.dir, (100, 100))
+		self.assertEquals(item, self.store.lookup(digest))
+		assert self.store.lookup(other) is None
+
+		# Changing the mtime causes it to be listed again
+		os.utime(self.store.dir, (200, 200))
+		assert self.store.lookup(digest) is None
+		self.assertEquals(os.path.join(self.store.dir, other), self.store.lookup(other))
+
+		# A recently-modified store is checked directly
+		os.rmdir(os.path.join(self.store.dir, other))
+		assert self.store.lookup(other) is None
+
 	def testEmptyManifest(self):
 		lines = list(manifest.generate_manifest(self.tmp))
 		self.assertEquals([], lines)
@@ -52,6 +78,45 @@ class TestStore(BaseTest):
 		self.assertEquals(['F f7ff9e8b7bb2e09b70935a5d785e0cc5d9d0abf0 2 5 MyFile'],
 				lines)
 
+	def testParallelManifest(self):
+		os.mkdir(os.path.join(self.tmp, 'sub'))
+		for i in range(10):
+			stream = file(os.path.join(self.tmp, 'sub' if i % 2 else '', 'file%d' % i), 'w')
+			stream.write(str(i) * (manifest._parallel_threshold * i // 3))
+			stream.close()
+		alg = manifest.get_algorithm('sha256')
+		try:
+			manifest.max_workers = 1
+			serial = list(alg.generate_manifest(self.tmp))
+			manifest.max_workers = 3
+			parallel = list(alg.generate_manifest(self.tmp))
+		finally:
+			manifest.max_workers = None
+		self.assertEquals(11, len(serial))	# 10 files and "D /sub"
+		self.assertEquals(serial, parallel)
+
+	def testManifestMemory(self):
+		import resource
+		def get_peak_mb():
+			peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			if sys.platform == 'darwin':
+				return peak / (1024 * 1024)	# (bytes)
+			return peak / 1024
+
+		path = os.path.join(self.tmp, 'huge')
+		for alg in ['sha1', 'sha1new', 'sha256']:
+			for size_mb in [16, 128]:
+				# (sparse, so it doesn't use much disk space)
+				stream = file(path, 'w')
+				stream.truncate(size_mb * 1024 * 1024)
+				stream.close()
+
+				before = get_peak_mb()
+				lines = list(manifest.get_algorithm(alg).generate_manifest(self.tmp))
+				self.assertEquals(1, len(lines))
+				grown = get_peak_mb() - before
+				assert grown < 16, "%s used %d MB extra for a %d MB file" % (alg, grown, size_mb)
+
 	def testLinkManifest(self):
 		path = os.path.join(self.tmp, 'MyLink')
 		os.symlink('Hello', path)
@@ -76,7 +141,46 @@ class TestStore(BaseTest):
 				os.unlink(mfile)
 			except BadDigest as ex:
 				raise Exception("%s: %s\n%s" % (alg_name, ex, ex.detail))
-	
+
+	def testQuickVerify(self):
+		self.populate_sample(self.tmp)
+		alg = manifest.get_algorithm('sha256')
+		digest = alg.getID(manifest.add_manifest_file(self.tmp, alg))
+
+		# Full verification doesn't use an index
+		assert manifest.verify(self.tmp, digest) is None
+
+		index = manifest.verify(self.tmp, digest, quick = True)
+		self.assertEquals(0, index.skipped_files)
+		self.assertEquals(3, index.hashed_files)
+
+		index = manifest.verify(self.tmp, digest, quick = True)
+		self.assertEquals(3, index.skipped_files)
+		self.assertEquals(5 + 10 + 10, index.skipped_bytes)
+		self.assertEquals(0, index.hashed_files)
+
+		# Modify a file without changing its size or mtime. The ctime changes,
+		# so we notice.
+		path = os.path.join(self.tmp, 'MyFile')
+		os.chmod(path, 0o644)
+		f = file(path, 'w')
+		f.write('Hallo')
+		f.close()
+		os.chmod(path, 0o444)
+		os.utime(path, (1, 2))
+		try:
+			manifest.verify(self.tmp, digest, quick = True)
+			assert 0
+		except BadDigest:
+			pass
+
+		# Old algorithm doesn't support quick mode
+		os.chmod(self.tmp, 0o700)
+		os.unlink(os.path.join(self.tmp, '.manifest'))
+		alg = manifest.get_algorithm('sha1')
+		digest = alg.getID(manifest.add_manifest_file(self.tmp, alg))
+		assert manifest.verify(self.tmp, digest, quick = True) is None
+
 	def populate_sample(self, target):
 		"""Create a set of files, links and directories in target for testing."""
 		path = os.path.join(target, 'MyFile')
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from basetest import BaseTest
-import sys, tempfile, os
+import sys, tempfile, os, tarfile
 import unittest, logging
 
 sys.path.insert(0, '..')
@@ -112,6 +112,94 @@ class AbstractTestUnpack():
 		unpack.unpack_archive('ftp://foo/file.gem', file('hello-0.1.gem'), self.tmpdir)
 		self.assert_manifest('sha1new=fbd4827be7a18f9821790bdfd83132ee60d54647')
 
+	def testUnpackWithManifest(self):
+		alg = manifest.get_algorithm('sha256')
+		def get_digest(root, builder):
+			if builder is None:
+				manifest.fixup_permissions(root)
+			else:
+				builder.fixup_permissions(root)
+			return alg.getID(manifest.add_manifest_file(root, alg, builder))
+
+		for archive, extract, single_pass in [('HelloWorld.tgz', None, True),
+						      ('HelloWorld.tgz', 'HelloWorld', True),
+						      ('HelloWorld.tar.bz2', None, True),
+						      ('HelloSym.tgz', None, True),
+						      ('HelloWorld.zip', 'HelloWorld', True),
+						      ('hello-0.1.gem', None, False)]:
+			old_dir = tempfile.mkdtemp(dir = self.tmpdir)
+			unpack.unpack_archive('ftp://foo/' + archive, file(archive), old_dir, extract)
+			old_dir = os.path.join(old_dir, extract or '')
+			expected = get_digest(old_dir, None)
+
+			new_dir = tempfile.mkdtemp(dir = self.tmpdir)
+			builder = unpack.unpack_archive_with_manifest('ftp://foo/' + archive, file(archive), new_dir, alg, extract)
+			self.assertEquals(single_pass, builder is not None)
+			new_dir = os.path.join(new_dir, extract or '')
+			self.assertEquals(expected, get_digest(new_dir, builder))
+			self.assertEquals(file(os.path.join(old_dir, '.manifest')).read(),
+					  file(os.path.join(new_dir, '.manifest')).read())
+
+			# The files were given the right permissions as they were written
+			for root, dirs, files in os.walk(new_dir):
+				for f in files + dirs:
+					full = os.path.join(root, f)
+					if os.path.islink(full): continue
+					self.assertEquals(os.stat(full).st_mode & 0o777, os.stat(full.replace(new_dir, old_dir)).st_mode & 0o777)
+
+	def testUnpackWithManifestHardLink(self):
+		# A top-level file followed by a hard link can't be unpacked in a single pass,
+		# so the file must be removed again before falling back to unpack_archive
+		src = tempfile.mkdtemp(dir = self.tmpdir)
+		file(os.path.join(src, 'a'), 'w').write('Hello\n')
+		os.link(os.path.join(src, 'a'), os.path.join(src, 'b'))
+		archive = os.path.join(self.tmpdir, 'links.tar')
+		tar = tarfile.open(archive, 'w')
+		tar.add(os.path.join(src, 'a'), 'a')
+		tar.add(os.path.join(src, 'b'), 'b')
+		tar.close()
+
+		alg = manifest.get_algorithm('sha256')
+		new_dir = tempfile.mkdtemp(dir = self.tmpdir)
+		builder = unpack.unpack_archive_with_manifest('ftp://foo/links.tar', file(archive), new_dir, alg)
+		self.assertEquals(None, builder)
+		self.assertEquals(['a', 'b'], sorted(os.listdir(new_dir)))
+		self.assertEquals('Hello\n', file(os.path.join(new_dir, 'b')).read())
+
+	def testStreamUnpacker(self):
+		alg = manifest.get_algorithm('sha256')
+		assert unpack.can_stream('application/x-compressed-tar', alg)
+		assert not unpack.can_stream('application/zip', alg)
+		assert not unpack.can_stream('application/x-compressed-tar', manifest.get_algorithm('sha1'))
+
+		expected_dir = tempfile.mkdtemp(dir = self.tmpdir)
+		unpack.unpack_archive('ftp://foo/HelloWorld.tgz', file('HelloWorld.tgz'), expected_dir)
+		manifest.fixup_permissions(expected_dir)
+		expected = alg.getID(manifest.add_manifest_file(expected_dir, alg))
+
+		# Feed the archive in through a pipe, as a download would
+		r, w = os.pipe()
+		new_dir = tempfile.mkdtemp(dir = self.tmpdir)
+		unpacker = unpack.StreamUnpacker('ftp://foo/HelloWorld.tgz', os.fdopen(r, 'rb'), new_dir, alg, type = 'application/x-compressed-tar')
+		data = file('HelloWorld.tgz', 'rb').read()
+		half = len(data) // 2
+		os.write(w, data[:half])
+		os.write(w, data[half:])
+		os.close(w)
+		builder = unpacker.get_result()
+		assert builder is not None
+		builder.fixup_permissions(new_dir)
+		self.assertEquals(expected, alg.getID(manifest.add_manifest_file(new_dir, alg, builder)))
+
+		# A truncated stream leaves nothing behind (the caller falls back to the downloaded copy)
+		r, w = os.pipe()
+		bad_dir = tempfile.mkdtemp(dir = self.tmpdir)
+		unpacker = unpack.StreamUnpacker('ftp://foo/HelloWorld.tgz', os.fdopen(r, 'rb'), bad_dir, alg, type = 'application/x-compressed-tar')
+		os.write(w, data[:half])
+		os.close(w)
+		self.assertEquals(None, unpacker.get_result())
+		self.assertEquals([], os.listdir(bad_dir))
+
 	def testSpecial(self):
 		os.chmod(self.tmpdir, 0o2755)
 		store = Store(self.tmpdir)
@@ -11,7 +11,7 @@ import logging
 from zeroinstall import SafeException, _
 from zeroinstall.cmd import UsageError
 from zeroinstall.injector import gpg
-from zeroinstall.injector.iface_cache import PendingFeed
+from zeroinstall.injector.iface_cache import PendingFeed, download_keys
 from zeroinstall.support import tasks
 from xml.dom import minidom
 
@@ -29,22 +29,34 @@ def handle(config, options, args):
 	for x in args:
 		if not os.path.isfile(x):
 			raise SafeException(_("File '%s' does not exist") % x)
+
+	# Check all the signatures first, running several copies of gpg at once
+	streams = [file(x) for x in args]
+	results = gpg.check_streams(streams)
+
+	pending_feeds = []
+	for x, signed_data, result in zip(args, streams, results):
 		logging.info(_("Importing from file '%s'"), x)
-		signed_data = file(x)
-		data, sigs = gpg.check_stream(signed_data)
+		if isinstance(result, Exception):
+			raise result
+		data, sigs = result
 		doc = minidom.parseString(data.read())
 		uri = doc.documentElement.getAttribute('uri')
 		if not uri:
 			raise SafeException(_("Missing 'uri' attribute on root element in '%s'") % x)
 		logging.info(_("Importing information about interface %s"), uri)
+		data.seek(0)
 		signed_data.seek(0)
 
-		pending = PendingFeed(uri, signed_data)
+		pending_feeds.append(PendingFeed(uri, signed_data, checked = (data, sigs)))
 
-		def run():
-			keys_downloaded = tasks.Task(pending.download_keys(h), "download keys")
-			yield keys_downloaded.finished
-			tasks.check(keys_downloaded.finished)
+	def run():
+		# Get any missing keys for all the feeds together
+		keys_downloaded = tasks.Task(download_keys(pending_feeds, h), "download keys")
+		yield keys_downloaded.finished
+		tasks.check(keys_downloaded.finished)
+		for pending in pending_feeds:
+			uri = pending.url
 			if not config.iface_cache.update_feed_if_trusted(uri, pending.sigs, pending.new_xml):
 				blocker = config.trust_mgr.confirm_keys(pending)
 				if blocker:
@@ -53,8 +65,8 @@ def handle(config, options, args):
 				if not config.iface_cache.update_feed_if_trusted(uri, pending.sigs, pending.new_xml):
 					raise SafeException(_("No signing keys trusted; not importing"))
 
-		task = tasks.Task(run(), "import feed")
+	task = tasks.Task(run(), "import feed")
 
-		errors = tasks.wait_for_blocker(task.finished)
-		if errors:
-			raise SafeException(_("Errors during download: ") + '\n'.join(errors))
+	errors = tasks.wait_for_blocker(task.finished)
+	if errors:
+		raise SafeException(_("Errors during download: ") + '\n'.join(errors))
@@ -10,7 +10,7 @@ import logging
 
 from zeroinstall import _
 from zeroinstall.cmd import UsageError
-from zeroinstall.injector import model, selections, requirements
+from zeroinstall.injector import model, selections, requirements, selections_cache
 from zeroinstall.injector.policy import Policy
 from zeroinstall.support import tasks
 
@@ -62,6 +62,13 @@ def get_selections(config, options, iface_uri, select_only, download_only, test_
 	r = requirements.Requirements(iface_uri)
 	r.parse_options(options)
 
+	if not (options.refresh or options.gui):
+		# If nothing has changed since last time, we don't need to solve again
+		saved = selections_cache.load_selections(config, r)
+		if saved is not None:
+			logging.info(_("Using saved selections for %s"), iface_uri)
+			return saved
+
 	policy = Policy(config = config, requirements = r)
 
 	# Note that need_download() triggers a solve
@@ -93,6 +100,9 @@ def get_selections(config, options, iface_uri, select_only, download_only, test_
 				# Do the update in the background while the program is running.
 				from zeroinstall.injector import background
 				background.spawn_background_update(policy, options.verbose > 0)
+		elif not select_only:
+			# Everything is fresh and cached, so next time we can skip the solve
+			selections_cache.save_selections(config, r, policy.solver)
 		return policy.solver.selections
 
 	# If the user didn't say whether to use the GUI, choose for them.
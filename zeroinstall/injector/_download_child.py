@@ -24,12 +24,8 @@ def _download_as_child(url, if_modified_since):
 		else:
 			raise Exception(_('Unsupported URL protocol in: %s') % url)
 
-		try:
-			sock = src.fp._sock
-		except AttributeError:
-			sock = src.fp.fp._sock	# Python 2.5 on FreeBSD
 		while True:
-			data = sock.recv(256)
+			data = src.read(64 * 1024)
 			if not data: break
 			os.write(1, data)
 
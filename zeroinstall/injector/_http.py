@@ -0,0 +1,571 @@
+"""
+A small HTTP client using non-blocking sockets, driven by L{tasks}.
+
+This lets us fetch several resources at once from within the main process, reusing
+keep-alive connections for later requests to the same server. https: URLs are
+fetched over TLS, tunnelling through the proxy (if any) with CONNECT. It is used by
+L{download.Download}; there should be no need to use it directly.
+"""
+
+# Copyright (C) 2011, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _, version
+import os, socket, errno, select, time, urllib, urlparse, base64
+from logging import debug
+
+from zeroinstall.support import tasks
+
+try:
+	import ssl
+except ImportError:
+	ssl = None		# Python was built without SSL support
+
+_bufsize = 64 * 1024		# Read this much from the socket at a time
+_max_header_size = 64 * 1024
+_max_redirects = 10
+_max_idle_time = 30		# Don't reuse connections idle for longer than this (seconds)
+_max_idle_per_server = 4
+
+schemes = ('http', 'https')	# The URL schemes we can fetch
+_default_ports = {'http': 80, 'https': 443}
+
+_redirect_codes = (301, 302, 303, 307)
+_retry_errors = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+class HTTPError(Exception):
+	"""The server returned an error, or a response we don't understand."""
+	pass
+
+class IncompleteResponse(HTTPError):
+	"""The connection was closed before the whole body had arrived.
+	Whatever did arrive has been written to the stream, so it may be worth resuming."""
+	pass
+
+class _StaleConnection(Exception):
+	"""A reused connection was closed by the server before it replied."""
+	pass
+
+class _Aborted(Exception):
+	pass
+
+def _would_block(ex):
+	return ex.args and ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+def _tls_blocker(ex, sock):
+	"""If ex means the TLS connection needs to read or write before the operation can
+	be retried, return a blocker for that. Otherwise, return None."""
+	if ssl is None or not isinstance(ex, ssl.SSLError):
+		return None
+	if ex.args[0] == ssl.SSL_ERROR_WANT_READ:
+		return tasks.InputBlocker(sock, _("TLS read"))
+	if ex.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+		return tasks.OutputBlocker(sock, _("TLS write"))
+	return None
+
+class Connection(object):
+	"""A non-blocking socket to a web server or proxy.
+	The generator methods yield L{tasks.Blocker}s; run them from a task.
+	@ivar key: the server we're connected to
+	@type key: (str, str, int)
+	@ivar buffer: data received but not yet used
+	@type buffer: str
+	@ivar eof: whether the server has closed its side
+	@type eof: bool
+	@ivar reused: whether this connection has already been used for an earlier request
+	@type reused: bool"""
+
+	__slots__ = ['key', 'sock', 'buffer', 'eof', 'reused', 'idle_since']
+
+	def __init__(self, key):
+		self.key = key
+		self.sock = None
+		self.buffer = ''
+		self.eof = False
+		self.reused = False
+		self.idle_since = None
+
+	def connect(self, host, port):
+		"""Open a new connection to the server (or to the proxy at host:port)."""
+		err = errno.EHOSTUNREACH
+		for family, socktype, proto, _unused, addr in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+			sock = socket.socket(family, socktype, proto)
+			sock.setblocking(False)
+			err = sock.connect_ex(addr)
+			if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EINTR):
+				yield tasks.OutputBlocker(sock, _("connect to %s") % host)
+				err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+			if err == 0:
+				self.sock = sock
+				return
+			sock.close()
+		raise socket.error(err, os.strerror(err))
+
+	def start_tls(self):
+		"""Switch to TLS, checking the server's certificate (where Python supports it)."""
+		if ssl is None:
+			raise HTTPError(_("Python was built without SSL support, so https: downloads aren't possible"))
+		hostname = self.key[1]
+		if hasattr(ssl, 'create_default_context'):
+			context = ssl.create_default_context()
+			sock = context.wrap_socket(self.sock, server_hostname = hostname, do_handshake_on_connect = False)
+		else:
+			sock = ssl.wrap_socket(self.sock, do_handshake_on_connect = False)	# Python < 2.7.9
+		self.sock = sock
+		while True:
+			try:
+				sock.do_handshake()
+				return
+			except ValueError as ex:
+				# (ssl.CertificateError, when the name doesn't match)
+				raise HTTPError(_("Bad certificate for %(host)s: %(error)s") % {'host': hostname, 'error': ex})
+			except socket.error as ex:
+				blocker = _tls_blocker(ex, sock)
+				if blocker is None: raise
+				yield blocker
+
+	def send_all(self, data):
+		"""Send all of data."""
+		while data:
+			try:
+				sent = self.sock.send(data)
+			except socket.error as ex:
+				blocker = _tls_blocker(ex, self.sock)
+				if blocker is None:
+					if not _would_block(ex): raise
+					blocker = tasks.OutputBlocker(self.sock, _("write to %s") % self.key[1])
+				yield blocker
+			else:
+				if sent:
+					data = data[sent:]
+				else:
+					# (TLS sockets return 0 if they need to wait)
+					yield tasks.OutputBlocker(self.sock, _("write to %s") % self.key[1])
+
+	def receive(self):
+		"""Add the next block of data from the server to L{buffer}, or set L{eof}."""
+		while True:
+			try:
+				data = self.sock.recv(_bufsize)
+			except socket.error as ex:
+				blocker = _tls_blocker(ex, self.sock)
+				if blocker is None:
+					if not _would_block(ex): raise
+					blocker = tasks.InputBlocker(self.sock, _("read from %s") % self.key[1])
+				yield blocker
+			else:
+				if data:
+					self.buffer += data
+				else:
+					self.eof = True
+				return
+
+	def is_closed(self):
+		"""Check whether the server has closed this idle connection (or sent something unexpected)."""
+		try:
+			readable, _unused, _unused = select.select([self.sock], [], [], 0)
+		except (select.error, socket.error):
+			return True
+		return bool(readable)
+
+	def close(self):
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+class ConnectionPool(object):
+	"""Keeps idle keep-alive connections so that later requests can reuse them."""
+	def __init__(self):
+		self._idle = {}		# key -> [Connection]
+
+	def get(self, key):
+		"""Return an open connection to key, or None if we don't have one."""
+		idle = self._idle.get(key, [])
+		now = time.time()
+		while idle:
+			conn = idle.pop()
+			if conn.idle_since + _max_idle_time > now and not conn.is_closed():
+				conn.reused = True
+				conn.idle_since = None
+				return conn
+			conn.close()
+		return None
+
+	def put(self, conn):
+		"""Return a connection which has finished its request and may be reused."""
+		idle = self._idle.setdefault(conn.key, [])
+		if conn.buffer or len(idle) >= _max_idle_per_server:
+			conn.close()
+		else:
+			conn.idle_since = time.time()
+			idle.append(conn)
+
+	def close_all(self):
+		for idle in self._idle.values():
+			for conn in idle:
+				conn.close()
+		self._idle = {}
+
+def _get_proxy(scheme, host):
+	"""Find the proxy to use for this host from the environment.
+	@return: (host, port, Proxy-Authorization header), or None to connect directly"""
+	proxy = urllib.getproxies().get(scheme, None)
+	if not proxy or urllib.proxy_bypass(host):
+		return None
+	if '://' not in proxy:
+		proxy = 'http://' + proxy
+	parsed = urlparse.urlparse(proxy)
+	auth = None
+	if parsed.username:
+		auth = 'Basic ' + base64.b64encode('%s:%s' % (urllib.unquote(parsed.username), urllib.unquote(parsed.password or '')))
+	return (parsed.hostname, parsed.port or 80, auth)
+
+def _parse_headers(head):
+	"""Parse a response's status line and headers.
+	@return: (version, code, reason, {lower-case-name: value})"""
+	lines = head.split('\n')
+	status = lines[0].strip().split(None, 2)
+	if len(status) < 2 or not status[0].startswith('HTTP/') or not status[1].isdigit():
+		raise HTTPError(_("Bad HTTP status line: %s") % repr(lines[0][:100]))
+	http_version = status[0]
+	code = int(status[1])
+	reason = status[2] if len(status) > 2 else ''
+
+	headers = {}
+	name = None
+	for line in lines[1:]:
+		line = line.rstrip('\r')
+		if not line: continue
+		if line[0] in ' \t' and name is not None:
+			headers[name] += ' ' + line.strip()
+			continue
+		if ':' not in line:
+			raise HTTPError(_("Bad HTTP header: %s") % repr(line[:100]))
+		name, value = line.split(':', 1)
+		name = name.strip().lower()
+		value = value.strip()
+		if name in headers:
+			headers[name] += ', ' + value
+		else:
+			headers[name] = value
+	return http_version, code, reason, headers
+
+def _tokens(value):
+	return [token.strip().lower() for token in value.split(',')]
+
+class HTTPFetch(object):
+	"""Fetch a single http: or https: URL into a stream, following redirects.
+	Use L{run} as a task.
+	@ivar not_modified: the server said the resource hasn't changed since modification_time (or still has the given etag)
+	@type not_modified: bool
+	@ivar validators: the ETag and Last-Modified headers sent with the resource, for use in a later conditional request
+	@type validators: (str | None, str | None)
+	@ivar redirected_to: set if the server redirected us to a URL we can't fetch ourselves
+	@type redirected_to: str | None
+	@ivar offset: the number of bytes of the resource already in the stream, which we asked the
+	server not to send again (reset to zero if it sends the whole resource anyway)
+	@type offset: int"""
+
+	def __init__(self, url, stream, modification_time = None, pool = None, aborted = None, offset = 0, etag = None):
+		"""@param url: the URL to fetch (see L{schemes})
+		@param stream: the body of the response is written here
+		@param modification_time: send this in an If-Modified-Since header
+		@param pool: reuse connections from this pool, and return them to it after use
+		@type pool: L{ConnectionPool} | None
+		@param aborted: stop (without error) when this is triggered
+		@type aborted: L{tasks.Blocker} | None
+		@param offset: stream already holds this many bytes from the start of the resource;
+		  ask for the rest with a Range request. If the server can't do that, stream is
+		  truncated and the whole resource is written to it instead.
+		@type offset: int
+		@param etag: send this in an If-None-Match header
+		@type etag: str | None"""
+		self.url = url
+		self.stream = stream
+		self.modification_time = modification_time
+		self.pool = pool
+		self.aborted = aborted or tasks.Blocker("abort " + url)
+		self.etag = etag
+		self.not_modified = False
+		self.validators = (None, None)
+		self.redirected_to = None
+		self.offset = offset
+		self._location = None
+		self._restart = False
+		self._head = None
+
+	def run(self):
+		"""Generator yielding L{tasks.Blocker}s until the download is complete.
+		@raise HTTPError: if the server returned an error response
+		@raise socket.error: if we failed to connect or lost the connection"""
+		url = self.url
+		try:
+			for i in range(_max_redirects + 1):
+				self._location = None
+				self._restart = False
+				for blocker in self._get(url):
+					yield blocker
+				if self._restart:
+					continue	# Ask again for the whole thing
+				if self._location is None:
+					return
+				url = urlparse.urljoin(url, self._location)
+				debug(_("Redirected to %s"), url)
+				if url.split(':', 1)[0] not in schemes:
+					self.redirected_to = url
+					return
+			raise HTTPError(_("Too many redirections"))
+		except _Aborted:
+			debug(_("Download of %s aborted"), url)
+
+	def _wait(self, gen):
+		"""Yield the blockers from gen, stopping if we're aborted."""
+		for blocker in gen:
+			yield blocker, self.aborted
+			if self.aborted.happened:
+				raise _Aborted()
+
+	def _get(self, url):
+		parsed = urlparse.urlparse(url)
+		scheme, netloc, path, params, query, fragment = parsed
+		host_header = netloc.rsplit('@', 1)[-1]
+		if not parsed.hostname:
+			raise HTTPError(_("Missing host name in URL '%s'") % url)
+		port = parsed.port or _default_ports[scheme]
+
+		headers = []
+		proxy = _get_proxy(scheme, parsed.hostname)
+		if proxy and scheme == 'http':
+			# Send the whole URL to the proxy
+			proxy_host, proxy_port, auth = proxy
+			key = (scheme, proxy_host, proxy_port)
+			target = urlparse.urlunparse((scheme, netloc, path or '/', params, query, ''))
+			if auth:
+				headers.append('Proxy-Authorization: ' + auth)
+			proxy = None
+		else:
+			# Talk to the server directly (or through a CONNECT tunnel for https)
+			key = (scheme, parsed.hostname, port)
+			target = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+		if self.modification_time:
+			headers.append('If-Modified-Since: ' + self.modification_time)
+		if self.etag:
+			headers.append('If-None-Match: ' + self.etag)
+		if self.offset:
+			headers.append('Range: bytes=%d-' % self.offset)
+
+		request = '\r\n'.join(['GET %s HTTP/1.1' % target,
+				       'Host: ' + host_header,
+				       'User-Agent: 0install/' + version] + headers) + '\r\n\r\n'
+
+		conn = self.pool and self.pool.get(key)
+		try:
+			while True:
+				if conn is None:
+					conn = Connection(key)
+					for blocker in self._open(conn, proxy):
+						yield blocker
+				try:
+					for blocker in self._wait(conn.send_all(request)):
+						yield blocker
+					for blocker in self._read_response(conn):
+						yield blocker
+					break
+				except _StaleConnection:
+					debug(_("Server closed idle connection; reconnecting"))
+					conn.close()
+					conn = None
+			if self.pool and conn.sock is not None:
+				self.pool.put(conn)
+			else:
+				conn.close()
+		except:
+			if conn is not None:
+				conn.close()
+			raise
+
+	def _open(self, conn, proxy):
+		"""Connect conn to its server, tunnelling through proxy if given, and start TLS for https."""
+		scheme, host, port = conn.key
+		if proxy:
+			proxy_host, proxy_port, auth = proxy
+			for blocker in self._wait(conn.connect(proxy_host, proxy_port)):
+				yield blocker
+			request = ['CONNECT %s:%d HTTP/1.1' % (host, port), 'Host: %s:%d' % (host, port)]
+			if auth:
+				request.append('Proxy-Authorization: ' + auth)
+			for blocker in self._wait(conn.send_all('\r\n'.join(request) + '\r\n\r\n')):
+				yield blocker
+			for blocker in self._read_head(conn):
+				yield blocker
+			http_version, code, reason, headers = self._head
+			if code != 200:
+				raise HTTPError(_("Proxy refused to connect to %(host)s: %(code)d %(reason)s") % {'host': host, 'code': code, 'reason': reason})
+		else:
+			for blocker in self._wait(conn.connect(host, port)):
+				yield blocker
+		if scheme == 'https':
+			for blocker in self._wait(conn.start_tls()):
+				yield blocker
+
+	def _read_head(self, conn):
+		"""Read a status line and headers into self._head."""
+		while True:
+			end = conn.buffer.find('\r\n\r\n')
+			if end != -1:
+				end += 4
+				break
+			end = conn.buffer.find('\n\n')
+			if end != -1:
+				end += 2
+				break
+			if len(conn.buffer) > _max_header_size:
+				raise HTTPError(_("HTTP headers too long"))
+			try:
+				for blocker in self._wait(conn.receive()):
+					yield blocker
+			except socket.error as ex:
+				if conn.reused and not conn.buffer and ex.args and ex.args[0] in _retry_errors:
+					raise _StaleConnection()
+				raise
+			if conn.eof:
+				if conn.reused and not conn.buffer:
+					raise _StaleConnection()
+				raise HTTPError(_("Connection closed before the server replied"))
+		head = conn.buffer[:end]
+		conn.buffer = conn.buffer[end:]
+		self._head = _parse_headers(head)
+
+	def _read_response(self, conn):
+		"""Read a response (ignoring any 1xx ones).
+		Closes conn if it can't be reused afterwards."""
+		while True:
+			for blocker in self._read_head(conn):
+				yield blocker
+			http_version, code, reason, headers = self._head
+			if code >= 200:
+				break
+			conn.reused = False		# (the next response is a real one)
+
+		if http_version == 'HTTP/1.1':
+			keep_alive = 'close' not in _tokens(headers.get('connection', ''))
+		else:
+			keep_alive = 'keep-alive' in _tokens(headers.get('connection', ''))
+
+		if code in (204, 304):
+			length = 0
+		elif 'chunked' in _tokens(headers.get('transfer-encoding', '')):
+			length = 'chunked'
+		elif 'content-length' in headers:
+			try:
+				length = int(headers['content-length'].split(',')[0])
+			except ValueError:
+				raise HTTPError(_("Bad Content-Length: %s") % headers['content-length'])
+		else:
+			length = None		# Until the server closes the connection
+			keep_alive = False
+
+		if code in _redirect_codes and 'location' in headers:
+			self._location = headers['location']
+			stream = None
+		elif code == 304 and (self.modification_time or self.etag):
+			self.not_modified = True
+			stream = None
+		elif code == 416 and self.offset:
+			# We've got more than the server has now. Start again.
+			debug(_("Server can't send %(url)s from byte %(offset)d; fetching all of it"), {'url': self.url, 'offset': self.offset})
+			self._discard_partial()
+			self._restart = True
+			stream = None
+		elif code == 206 and self.offset:
+			content_range = headers.get('content-range', '')
+			if not content_range.startswith('bytes %d-' % self.offset):
+				conn.close()
+				raise HTTPError(_("Server sent the wrong range (asked for bytes %(offset)d onwards; got %(range)s)") %
+						{'offset': self.offset, 'range': repr(content_range[:100])})
+			debug(_("Resuming %(url)s from byte %(offset)d"), {'url': self.url, 'offset': self.offset})
+			stream = self.stream
+		elif 200 <= code < 300:
+			self.validators = (headers.get('etag', None), headers.get('last-modified', None))
+			if self.offset:
+				debug(_("Server doesn't support resuming %s; fetching all of it"), self.url)
+				self._discard_partial()
+			stream = self.stream
+		else:
+			conn.close()
+			raise HTTPError(_("HTTP Error %(code)d: %(reason)s") % {'code': code, 'reason': reason})
+
+		if length == 'chunked':
+			body = self._read_chunked(conn, stream)
+		else:
+			body = self._read_body(conn, stream, length)
+		for blocker in body:
+			yield blocker
+
+		if not keep_alive:
+			conn.close()
+
+	def _discard_partial(self):
+		self.stream.seek(0)
+		self.stream.truncate()
+		self.offset = 0
+
+	def _read_body(self, conn, stream, length):
+		"""Copy length bytes (or everything until EOF if None) to stream (or discard if None)."""
+		while length != 0:
+			if not conn.buffer:
+				if conn.eof:
+					if length is None:
+						return
+					raise IncompleteResponse(_("Connection closed with %d bytes still to come") % length)
+				for blocker in self._wait(conn.receive()):
+					yield blocker
+				continue
+			if length is None:
+				data = conn.buffer
+			else:
+				data = conn.buffer[:length]
+				length -= len(data)
+			conn.buffer = conn.buffer[len(data):]
+			if stream is not None:
+				stream.write(data)
+				stream.flush()
+
+	def _read_line(self, conn):
+		"""Wait until conn.buffer contains a complete line."""
+		while '\n' not in conn.buffer:
+			if conn.eof:
+				raise IncompleteResponse(_("Connection closed in the middle of a chunked response"))
+			if len(conn.buffer) > _max_header_size:
+				raise HTTPError(_("Bad chunked response"))
+			for blocker in self._wait(conn.receive()):
+				yield blocker
+
+	def _pop_line(self, conn):
+		line, conn.buffer = conn.buffer.split('\n', 1)
+		return line.strip()
+
+	def _read_chunked(self, conn, stream):
+		"""Copy a body using chunked transfer-encoding to stream."""
+		while True:
+			for blocker in self._read_line(conn):
+				yield blocker
+			line = self._pop_line(conn)
+			try:
+				size = int(line.split(';', 1)[0], 16)
+			except ValueError:
+				raise HTTPError(_("Bad chunk size: %s") % repr(line[:100]))
+			if size == 0:
+				break
+			for blocker in self._read_body(conn, stream, size):
+				yield blocker
+			for blocker in self._read_line(conn):
+				yield blocker
+			self._pop_line(conn)
+
+		# Skip trailers
+		while True:
+			for blocker in self._read_line(conn):
+				yield blocker
+			if not self._pop_line(conn):
+				break
@@ -7,10 +7,10 @@ Integration with native distribution package managers.
 # See the README file for details, or visit http://0install.net.
 
 from zeroinstall import _
-import os, platform, re, subprocess, sys
+import os, platform, re, subprocess, sys, mmap, zlib
 from logging import warn, info
 from zeroinstall.injector import namespaces, model, arch
-from zeroinstall.support import basedir
+from zeroinstall.support import basedir, tasks
 
 _dotted_ints = '[0-9]+(?:\.[0-9]+)*'
 
@@ -20,9 +20,39 @@ _zeroinstall_regexp = '(?:%s)(?:-(?:pre|rc|post|)(?:%s))*' % (_dotted_ints, _dot
 # This matches the interesting bits of distribution version numbers
 _version_regexp = '(%s)(-r%s)?' % (_zeroinstall_regexp, _dotted_ints)
 
+def _bisect_lines(data, lo, hi, name):
+	"""Find the line "name\tdetails\n" in data[lo:hi], which must be a sequence of such
+	lines sorted by name.
+	@return: the details, or None if there is no such line"""
+	# lo is always the start of a line
+	while lo < hi:
+		mid = (lo + hi) // 2
+		line_start = data.rfind('\n', lo, mid) + 1
+		if line_start == 0:
+			line_start = lo		# mid is on the first line
+		line_end = data.find('\n', line_start)
+		tab = data.find('\t', line_start, line_end)
+		key = data[line_start:tab]
+		if key == name:
+			return data[tab + 1:line_end]
+		elif key < name:
+			lo = line_end + 1
+		else:
+			hi = line_start
+	return None
+
 # We try to do updates atomically without locking, but we don't worry too much about
 # duplicate entries or being a little out of sync with the on-disk copy.
 class Cache(object):
+	"""A cache file has a header, a table of "key\tvalue" lines sorted by key, and then
+	a log of the entries added since the table was written. The table is memory-mapped
+	and searched by bisection, so only the log is read when the cache is loaded. Each log
+	record has a checksum, so a record that was only partly written is ignored. Once the
+	log has max_log records, it is merged into a new table.
+	Keys may not contain tabs or newlines, and values may not contain newlines."""
+
+	max_log = 256		# Compact the cache when the log has this many records
+
 	def __init__(self, cache_leaf, source, format):
 		"""Maintain a cache file (e.g. ~/.cache/0install.net/injector/$name).
 		If the size or mtime of $source has changed, or the cache
@@ -33,6 +63,10 @@ class Cache(object):
 		self.cache_dir = basedir.save_cache_path(namespaces.config_site,
 							 namespaces.config_prog)
 		self.cached_for = {}		# Attributes of source when cache was created
+		self._data = None		# The mapped cache file
+		self._table_start = self._table_end = 0
+		self._log = {}			# Entries in the log (the latest for each key)
+		self._log_records = 0		# Number of records in the log (including duplicates)
 		try:
 			self._load_cache()
 		except Exception as ex:
@@ -48,38 +82,67 @@ class Cache(object):
 		except Exception as ex:
 			warn("Failed to stat %s: %s", self.source, ex)
 			mtime = size = 0
-		self.cache = {}
+		self._write_table(mtime, size, {})
+
+	# Replace the cache file with one containing a table of these entries (and no log).
+	def _write_table(self, mtime, size, entries):
+		table = ''.join(['%s\t%s\n' % (key, entries[key]) for key in sorted(entries)])
+		data = "version=2\nmtime=%d\nsize=%d\nformat=%d\ntable=%d\n\n" % (mtime, size, self.format, len(table)) + table
 		import tempfile
 		tmp, tmp_name = tempfile.mkstemp(dir = self.cache_dir)
-		data = "mtime=%d\nsize=%d\nformat=%d\n\n" % (mtime, size, self.format)
 		while data:
 			wrote = os.write(tmp, data)
 			data = data[wrote:]
+		os.close(tmp)
 		os.rename(tmp_name, os.path.join(self.cache_dir, self.cache_leaf))
 
 		self._load_cache()
 
-	# Populate self.cache from our saved cache file.
+	# Map the cache file and read its header and log.
 	# Throws an exception if the cache doesn't exist or has the wrong format.
 	def _load_cache(self):
-		self.cache = cache = {}
-		stream = file(os.path.join(self.cache_dir, self.cache_leaf))
+		if self._data is not None:
+			self._data.close()
+			self._data = None
+		self._log = log = {}
+		self._log_records = 0
+		fd = os.open(os.path.join(self.cache_dir, self.cache_leaf), os.O_RDONLY)
 		try:
-			for line in stream:
-				line = line.strip()
-				if not line:
-					break
-				key, value = line.split('=', 1)
-				if key in ('mtime', 'size', 'format'):
-					self.cached_for[key] = int(value)
-
-			self._check_valid()
-
-			for line in stream:
-				key, value = line.split('=', 1)
-				cache[key] = value[:-1]
+			data = mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
 		finally:
-			stream.close()
+			os.close(fd)
+		end = data.find('\n\n')
+		if end == -1:
+			data.close()
+			raise Exception("Missing end of header")
+		header = {}
+		for line in data[:end].split('\n'):
+			key, value = line.split('=', 1)
+			header[key] = value
+		if header.get('version', None) != '2':
+			data.close()
+			raise Exception("Old cache format")
+		self.cached_for = {}
+		for key in ('mtime', 'size', 'format'):
+			if key in header:
+				self.cached_for[key] = int(header[key])
+		self._data = data
+		self._table_start = end + 2
+		self._table_end = self._table_start + int(header['table'])
+
+		self._check_valid()
+
+		for line in data[self._table_end:].split('\n')[:-1]:	# (ignore any incomplete last line)
+			self._log_records += 1
+			try:
+				checksum, record = line.split('\t', 1)
+				if int(checksum, 16) != zlib.crc32(record) & 0xffffffff:
+					raise Exception("Bad checksum")
+				key, value = record.split('\t', 1)
+			except Exception as ex:
+				info(_("Ignoring corrupted record in cache %(cache)s: %(exception)s"), {'cache': self.cache_leaf, 'exception': ex})
+				continue
+			log[key] = value
 
 	# Check the source file hasn't changed since we created the cache
 	def _check_valid(self):
@@ -99,19 +162,152 @@ class Cache(object):
 			self.flush()
 			return None
 		else:
-			return self.cache.get(key, None)
+			if key in self._log or self._data is None:
+				return self._log.get(key, None)
+			return _bisect_lines(self._data, self._table_start, self._table_end, key)
 
 	def put(self, key, value):
 		cache_path = os.path.join(self.cache_dir, self.cache_leaf)
-		self.cache[key] = value
+		self._log[key] = value
+		record = '%s\t%s' % (key, value)
+		record = '%08x\t%s\n' % (zlib.crc32(record) & 0xffffffff, record)
 		try:
-			stream = file(cache_path, 'a')
+			fd = os.open(cache_path, os.O_RDWR | os.O_APPEND)
 			try:
-				stream.write('%s=%s\n' % (key, value))
+				# If an earlier write was cut short, start a new line
+				os.lseek(fd, -1, 2)
+				if os.read(fd, 1) != '\n':
+					record = '\n' + record
+				while record:
+					wrote = os.write(fd, record)
+					record = record[wrote:]
 			finally:
-				stream.close()
+				os.close(fd)
 		except Exception as ex:
 			warn("Failed to write to cache %s: %s=%s: %s", cache_path, key, value, ex)
+			return
+
+		self._log_records += 1
+		if self._log_records >= self.max_log:
+			try:
+				self._compact()
+			except Exception as ex:
+				warn(_("Failed to compact cache %(cache)s: %(exception)s"), {'cache': cache_path, 'exception': ex})
+
+	def _compact(self):
+		"""Merge the log into the table."""
+		self._load_cache()		# Pick up entries added by other processes
+		entries = {}
+		for line in self._data[self._table_start:self._table_end].split('\n')[:-1]:
+			key, value = line.split('\t', 1)
+			entries[key] = value
+		entries.update(self._log)
+		self._write_table(self.cached_for['mtime'], self.cached_for['size'], entries)
+
+class PackageIndex(object):
+	"""A sorted file (e.g. ~/.cache/0install.net/injector/$name) with a line of
+	information about each package in a package database, built in one pass over
+	the database. If the size or mtime of $source has changed, or the index format
+	version is different, it is built again. Lookups bisect the memory-mapped file,
+	so it is never loaded or parsed as a whole.
+	@since: 1.1"""
+
+	def __init__(self, cache_leaf, source, format, generate):
+		"""@param generate: reads the database, returning each package name and its information
+		(the name may not contain a tab and neither may contain a newline; only the first entry
+		for each name is used)
+		@type generate: () -> iterable((str, str))"""
+		self.cache_leaf = cache_leaf
+		self.source = source
+		self.format = format
+		self.generate = generate
+		self.cache_dir = basedir.save_cache_path(namespaces.config_site,
+							 namespaces.config_prog)
+		self.cached_for = {}		# Attributes of source when index was created
+		self._data = None		# The mapped index file
+		self._start = 0			# Offset of the first entry in _data
+		try:
+			self._load_index()
+		except Exception as ex:
+			info(_("Failed to load index (%s). Regenerating..."), ex)
+			self.regenerate()
+
+	def regenerate(self):
+		"""Build the index again from the source."""
+		try:
+			info = os.stat(self.source)
+			mtime = int(info.st_mtime)
+			size = info.st_size
+		except Exception as ex:
+			warn("Failed to stat %s: %s", self.source, ex)
+			mtime = size = 0
+		entries = {}
+		for name, details in self.generate():
+			entries.setdefault(name, details)
+		data = "mtime=%d\nsize=%d\nformat=%d\n\n" % (mtime, size, self.format) + \
+			''.join(['%s\t%s\n' % (name, entries[name]) for name in sorted(entries)])
+		import tempfile
+		tmp, tmp_name = tempfile.mkstemp(dir = self.cache_dir)
+		while data:
+			wrote = os.write(tmp, data)
+			data = data[wrote:]
+		os.close(tmp)
+		os.rename(tmp_name, os.path.join(self.cache_dir, self.cache_leaf))
+
+		self._load_index()
+
+	# Map the index file into memory and read its header.
+	# Throws an exception if the index doesn't exist or is out-of-date.
+	def _load_index(self):
+		if self._data is not None:
+			self._data.close()
+			self._data = None
+		fd = os.open(os.path.join(self.cache_dir, self.cache_leaf), os.O_RDONLY)
+		try:
+			data = mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
+		finally:
+			os.close(fd)
+		end = data.find('\n\n')
+		if end == -1:
+			data.close()
+			raise Exception("Missing end of header")
+		self.cached_for = {}
+		for line in data[:end].split('\n'):
+			key, value = line.split('=', 1)
+			if key in ('mtime', 'size', 'format'):
+				self.cached_for[key] = int(value)
+		self._data = data
+		self._start = end + 2
+
+		self._check_valid()
+
+	# Check the source hasn't changed since we created the index
+	def _check_valid(self):
+		info = os.stat(self.source)
+		if self.cached_for['mtime'] != int(info.st_mtime):
+			raise Exception("Modification time of %s has changed" % self.source)
+		if self.cached_for['size'] != info.st_size:
+			raise Exception("Size of %s has changed" % self.source)
+		if self.cached_for.get('format', None) != self.format:
+			raise Exception("Format of index has changed")
+
+	def get(self, name):
+		"""Get the information about a package.
+		@return: the information, or None if the database doesn't have this package
+		@rtype: str"""
+		try:
+			self._check_valid()
+		except Exception as ex:
+			info(_("Index needs to be rebuilt: %s"), ex)
+			try:
+				self.regenerate()
+			except Exception as ex:
+				warn(_("Failed to rebuild index %(index)s: %(exception)s"), {'index': self.cache_leaf, 'exception': ex})
+				if self._data is None:
+					return None
+
+		# Each entry is a line "name\tdetails\n", sorted by name.
+		return _bisect_lines(self._data, self._start, len(self._data), name)
 
 def try_cleanup_distro_version(version):
 	"""Try to turn a distribution version string into one readable by Zero Install.
@@ -314,6 +510,48 @@ class CachedDistribution(Distribution):
 			os.unlink(tmpname)
 			raise
 
+class IndexedDistribution(Distribution):
+	"""For distributions where finding the installed versions of a package means scanning
+	the package database (e.g. a directory with an entry for each installed package), we
+	scan it once to build a L{PackageIndex}, which is rebuilt when the mtime or size of
+	the database changes.
+	@since: 1.1"""
+
+	index_leaf = None		# Name of the index file in the cache directory
+
+	def __init__(self, db):
+		"""@param db: rebuild the index when the timestamp or size of this file or directory changes"""
+		try:
+			self._index = PackageIndex(self.index_leaf, db, 1, self._generate_index)
+		except Exception as ex:
+			warn(_("Failed to index distribution database %(db)s: %(exception)s"), {'db': db, 'exception': ex})
+			self._index = None
+
+	def generate_index(self):
+		"""Read the package database.
+		@return: the name, cleaned-up version and Zero Install machine type of each installed package
+		@rtype: iterable((str, str, str))"""
+		raise NotImplementedError("Abstract")
+
+	def _generate_index(self):
+		versions = {}
+		for package, version, zi_arch in self.generate_index():
+			versions.setdefault(package, []).extend([version, zi_arch])
+		for package, versionarchs in versions.iteritems():
+			yield package, '\t'.join(versionarchs)
+
+	def get_installed_versions(self, package):
+		"""Look up a package in the index.
+		@return: the version and machine type of each installed version
+		@rtype: [(str, str)]"""
+		if self._index is None:
+			return []
+		details = self._index.get(package)
+		if details is None:
+			return []
+		fields = details.split('\t')
+		return zip(fields[::2], fields[1::2])
+
 # Maps machine type names used in packages to their Zero Install versions
 _canonical_machine = {
 	'all' : '*',
@@ -337,14 +575,55 @@ def canonical_machine(package_machine):
 		return host_machine
 	return machine
 
+def read_dpkg_status(status_file):
+	"""Read a dpkg status file (e.g. /var/lib/dpkg/status) in a single pass.
+	Only the fields we need are looked at.
+	@return: the version and (dpkg) architecture of each installed package
+	@rtype: generator((str, str, str))
+	@since: 1.1"""
+	stream = file(status_file)
+	try:
+		package = version = debarch = None
+		installed = False
+		for line in stream:
+			if line[0] in ' \t':
+				continue		# Continuation of a multi-line field
+			if line == '\n':
+				if installed and package and version:
+					yield package, version, debarch or ''
+				package = version = debarch = None
+				installed = False
+			elif line.startswith('Package:'):
+				package = line[8:].strip()
+			elif line.startswith('Status:'):
+				installed = line.rstrip().endswith(' installed')
+			elif line.startswith('Version:'):
+				version = line[8:].strip()
+			elif line.startswith('Architecture:'):
+				debarch = line[13:].strip()
+		if installed and package and version:
+			yield package, version, debarch or ''
+	finally:
+		stream.close()
+
 class DebianDistribution(Distribution):
 	"""A dpkg-based distribution."""
 
 	cache_leaf = 'dpkg-status.cache'
 
 	def __init__(self, dpkg_status, pkgcache):
-		self.dpkg_cache = Cache('dpkg-status.cache', dpkg_status, 2)
 		self.apt_cache = {}
+		self.dpkg_cache = None
+
+		def generate():
+			for package, version, debarch in read_dpkg_status(dpkg_status):
+				yield package, version + '\t' + debarch
+		try:
+			self.dpkg_index = PackageIndex('dpkg-status.index', dpkg_status, 1, generate)
+		except Exception as ex:
+			warn(_("Failed to read %(file)s (%(exception)s); will use dpkg-query instead"), {'file': dpkg_status, 'exception': ex})
+			self.dpkg_index = None
+			self.dpkg_cache = Cache('dpkg-status.cache', dpkg_status, 2)
 
 	def _query_installed_package(self, package):
 		null = os.open('/dev/null', os.O_WRONLY)
@@ -357,14 +636,21 @@ class DebianDistribution(Distribution):
 			if not line: continue
 			version, debarch, status = line.split('\t', 2)
 			if not status.endswith(' installed'): continue
-			clean_version = try_cleanup_distro_version(version)
-			if clean_version:
-				return '%s\t%s' % (clean_version, canonical_machine(debarch.strip()))
-			else:
-				warn(_("Can't parse distribution version '%(version)s' for package '%(package)s'"), {'version': version, 'package': package})
+			installed_info = self._format_installed_package(package, version, debarch)
+			if installed_info:
+				return installed_info
 
 		return '-'
 
+	def _format_installed_package(self, package, version, debarch):
+		"""@return: the cleaned-up version and machine, or None if we can't parse the version"""
+		clean_version = try_cleanup_distro_version(version)
+		if clean_version:
+			return '%s\t%s' % (clean_version, canonical_machine(debarch.strip()))
+		else:
+			warn(_("Can't parse distribution version '%(version)s' for package '%(package)s'"), {'version': version, 'package': package})
+			return None
+
 	def get_package_info(self, package, factory):
 		# Add any already-installed package...
 		installed_cached_info = self._get_dpkg_info(package)
@@ -385,7 +671,7 @@ class DebianDistribution(Distribution):
 
 		# From apt-cache...
 		cached = self.apt_cache.get(package, None)
-		if cached:
+		if cached and not isinstance(cached, tasks.Blocker):
 			candidate_version = cached['version']
 			candidate_arch = cached['arch']
 			if candidate_version and candidate_version != installed_version:
@@ -402,6 +688,13 @@ class DebianDistribution(Distribution):
 		return int(disto_name == 'Debian')
 
 	def _get_dpkg_info(self, package):
+		if self.dpkg_index is not None:
+			entry = self.dpkg_index.get(package)
+			if entry is None:
+				return '-'
+			version, debarch = entry.split('\t')
+			return self._format_installed_package(package, version, debarch) or '-'
+
 		installed_cached_info = self.dpkg_cache.get(package)
 		if installed_cached_info == None:
 			installed_cached_info = self._query_installed_package(package)
@@ -416,33 +709,68 @@ class DebianDistribution(Distribution):
 			return self.packagekit.fetch_candidates(package_names)
 
 		# No PackageKit. Use apt-cache directly.
-		for package in package_names:
-			# Check to see whether we could get a newer version using apt-get
+		return self._fetch_apt_candidates(package_names)
+
+	@tasks.async
+	def _fetch_apt_candidates(self, package_names):
+		"""Check to see whether we could get newer versions using apt-get.
+		All the packages we don't know about yet are looked up with a single
+		apt-cache command. While it is running, their apt_cache entries are a
+		blocker for the lookup."""
+		known = [self.apt_cache[p] for p in package_names if p in self.apt_cache]
+		in_progress = list(set([b for b in known if isinstance(b, tasks.Blocker)]))
+
+		# Filter out the ones we've already fetched
+		package_names = [p for p in package_names if p not in self.apt_cache]
+
+		if package_names:
+			blocker = tasks.Blocker('apt-cache show %s' % ' '.join(package_names))
+			for package in package_names:
+				self.apt_cache[package] = blocker
 			try:
 				null = os.open('/dev/null', os.O_WRONLY)
-				child = subprocess.Popen(['apt-cache', 'show', '--no-all-versions', '--', package], stdout = subprocess.PIPE, stderr = null)
-				os.close(null)
-
-				arch = version = size = None
-				for line in child.stdout:
-					line = line.strip()
-					if line.startswith('Version: '):
-						version = line[9:]
-						version = try_cleanup_distro_version(version)
-					elif line.startswith('Architecture: '):
-						arch = canonical_machine(line[14:].strip())
-					elif line.startswith('Size: '):
-						size = int(line[6:].strip())
-				if version and arch:
-					cached = {'version': version, 'arch': arch, 'size': size}
-				else:
-					cached = None
+				try:
+					child = subprocess.Popen(['apt-cache', 'show', '--no-all-versions', '--'] + package_names, stdout = subprocess.PIPE, stderr = null)
+				finally:
+					os.close(null)
+
+				output = []
+				while True:
+					yield tasks.InputBlocker(child.stdout, 'apt-cache output')
+					data = os.read(child.stdout.fileno(), 4096)
+					if not data: break
+					output.append(data)
+				child.stdout.close()
 				child.wait()
+
+				# Missing packages are reported on stderr; we get a record for each one that exists.
+				# (multi-arch support? can there be multiple candidates?)
+				for record in ''.join(output).split('\n\n'):
+					package = arch = version = size = None
+					for line in record.split('\n'):
+						line = line.strip()
+						if line.startswith('Package: '):
+							package = line[9:].strip()
+						elif line.startswith('Version: '):
+							version = line[9:]
+							version = try_cleanup_distro_version(version)
+						elif line.startswith('Architecture: '):
+							arch = canonical_machine(line[14:].strip())
+						elif line.startswith('Size: '):
+							size = int(line[6:].strip())
+					if package in package_names and version and arch:
+						self.apt_cache[package] = {'version': version, 'arch': arch, 'size': size}
 			except Exception as ex:
-				warn("'apt-cache show %s' failed: %s", package, ex)
-				cached = None
-			# (multi-arch support? can there be multiple candidates?)
-			self.apt_cache[package] = cached
+				warn("'apt-cache show %s' failed: %s", ' '.join(package_names), ex)
+			finally:
+				for package in package_names:
+					if self.apt_cache[package] is blocker:
+						self.apt_cache[package] = None
+				blocker.trigger()
+
+		while in_progress:
+			yield in_progress
+			in_progress = [b for b in in_progress if not b.happened]
 
 class RPMDistribution(CachedDistribution):
 	"""An RPM-based distribution."""
@@ -481,28 +809,37 @@ class RPMDistribution(CachedDistribution):
 	def get_score(self, disto_name):
 		return int(disto_name == 'RPM')
 
-class SlackDistribution(Distribution):
+class SlackDistribution(IndexedDistribution):
 	"""A Slack-based distribution."""
 
+	index_leaf = 'slack-packages.index'
+
 	def __init__(self, packages_dir):
 		self._packages_dir = packages_dir
+		IndexedDistribution.__init__(self, packages_dir)
+
+	def generate_index(self):
+		for entry in os.listdir(self._packages_dir):
+			try:
+				name, version, arch, build = entry.rsplit('-', 3)
+			except ValueError:
+				warn(_("Can't parse Slack package entry '%s'"), entry)
+				continue
+			zi_arch = canonical_machine(arch)
+			clean_version = try_cleanup_distro_version("%s-%s" % (version, build))
+			if not clean_version:
+				warn(_("Can't parse distribution version '%(version)s' for package '%(package)s'"), {'version': version, 'package': name})
+				continue
+			yield name, clean_version, zi_arch
 
 	def get_package_info(self, package, factory):
 		# Add installed versions...
-		for entry in os.listdir(self._packages_dir):
-			name, version, arch, build = entry.rsplit('-', 3)
-			if name == package:
-				zi_arch = canonical_machine(arch)
-				clean_version = try_cleanup_distro_version("%s-%s" % (version, build))
-				if not clean_version:
-					warn(_("Can't parse distribution version '%(version)s' for package '%(package)s'"), {'version': version, 'package': name})
-					continue
-	
-				impl = factory('package:slack:%s:%s:%s' % \
-						(package, clean_version, zi_arch))
-				impl.version = model.parse_version(clean_version)
-				if zi_arch != '*':
-					impl.machine = zi_arch
+		for clean_version, zi_arch in self.get_installed_versions(package):
+			impl = factory('package:slack:%s:%s:%s' % \
+					(package, clean_version, zi_arch))
+			impl.version = model.parse_version(clean_version)
+			if zi_arch != '*':
+				impl.machine = zi_arch
 
 		# Add any uninstalled candidates found by PackageKit
 		self.packagekit.get_candidates(package, factory, 'package:slack')
@@ -510,25 +847,33 @@ class SlackDistribution(Distribution):
 	def get_score(self, disto_name):
 		return int(disto_name == 'Slack')
 
-class GentooDistribution(Distribution):
+# A Gentoo package directory is named $PN-$PV: the version is the longest suffix that
+# looks like a Gentoo version (package names may contain "-[0-9]" too).
+_gentoo_package_dir_regexp = re.compile(r'^(.+)-([0-9]+(\.[0-9]+)*[a-z]?((_alpha|_beta|_pre|_rc|_p)[0-9]*)*(-r[0-9]+)?)$')
+
+class GentooDistribution(IndexedDistribution):
+
+	index_leaf = 'gentoo-pkgdir.index'
 
 	def __init__(self, pkgdir):
 		self._pkgdir = pkgdir
+		# Portage updates the mtime of the top-level directory whenever it
+		# installs or removes a package, so we don't need to check each category.
+		IndexedDistribution.__init__(self, pkgdir)
 
-	def get_package_info(self, package, factory):
-		# Add installed versions...
+	def generate_index(self):
 		_version_start_reqexp = '-[0-9]'
 
-		if package.count('/') != 1: return
+		for category in os.listdir(self._pkgdir):
+			category_dir = os.path.join(self._pkgdir, category)
+			if not os.path.isdir(category_dir): continue
 
-		category, leafname = package.split('/')
-		category_dir = os.path.join(self._pkgdir, category)
-		match_prefix = leafname + '-'
+			for filename in os.listdir(category_dir):
+				package_match = _gentoo_package_dir_regexp.match(filename) or \
+						re.match('^(.+?)-[0-9]', filename)
+				if package_match is None: continue
+				leafname = package_match.group(1)
 
-		if not os.path.isdir(category_dir): return
-
-		for filename in os.listdir(category_dir):
-			if filename.startswith(match_prefix) and filename[len(match_prefix)].isdigit():
 				name = file(os.path.join(category_dir, filename, 'PF')).readline().strip()
 
 				match = re.search(_version_start_reqexp, name)
@@ -537,6 +882,9 @@ class GentooDistribution(Distribution):
 					continue
 				else:
 					version = try_cleanup_distro_version(name[match.start() + 1:])
+					if not version:
+						warn(_("Can't parse distribution version '%(version)s' for package '%(package)s'"), {'version': name[match.start() + 1:], 'package': name})
+						continue
 
 				if category == 'app-emulation' and name.startswith('emul-'):
 					__, __, machine, __ = name.split('-', 3)
@@ -544,10 +892,15 @@ class GentooDistribution(Distribution):
 					machine, __ = file(os.path.join(category_dir, filename, 'CHOST')).readline().split('-', 1)
 				machine = arch.canonicalize_machine(machine)
 
-				impl = factory('package:gentoo:%s:%s:%s' % \
-						(package, version, machine))
-				impl.version = model.parse_version(version)
-				impl.machine = machine
+				yield category + '/' + leafname, version, machine
+
+	def get_package_info(self, package, factory):
+		# Add installed versions...
+		for version, machine in self.get_installed_versions(package):
+			impl = factory('package:gentoo:%s:%s:%s' % \
+					(package, version, machine))
+			impl.version = model.parse_version(version)
+			impl.machine = machine
 
 		# Add any uninstalled candidates found by PackageKit
 		self.packagekit.get_candidates(package, factory, 'package:gentoo')
@@ -555,12 +908,15 @@ class GentooDistribution(Distribution):
 	def get_score(self, disto_name):
 		return int(disto_name == 'Gentoo')
 
-class PortsDistribution(Distribution):
+class PortsDistribution(IndexedDistribution):
+
+	index_leaf = 'ports-pkgdir.index'
 
 	def __init__(self, pkgdir):
 		self._pkgdir = pkgdir
+		IndexedDistribution.__init__(self, pkgdir)
 
-	def get_package_info(self, package, factory):
+	def generate_index(self):
 		_name_version_regexp = '^(.+)-([^-]+)$'
 
 		nameversion = re.compile(_name_version_regexp)
@@ -576,12 +932,15 @@ class PortsDistribution(Distribution):
 				continue
 			else:
 				name = match.group(1)
-				if name != package:
-					continue
 				version = try_cleanup_distro_version(match.group(2))
+				if not version:
+					warn(_("Can't parse distribution version '%(version)s' for package '%(package)s'"), {'version': match.group(2), 'package': name})
+					continue
 
-			machine = host_machine
+			yield name, version, host_machine
 
+	def get_package_info(self, package, factory):
+		for version, machine in self.get_installed_versions(package):
 			impl = factory('package:ports:%s:%s:%s' % \
 						(package, version, machine))
 			impl.version = model.parse_version(version)
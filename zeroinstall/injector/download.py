@@ -9,13 +9,15 @@ This is the low-level interface for downloading interfaces, implementations, ico
 # Copyright (C) 2009, Thomas Leonard
 # See the README file for details, or visit http://0install.net.
 
-import tempfile, os, sys, subprocess
+import tempfile, os, sys, subprocess, urlparse, hashlib, time
 
 if __name__ == '__main__':
 	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
 from zeroinstall import SafeException
-from zeroinstall.support import tasks
+from zeroinstall.support import tasks, basedir
+from zeroinstall.injector import _http
+from zeroinstall.injector.namespaces import config_site, config_prog
 from logging import info, debug
 from zeroinstall import _
 
@@ -29,6 +31,57 @@ RESULT_OK = 0
 RESULT_FAILED = 1
 RESULT_NOT_MODIFIED = 2
 
+# Data is passed to open_stream's pipe in chunks of up to this size
+_stream_chunk_size = 64 * 1024
+
+# How often (in seconds) open_stream checks for newly downloaded data
+_stream_poll_interval = 0.05
+
+# If the connection is lost part way through, resume up to this many times before giving up
+_max_resumes = 10
+
+# Partial downloads not touched for this long (in seconds) are deleted
+_max_partial_age = 30 * 24 * 60 * 60
+
+_partials_in_use = set()	# Paths of partial downloads open in this process
+
+def _open_partial(url, expected_size):
+	"""Open the file in which we keep the partial download of url, creating it if necessary.
+	We use a different file if the expected size changes, since it's probably a new version.
+	@return: (path, stream), or None if it's not available (e.g. another process is using it)"""
+	try:
+		import fcntl
+	except ImportError:
+		return None
+
+	try:
+		cache_dir = basedir.save_cache_path(config_site, config_prog, 'partial-downloads')
+		path = os.path.join(cache_dir, '%s-%d' % (hashlib.sha256(url).hexdigest(), expected_size))
+		if path in _partials_in_use:
+			return None
+
+		old = time.time() - _max_partial_age
+		for leaf in os.listdir(cache_dir):
+			other = os.path.join(cache_dir, leaf)
+			if other != path and other not in _partials_in_use and os.path.getmtime(other) < old:
+				info(_("Deleting old partial download %s"), other)
+				os.unlink(other)
+
+		stream = open(path, 'a+b')
+		try:
+			fcntl.lockf(stream.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError as ex:
+			debug(_("Partial download %(path)s is locked (%(error)s)"), {'path': path, 'error': ex})
+			stream.close()
+			return None
+		if os.fstat(stream.fileno()).st_size > expected_size:
+			stream.truncate(0)
+	except EnvironmentError as ex:
+		info(_("Can't keep partial download of %(url)s: %(error)s"), {'url': url, 'error': ex})
+		return None
+	_partials_in_use.add(path)
+	return path, stream
+
 class DownloadError(SafeException):
 	"""Download process failed."""
 	pass
@@ -38,6 +91,60 @@ class DownloadAborted(DownloadError):
 	def __init__(self, message = None):
 		SafeException.__init__(self, message or _("Download aborted at user's request"))
 
+class DownloadScheduler(object):
+	"""Limits the number of downloads in progress, both in total and from any one host.
+	Other downloads wait in a queue and start in the order they were requested as
+	slots become free. The scheduler also keeps idle connections open so that
+	later downloads from the same server can reuse them.
+	@ivar max_downloads: the maximum number of downloads to run at once
+	@type max_downloads: int
+	@ivar max_downloads_per_host: the maximum number of downloads from a single host to run at once
+	@type max_downloads_per_host: int
+	@ivar connections: idle keep-alive connections
+	@type connections: L{_http.ConnectionPool}
+	@since: 1.1"""
+
+	def __init__(self, max_downloads = 8, max_downloads_per_host = 2):
+		self.max_downloads = max_downloads
+		self.max_downloads_per_host = max_downloads_per_host
+		self.connections = _http.ConnectionPool()
+		self._waiting = []		# Slots not yet granted, oldest first
+		self._running = {}		# Host -> number of granted slots
+		self._n_running = 0
+
+	def get_slot(self, url):
+		"""Request permission to download url.
+		The returned blocker is triggered when the download may start.
+		Pass it to L{release_slot} when finished (whether or not it was ever triggered).
+		@rtype: L{tasks.Blocker}"""
+		slot = tasks.Blocker("download slot for " + url)
+		slot.host = urlparse.urlparse(url).netloc.lower()
+		self._waiting.append(slot)
+		self._start_waiting()
+		return slot
+
+	def release_slot(self, slot):
+		"""The download using this slot has finished (or been aborted while waiting)."""
+		if slot.happened:
+			self._n_running -= 1
+			self._running[slot.host] -= 1
+			if not self._running[slot.host]:
+				del self._running[slot.host]
+		else:
+			self._waiting.remove(slot)
+		self._start_waiting()
+
+	def _start_waiting(self):
+		for slot in self._waiting[:]:
+			if self._n_running >= self.max_downloads:
+				break
+			if self._running.get(slot.host, 0) >= self.max_downloads_per_host:
+				continue
+			self._waiting.remove(slot)
+			self._n_running += 1
+			self._running[slot.host] = self._running.get(slot.host, 0) + 1
+			slot.trigger()
+
 class Download(object):
 	"""A download of a single resource to a temporary file.
 	@ivar url: the URL of the resource being fetched
@@ -59,25 +166,40 @@ class Download(object):
 	@ivar aborted_by_user: whether anyone has called L{abort}
 	@type aborted_by_user: bool
 	@ivar unmodified: whether the resource was not modified since the modification_time given at construction
+	(or still has the etag given)
 	@type unmodified: bool
+	@ivar etag: entity tag of a copy we already have; the resource will not be downloaded if it still matches
+	@type etag: str | None
+	@ivar validators: the ETag and Last-Modified headers the server sent with the resource
+	(only known when we fetched it ourselves, rather than with the helper process)
+	@type validators: (str | None, str | None)
+	@ivar scheduler: decides when the download may start and provides reusable connections (set by L{handler.Handler.monitor_download})
+	@type scheduler: L{DownloadScheduler} | None
+	@ivar partial: if the download fails, the data received so far is kept in this file and the next download of the same URL
+	(with the same expected_size) resumes from there (set by L{start} if expected_size is known and the scheme is http: or https:)
+	@type partial: str | None
 	"""
 	__slots__ = ['url', 'tempfile', 'status', 'errors', 'expected_size', 'downloaded',
 		     'hint', 'child', '_final_total_size', 'aborted_by_user',
-		     'modification_time', 'unmodified']
+		     'modification_time', 'etag', 'unmodified', 'validators', 'scheduler', 'partial', '_aborted']
 
-	def __init__(self, url, hint = None, modification_time = None):
+	def __init__(self, url, hint = None, modification_time = None, etag = None):
 		"""Create a new download object.
 		@param url: the resource to download
 		@param hint: object with which this download is associated (an optional hint for the GUI)
 		@param modification_time: string with HTTP date that indicates last modification time.
 		  The resource will not be downloaded if it was not modified since that date.
+		@param etag: entity tag previously sent with the resource (see L{validators}).
+		  The resource will not be downloaded if it still has this tag.
 		@postcondition: L{status} == L{download_starting}."""
 		self.url = url
 		self.status = download_starting
 		self.hint = hint
 		self.aborted_by_user = False
 		self.modification_time = modification_time
+		self.etag = etag
 		self.unmodified = False
+		self.validators = (None, None)
 
 		self.tempfile = None		# Stream for result
 		self.errors = None
@@ -87,14 +209,28 @@ class Download(object):
 		self._final_total_size = None	# Set when download is finished
 
 		self.child = None
+		self.scheduler = None
+		self.partial = None
+		self._aborted = None
 	
 	def start(self):
 		"""Create a temporary file and begin the download.
+		If L{expected_size} is set, the data is kept in the cache of L{partial} downloads
+		instead, continuing from any earlier attempt.
+		If L{scheduler} is set, the download may wait in its queue before fetching anything.
 		@precondition: L{status} == L{download_starting}"""
 		assert self.status == download_starting
 		assert self.downloaded is None
 
-		self.tempfile = tempfile.TemporaryFile(prefix = 'injector-dl-data-')
+		opened = None
+		if self.expected_size is not None and self.modification_time is None and self.etag is None and \
+		   self.url.split(':', 1)[0] in _http.schemes:
+			opened = _open_partial(self.url, self.expected_size)
+		if opened is None:
+			self.tempfile = tempfile.TemporaryFile(prefix = 'injector-dl-data-')
+		else:
+			self.partial, self.tempfile = opened
+		self._aborted = tasks.Blocker("abort " + self.url)
 
 		task = tasks.Task(self._do_download(), "download " + self.url)
 		self.downloaded = task.finished
@@ -103,33 +239,86 @@ class Download(object):
 		"""Will trigger L{downloaded} when done (on success or failure)."""
 		self.errors = ''
 
-		# Can't use fork here, because Windows doesn't have it
-		assert self.child is None, self.child
-		my_dir = os.path.dirname(__file__)
-		child_args = [sys.executable, '-u', os.path.join(my_dir, '_download_child.py'), self.url]
-		if self.modification_time: child_args.append(self.modification_time)
-		self.child = subprocess.Popen(child_args, stderr = subprocess.PIPE, stdout = self.tempfile)
-
-		self.status = download_fetching
-
-		# Wait for child to exit, collecting error output as we go
-
-		while True:
-			yield tasks.InputBlocker(self.child.stderr, "read data from " + self.url)
-
-			data = os.read(self.child.stderr.fileno(), 100)
-			if not data:
-				break
-			self.errors += data
+		slot = None
+		try:
+			if self.scheduler is not None:
+				slot = self.scheduler.get_slot(self.url)
+				yield slot, self._aborted
+
+			self.status = download_fetching
+
+			status = RESULT_OK
+			child_url = self.url
+			if self.url.split(':', 1)[0] in _http.schemes and not self.aborted_by_user:
+				# Fetch it ourselves, reusing any open connection to the server
+				pool = self.scheduler and self.scheduler.connections
+				resumes = 0
+				while True:
+					offset = 0
+					if self.partial is not None:
+						offset = self.get_bytes_downloaded_so_far()
+						if offset == self.expected_size:
+							info(_("Already have all of %s"), self.url)
+							child_url = None
+							break
+						if offset:
+							info(_("Resuming download of %(url)s from byte %(offset)d"), {'url': self.url, 'offset': offset})
+					fetch = _http.HTTPFetch(self.url, self.tempfile, self.modification_time, pool, self._aborted, offset, self.etag)
+					fetched = tasks.Task(fetch.run(), "fetch " + self.url).finished
+					yield fetched
+					try:
+						tasks.check(fetched)
+					except (EnvironmentError, _http.HTTPError) as ex:
+						if self.partial is not None and resumes < _max_resumes and not self.aborted_by_user and \
+						   isinstance(ex, (EnvironmentError, _http.IncompleteResponse)) and \
+						   self.get_bytes_downloaded_so_far() > fetch.offset:
+							# We were getting somewhere, so try to get the rest
+							info(_("Lost connection while downloading %(url)s: %(error)s"), {'url': self.url, 'error': ex})
+							resumes += 1
+							continue
+						self.errors += "Error downloading '" + self.url + "': " + (str(ex) or str(ex.__class__.__name__))
+						status = RESULT_FAILED
+					else:
+						if fetch.not_modified:
+							status = RESULT_NOT_MODIFIED
+						else:
+							self.validators = fetch.validators
+					# (we still need the helper for redirects to ftp:)
+					child_url = fetch.redirected_to
+					break
+
+				if child_url is not None and self.partial is not None:
+					# (the helper can't resume, so it starts from the beginning)
+					self.tempfile.truncate(0)
+
+			if child_url is not None and not self.aborted_by_user:
+				# Can't use fork here, because Windows doesn't have it
+				assert self.child is None, self.child
+				my_dir = os.path.dirname(__file__)
+				child_args = [sys.executable, '-u', os.path.join(my_dir, '_download_child.py'), child_url]
+				if self.modification_time: child_args.append(self.modification_time)
+				self.child = subprocess.Popen(child_args, stderr = subprocess.PIPE, stdout = self.tempfile)
+
+				# Wait for child to exit, collecting error output as we go
+
+				while True:
+					yield tasks.InputBlocker(self.child.stderr, "read data from " + child_url)
+
+					data = os.read(self.child.stderr.fileno(), 100)
+					if not data:
+						break
+					self.errors += data
+
+				status = self.child.wait()
+				self.child = None
+		finally:
+			if slot is not None:
+				self.scheduler.release_slot(slot)
 
 		# Download is complete...
 
 		assert self.status is download_fetching
 		assert self.tempfile is not None
-		assert self.child is not None
-
-		status = self.child.wait()
-		self.child = None
 
 		errors = self.errors
 		self.errors = None
@@ -152,6 +341,18 @@ class Download(object):
 		stream = self.tempfile
 		self.tempfile = None
 
+		if self.partial is not None:
+			_partials_in_use.discard(self.partial)
+			if (self.aborted_by_user or errors) and self._final_total_size:
+				info(_("Keeping partial download of %(url)s (%(size)d bytes) for next time"), {'url': self.url, 'size': self._final_total_size})
+			else:
+				# Either we've got it all, or it's not worth keeping
+				try:
+					os.unlink(self.partial)
+				except OSError as ex:
+					info(_("Failed to delete partial download: %s"), ex)
+			self.partial = None
+
 		try:
 			if self.aborted_by_user:
 				raise DownloadAborted(errors)
@@ -178,14 +379,84 @@ class Download(object):
 	def abort(self):
 		"""Signal the current download to stop.
 		@postcondition: L{aborted_by_user}"""
-		if self.child is not None:
-			info(_("Killing download process %s"), self.child.pid)
-			import signal
-			os.kill(self.child.pid, signal.SIGTERM)
+		if self.downloaded is not None and not self.downloaded.happened:
+			info(_("Aborting download of %s"), self.url)
 			self.aborted_by_user = True
+			self._aborted.trigger()
+			if self.child is not None:
+				info(_("Killing download process %s"), self.child.pid)
+				import signal
+				os.kill(self.child.pid, signal.SIGTERM)
 		else:
 			self.status = download_failed
 
+	def open_stream(self, skip = 0):
+		"""Get a pipe which receives the data as it is downloaded, so that it can be processed
+		while the download is still in progress. The data is still saved to L{tempfile}
+		as usual. The pipe is closed when the download ends, whether it succeeded or not,
+		so check L{downloaded} before trusting what was read. Data beyond L{expected_size}
+		is not sent. If the reader closes the pipe early, we just stop sending.
+		@param skip: the number of bytes at the start not to send
+		@type skip: int
+		@return: the read end of the pipe, or None if this isn't supported on this platform
+		@rtype: file | None
+		@precondition: L{status} is L{download_starting} or L{download_fetching}
+		@since: 1.1"""
+		assert self.tempfile is not None
+		try:
+			import fcntl
+		except ImportError:
+			return None
+		# We read the file while it's still being written. Make sure the writer (or the
+		# helper process) always appends, even when we have moved the shared file offset.
+		fd = self.tempfile.fileno()
+		fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_APPEND)
+
+		r, w = os.pipe()
+		for end in (r, w):
+			# (child processes mustn't keep the pipe open)
+			fcntl.fcntl(end, fcntl.F_SETFD, fcntl.fcntl(end, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+		fcntl.fcntl(w, fcntl.F_SETFL, fcntl.fcntl(w, fcntl.F_GETFL) | os.O_NONBLOCK)
+		tasks.Task(self._copy_to_pipe(self.tempfile, w, skip), "stream " + self.url)
+		return os.fdopen(r, 'rb')
+
+	def _copy_to_pipe(self, stream, pipe, pos):
+		import errno
+		fd = stream.fileno()
+		data = ''
+		try:
+			while True:
+				if not data:
+					if self.downloaded.happened and self.status != download_complete:
+						break
+					limit = _stream_chunk_size
+					if self.expected_size is not None:
+						limit = min(limit, self.expected_size - pos)
+						if limit <= 0:
+							break
+					os.lseek(fd, pos, 0)
+					data = os.read(fd, limit)
+					pos += len(data)
+					if not data:
+						if self.downloaded.happened:
+							break
+						# Wait for more data
+						yield self.downloaded, tasks.TimeoutBlocker(_stream_poll_interval, "poll " + self.url)
+						continue
+
+				yield tasks.OutputBlocker(pipe, "stream " + self.url)
+				try:
+					sent = os.write(pipe, data)
+				except OSError as ex:
+					if ex.errno == errno.EAGAIN:
+						continue
+					if ex.errno == errno.EPIPE:
+						break		# Reader has stopped
+					raise
+				data = data[sent:]
+		finally:
+			os.close(pipe)
+
 	def get_current_fraction(self):
 		"""Returns the current fraction of this download that has been fetched (from 0 to 1),
 		or None if the total size isn't known.
@@ -16,6 +16,33 @@ from zeroinstall.injector import arch, model
 from zeroinstall.injector.model import network_offline
 from zeroinstall.support import tasks
 
+def _referenced_feeds(feed, archs):
+	"""List the feeds which feed's implementations (for any of archs) depend on,
+	and any extra feeds it imports. These are the feeds the solver is likely to
+	need next.
+	@rtype: generator(str)"""
+	def usable(os, machine):
+		for a in archs:
+			if os in a.os_ranks and (machine is None or machine in a.machine_ranks):
+				return True
+		return False
+	uses = set()
+	for a in archs:
+		uses.update(a.use)
+
+	for f in feed.feeds:
+		if usable(f.os, f.machine):
+			yield f.uri
+	for impl in feed.implementations.values():
+		if not usable(impl.os, impl.machine):
+			continue
+		deps = list(impl.requires)
+		for command in impl.commands.values():
+			deps += command.requires
+		for dep in deps:
+			if dep.metadata.get("use", None) in uses:
+				yield dep.interface
+
 class Driver(object):
 	"""Chooses a set of implementations based on a policy.
 	Typical use:
@@ -79,16 +106,24 @@ class Driver(object):
 	def solve_with_downloads(self, force = False, update_local = False):
 		"""Run the solver, then download any feeds that are missing or
 		that need to be updated. Each time a new feed is imported into
-		the cache, the solver is run again, possibly adding new downloads.
+		the cache, the feeds it refers to are fetched too (if we don't have
+		them yet), without waiting for the solver. The solver is run again when
+		a feed it asked for arrives, or when any feed arrives while it can't
+		find a solution, possibly adding new downloads. We stop once the solver
+		is ready and none of the feeds it asked for are still downloading; any
+		prefetches it didn't need are left to finish in the background.
 		@param force: whether to download even if we're already ready to run.
 		@param update_local: fetch PackageKit feeds even if we're ready to run."""
 
 		downloads_finished = set()		# Successful or otherwise
 		downloads_in_progress = {}		# URL -> Download
+		prefetching = set()			# URLs in downloads_in_progress the solver hasn't asked for
 
 		host_arch = self.target_arch
 		if self.requirements.source:
 			host_arch = arch.SourceArchitecture(host_arch)
+		archs = [host_arch, host_arch.child_arch]
+		iface_cache = self.config.iface_cache
 
 		# There are three cases:
 		# 1. We want to run immediately if possible. If not, download all the information we can.
@@ -113,7 +148,10 @@ class Driver(object):
 				force = True
 
 			for f in self.solver.feeds_used:
-				if f in downloads_finished or f in downloads_in_progress:
+				if f in downloads_in_progress:
+					prefetching.discard(f)		# The solver wants it now
+					continue
+				if f in downloads_finished:
 					continue
 				if os.path.isabs(f):
 					if force:
@@ -134,23 +172,52 @@ class Driver(object):
 					info(_("Can't choose versions and in off-line mode, so aborting"))
 				break
 
-			# Wait for at least one download to finish
-			blockers = downloads_in_progress.values()
-			yield blockers
-			tasks.check(blockers, self.config.handler.report_error)
-
-			for f in downloads_in_progress.keys():
-				if f in downloads_in_progress and downloads_in_progress[f].happened:
-					del downloads_in_progress[f]
-					downloads_finished.add(f)
-
-					# Need to refetch any "distribution" feed that
-					# depends on this one
-					distro_feed_url = 'distribution:' + f
-					if distro_feed_url in downloads_finished:
-						downloads_finished.remove(distro_feed_url)
-					if distro_feed_url in downloads_in_progress:
-						del downloads_in_progress[distro_feed_url]
+			if self.solver.ready and not [f for f in downloads_in_progress if f not in prefetching]:
+				break
+
+			# Wait until a download the solver asked for has finished (or any
+			# download, if it can't find a solution yet) before solving again.
+			need_solve = False
+			while not need_solve:
+				blockers = downloads_in_progress.values()
+				yield blockers
+				tasks.check(blockers, self.config.handler.report_error)
+
+				for f in downloads_in_progress.keys():
+					if f in downloads_in_progress and downloads_in_progress[f].happened:
+						del downloads_in_progress[f]
+						downloads_finished.add(f)
+						if f not in prefetching or not self.solver.ready:
+							need_solve = True
+						prefetching.discard(f)
+
+						# Need to refetch any "distribution" feed that
+						# depends on this one
+						distro_feed_url = 'distribution:' + f
+						if distro_feed_url in downloads_finished:
+							downloads_finished.remove(distro_feed_url)
+						if distro_feed_url in downloads_in_progress:
+							del downloads_in_progress[distro_feed_url]
+							prefetching.discard(distro_feed_url)
+
+						if f.startswith('distribution:') or os.path.isabs(f) or \
+						   self.config.network_use == network_offline:
+							continue
+
+						# Start fetching anything new it depends on now, rather than
+						# waiting for the solver to ask for it
+						feed = iface_cache.get_feed(f)
+						if feed is None:
+							continue	# (download failed)
+						for uri in _referenced_feeds(feed, archs):
+							if uri in downloads_finished or uri in downloads_in_progress or os.path.isabs(uri):
+								continue
+							iface_cache.get_interface(uri)		# (as the solver would)
+							if iface_cache.get_feed(uri) is not None:
+								continue	# The solver will ask for it if it needs it
+							debug(_("Prefetching %(feed)s (needed by %(parent)s)"), {'feed': uri, 'parent': f})
+							downloads_in_progress[uri] = self.config.fetcher.download_and_import_feed(uri, iface_cache)
+							prefetching.add(uri)
 
 	@tasks.async
 	def solve_and_download_impls(self, refresh = False, select_only = False):
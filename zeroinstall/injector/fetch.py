@@ -6,7 +6,7 @@ Downloads feeds, keys, packages and icons.
 # See the README file for details, or visit http://0install.net.
 
 from zeroinstall import _
-import os
+import os, time
 from logging import info, debug, warn
 
 from zeroinstall.support import tasks, basedir
@@ -14,7 +14,7 @@ from zeroinstall.injector.namespaces import XMLNS_IFACE, config_site
 from zeroinstall.injector.model import SafeException, escape, DistributionSource
 from zeroinstall.injector.iface_cache import PendingFeed, ReplayAttack
 from zeroinstall.injector.handler import NoTrustedKeys
-from zeroinstall.injector import download
+from zeroinstall.injector import download, writer
 
 def _escape_slashes(path):
 	return path.replace('/', '%23')
@@ -232,7 +232,18 @@ class Fetcher(object):
 		else:
 			url = feed_url
 
-		dl = self.handler.get_download(url, force = force, hint = feed_url)
+		iface_cache = self.config.iface_cache
+		validators = None
+		if not use_mirror and iface_cache.get_feed(feed_url) is not None:
+			validators = iface_cache.get_feed_validators(feed_url)
+		if validators:
+			# Only fetch it if it has changed since we got the cached copy
+			etag, last_modified = validators
+			factory = lambda url, hint: download.Download(url, hint = hint, modification_time = last_modified, etag = etag)
+		else:
+			factory = None
+
+		dl = self.handler.get_download(url, force = force, hint = feed_url, factory = factory)
 		stream = dl.tempfile
 
 		@tasks.named_async("fetch_feed " + url)
@@ -240,6 +251,14 @@ class Fetcher(object):
 			yield dl.downloaded
 			tasks.check(dl.downloaded)
 
+			if dl.unmodified:
+				# We already have this version, and checked its signatures when we got it
+				info(_("Feed %s not modified since last check"), feed_url)
+				feed = iface_cache.get_feed(feed_url)
+				feed.last_checked = int(time.time())
+				writer.save_feed(feed)
+				return
+
 			pending = PendingFeed(feed_url, stream)
 
 			if use_mirror:
@@ -260,6 +279,11 @@ class Fetcher(object):
 				if not self.config.iface_cache.update_feed_if_trusted(pending.url, pending.sigs, pending.new_xml):
 					raise NoTrustedKeys(_("No signing keys trusted; not importing"))
 
+			if use_mirror:
+				iface_cache.set_feed_validators(feed_url, None, None)
+			else:
+				iface_cache.set_feed_validators(feed_url, *dl.validators)
+
 		task = fetch_feed()
 		task.dl = dl
 		return task
@@ -11,13 +11,14 @@ This module is used to invoke GnuPG to check the digital signatures on interface
 
 from zeroinstall import _
 import subprocess
-import base64, re
+import base64, re, hashlib
 import os
 import tempfile
-from logging import info, warn
+from logging import info, debug, warn
 
 from zeroinstall.support import find_in_path, basedir
 from zeroinstall.injector.trust import trust_db
+from zeroinstall.injector.namespaces import config_site, config_prog
 from zeroinstall.injector.model import SafeException
 
 _gnupg_options = None
@@ -114,6 +115,8 @@ class ErrSig(Signature):
 			return self.status[self.KEYID]
 		return None
 
+_signature_classes = dict((cls.__name__, cls) for cls in [ValidSig, BadSig, ErrSig])
+
 class Key:
 	"""A GPG key.
 	@since: 0.27
@@ -129,6 +132,134 @@ class Key:
 	def get_short_name(self):
 		return self.name.split(' (', 1)[0].split(' <', 1)[0]
 
+# The files which determine the public keys gpg uses, relative to the GnuPG home directory
+_keyring_files = ['pubring.gpg', 'pubring.kbx', os.path.join('public-keys.d', 'pubring.db'), 'gpg.conf']
+
+def _get_keyring_state():
+	"""Get the details of the user's keyring files, which change whenever keys are added,
+	updated or removed.
+	@return: the state, or None if we can't find the keyring"""
+	home = os.environ.get('GNUPGHOME', None) or os.path.join(basedir.home, '.gnupg')
+	state = []
+	for leaf in _keyring_files:
+		try:
+			st = os.stat(os.path.join(home, leaf))
+		except OSError:
+			continue
+		state.append((leaf, st.st_ino, st.st_size, st.st_mtime))
+	if not state:
+		return None
+	return (os.path.abspath(home), tuple(state))
+
+class _VerificationCache(object):
+	"""Remembers the signatures found on data we have checked before, and the names of keys
+	we have loaded, so that we don't need to run gpg again for them. The results only depend
+	on the signed data and the keys in the keyring, so everything is thrown away when the
+	keyring changes. The cache is shared between processes using a file in the cache directory."""
+
+	_format = 1
+	_max_entries = 1000
+
+	def __init__(self):
+		self.path = None
+		self.keyring_state = None
+		self.sigs = {}		# SHA-256 of signed data -> [(class name, status, messages)]
+		self.keys = {}		# Fingerprint -> name
+
+	def _update(self):
+		"""Make sure we have the current contents for the current keyring.
+		@return: whether the cache can be used"""
+		state = _get_keyring_state()
+		if state is None:
+			return False
+		path = os.path.join(basedir.save_cache_path(config_site, config_prog), 'verified-signatures')
+		if path == self.path and state == self.keyring_state:
+			return True
+		self.path = path
+		self.keyring_state = state
+		self.sigs = {}
+		self.keys = {}
+		if os.path.exists(path):
+			import cPickle
+			try:
+				stream = file(path, 'rb')
+				try:
+					format, keyring_state, sigs, keys = cPickle.load(stream)
+				finally:
+					stream.close()
+				if format == self._format and keyring_state == state:
+					self.sigs = sigs
+					self.keys = keys
+			except Exception as ex:
+				info(_("Failed to load signature cache %(path)s: %(exception)s"), {'path': path, 'exception': ex})
+		return True
+
+	def get_sigs(self, digest):
+		"""@return: the signatures found last time, or None if we haven't seen this data with this keyring"""
+		if not self._update():
+			return None
+		details = self.sigs.get(digest, None)
+		if details is None:
+			return None
+		sigs = []
+		for class_name, status, messages in details:
+			sig = _signature_classes[class_name](status)
+			sig.messages = messages
+			sigs.append(sig)
+		return sigs
+
+	def add_sigs(self, digest, sigs, keyring_state):
+		"""Record the result of checking some data with the keyring in the given state.
+		If the keyring changed while we were checking, nothing is recorded."""
+		if not self._update() or keyring_state != self.keyring_state:
+			return
+		if len(self.sigs) >= self._max_entries:
+			self.sigs = {}
+		self.sigs[digest] = [(sig.__class__.__name__, sig.status, sig.messages) for sig in sigs]
+		self._save()
+
+	def get_keys(self, fingerprints):
+		"""@return: the cached keys, and a list of the fingerprints we don't know about"""
+		keys = {}
+		missing = []
+		if not self._update():
+			return keys, list(fingerprints)
+		for fp in fingerprints:
+			name = self.keys.get(fp, None)
+			if name is None:
+				missing.append(fp)
+			else:
+				keys[fp] = Key(fp)
+				keys[fp].name = name
+		return keys, missing
+
+	def add_keys(self, keys, keyring_state):
+		if not self._update() or keyring_state != self.keyring_state:
+			return
+		for key in keys.values():
+			self.keys[key.fingerprint] = key.name
+		self._save()
+
+	def _save(self):
+		import cPickle
+		try:
+			tmp_fd, tmp_name = tempfile.mkstemp(dir = os.path.dirname(self.path), prefix = 'tmp-')
+		except OSError as ex:
+			info(_("Can't save signature cache: %s"), ex)
+			return
+		try:
+			stream = os.fdopen(tmp_fd, 'wb')
+			try:
+				cPickle.dump((self._format, self.keyring_state, self.sigs, self.keys), stream, cPickle.HIGHEST_PROTOCOL)
+			finally:
+				stream.close()
+			os.rename(tmp_name, self.path)
+		except:
+			os.unlink(tmp_name)
+			raise
+
+_cache = _VerificationCache()
+
 def load_keys(fingerprints):
 	"""Load a set of keys at once.
 	This is much more efficient than making individual calls to L{load_key}.
@@ -137,11 +268,14 @@ def load_keys(fingerprints):
 	@since: 0.27"""
 	import codecs
 
-	keys = {}
-
 	# Otherwise GnuPG returns everything...
-	if not fingerprints: return keys
+	if not fingerprints: return {}
 
+	keyring_state = _get_keyring_state()
+	cached, fingerprints = _cache.get_keys(fingerprints)
+	if not fingerprints: return cached
+
+	keys = {}
 	for fp in fingerprints:
 		keys[fp] = Key(fp)
 
@@ -177,7 +311,10 @@ def load_keys(fingerprints):
 	finally:
 		if child.wait():
 			warn(_("gpg --list-keys failed with exit code %d") % child.returncode)
+		else:
+			_cache.add_keys(keys, keyring_state)
 
+	keys.update(cached)
 	return keys
 
 def load_key(fingerprint):
@@ -214,6 +351,8 @@ def import_key(stream):
 		warn(_("Warnings from 'gpg --import':\n%s") % error_messages)
 
 def _check_xml_stream(stream):
+	"""Start checking the signature on an XML feed.
+	@return: the result (if it's in the cache), or a L{_Verification} that will get it"""
 	xml_comment_start = '<!-- Base64 Signature'
 
 	data_to_check = stream.read()
@@ -223,13 +362,6 @@ def _check_xml_stream(stream):
 		raise SafeException(_("No signature block in XML. Maybe this file isn't signed?"))
 	last_comment += 1	# Include new-line in data
 	
-	data = tempfile.TemporaryFile()
-	data.write(data_to_check[:last_comment])
-	data.flush()
-	os.lseek(data.fileno(), 0, 0)
-
-	errors = tempfile.TemporaryFile()
-
 	sig_lines = data_to_check[last_comment:].split('\n')
 	if sig_lines[0].strip() != xml_comment_start:
 		raise SafeException(_('Bad signature block: extra data on comment line'))
@@ -246,40 +378,72 @@ def _check_xml_stream(stream):
 	except Exception as ex:
 		raise SafeException(_("Invalid base 64 encoded signature: %s") % str(ex))
 
-	sig_fd, sig_name = tempfile.mkstemp(prefix = 'injector-sig-')
-	try:
-		sig_file = os.fdopen(sig_fd, 'w')
-		sig_file.write(sig_data)
-		sig_file.close()
-
-		# Note: Should ideally close status_r in the child, but we want to support Windows too
-		child = _run_gpg([# Not all versions support this:
-				  #'--max-output', str(1024 * 1024),
-				  '--batch',
-				  # Windows GPG can only cope with "1" here
-				  '--status-fd', '1',
-				  '--verify', sig_name, '-'],
-			   stdin = data,
-			   stdout = subprocess.PIPE,
-			   stderr = errors)
+	# Have we checked exactly this data before?
+	keyring_state = _get_keyring_state()
+	digest = hashlib.sha256(data_to_check).hexdigest()
+	sigs = _cache.get_sigs(digest)
+	if sigs is not None:
+		debug(_("Using cached signatures for data with SHA-256 %s"), digest)
+		os.lseek(stream.fileno(), 0, 0)
+		stream.seek(0)
+		return (stream, sigs)
+
+	return _Verification(stream, data_to_check[:last_comment], sig_data, digest, keyring_state)
 
+class _Verification(object):
+	"""A gpg process checking a detached signature.
+	Its output goes to temporary files, so we can run several at once without reading from them."""
+
+	def __init__(self, stream, data_to_check, sig_data, digest, keyring_state):
+		self.stream = stream
+		self.digest = digest
+		self.keyring_state = keyring_state
+
+		data = tempfile.TemporaryFile()
+		data.write(data_to_check)
+		data.flush()
+		os.lseek(data.fileno(), 0, 0)
+
+		self.errors = tempfile.TemporaryFile()
+		self.status = tempfile.TemporaryFile()
+
+		sig_fd, self.sig_name = tempfile.mkstemp(prefix = 'injector-sig-')
 		try:
-			sigs = _get_sigs_from_gpg_status_stream(child.stdout, child, errors)
+			sig_file = os.fdopen(sig_fd, 'w')
+			sig_file.write(sig_data)
+			sig_file.close()
+
+			self.child = _run_gpg([# Not all versions support this:
+					  #'--max-output', str(1024 * 1024),
+					  '--batch',
+					  # Windows GPG can only cope with "1" here
+					  '--status-fd', '1',
+					  '--verify', self.sig_name, '-'],
+				   stdin = data,
+				   stdout = self.status,
+				   stderr = self.errors)
+		except:
+			os.unlink(self.sig_name)
+			raise
 		finally:
-			os.lseek(stream.fileno(), 0, 0)
-			stream.seek(0)
-	finally:
-		os.unlink(sig_name)
-	return (stream, sigs)
-
-def check_stream(stream):
-	"""Pass stream through gpg --decrypt to get the data, the error text,
-	and a list of signatures (good or bad). If stream starts with "<?xml "
-	then get the signature from a comment at the end instead (and the returned
-	data is the original stream). stream must be seekable.
-	@note: Stream returned may or may not be the one passed in. Be careful!
-	@return: (data_stream, [Signatures])"""
+			data.close()
 
+	def get_result(self):
+		"""Wait for gpg to finish and collect the signatures.
+		@return: (data_stream, [Signatures])"""
+		try:
+			self.child.wait()
+			self.status.seek(0)
+			sigs = _get_sigs_from_gpg_status_stream(self.status, self.child, self.errors)
+		finally:
+			self.status.close()
+			os.unlink(self.sig_name)
+			os.lseek(self.stream.fileno(), 0, 0)
+			self.stream.seek(0)
+		_cache.add_sigs(self.digest, sigs, self.keyring_state)
+		return (self.stream, sigs)
+
+def _start_check(stream):
 	stream.seek(0)
 
 	start = stream.read(6)
@@ -291,6 +455,57 @@ def check_stream(stream):
 	else:
 		raise SafeException(_("This is not a Zero Install feed! It should be an XML document, but it starts:\n%s") % repr(stream.read(120)))
 
+def check_stream(stream):
+	"""Pass stream through gpg --decrypt to get the data, the error text,
+	and a list of signatures (good or bad). If stream starts with "<?xml "
+	then get the signature from a comment at the end instead (and the returned
+	data is the original stream). stream must be seekable.
+	@note: Stream returned may or may not be the one passed in. Be careful!
+	@return: (data_stream, [Signatures])"""
+	result = _start_check(stream)
+	if isinstance(result, _Verification):
+		result = result.get_result()
+	return result
+
+def check_streams(streams, max_children = 4):
+	"""Check the signatures on many feeds. This gives the same results as calling
+	L{check_stream} on each one, but several copies of gpg run at once.
+	This is much faster when importing lots of feeds.
+	@param streams: the signed data (each must be seekable)
+	@type streams: [file]
+	@param max_children: the maximum number of gpg processes to run at once
+	@type max_children: int
+	@return: for each stream, either (data_stream, [Signatures]) or the exception explaining why it couldn't be checked
+	@rtype: [(file, [L{Signature}]) | L{SafeException}]
+	@since: 1.1"""
+	results = [None] * len(streams)
+	running = []		# (index, _Verification), oldest first
+
+	def finish_oldest():
+		i, verification = running.pop(0)
+		try:
+			results[i] = verification.get_result()
+		except SafeException as ex:
+			results[i] = ex
+
+	try:
+		for i, stream in enumerate(streams):
+			try:
+				result = _start_check(stream)
+			except SafeException as ex:
+				results[i] = ex
+				continue
+			if isinstance(result, _Verification):
+				running.append((i, result))
+				if len(running) >= max_children:
+					finish_oldest()
+			else:
+				results[i] = result
+	finally:
+		while running:
+			finish_oldest()
+	return results
+
 def _get_sigs_from_gpg_status_stream(status_r, child, errors):
 	"""Read messages from status_r and collect signatures from it.
 	When done, reap 'child'.
@@ -34,19 +34,26 @@ class Handler(object):
 	@type total_bytes_downloaded: int
 	@ivar dry_run: instead of starting a download, just report what we would have downloaded
 	@type dry_run: bool
+	@ivar scheduler: limits how many downloads run at once (see L{download.DownloadScheduler.max_downloads} and L{download.DownloadScheduler.max_downloads_per_host})
+	@type scheduler: L{download.DownloadScheduler}
 	"""
 
-	__slots__ = ['monitored_downloads', 'dry_run', 'total_bytes_downloaded', 'n_completed_downloads']
+	__slots__ = ['monitored_downloads', 'dry_run', 'total_bytes_downloaded', 'n_completed_downloads', 'scheduler']
 
 	def __init__(self, mainloop = None, dry_run = False):
 		self.monitored_downloads = {}		
 		self.dry_run = dry_run
 		self.n_completed_downloads = 0
 		self.total_bytes_downloaded = 0
+		self.scheduler = download.DownloadScheduler()
 
 	def monitor_download(self, dl):
 		"""Called when a new L{download} is started.
-		This is mainly used by the GUI to display the progress bar."""
+		This is mainly used by the GUI to display the progress bar.
+		Downloads are queued by our L{scheduler}, so dl may remain in the
+		L{download.download_starting} state for a while."""
+		if isinstance(dl, download.Download) and dl.scheduler is None:
+			dl.scheduler = self.scheduler
 		dl.start()
 		self.monitored_downloads[dl.url] = dl
 		self.downloads_changed()
@@ -80,13 +87,16 @@ class Handler(object):
 		"""@deprecated: use tasks.wait_for_blocker instead"""
 		tasks.wait_for_blocker(blocker)
 	
-	def get_download(self, url, force = False, hint = None, factory = None):
+	def get_download(self, url, force = False, hint = None, factory = None, expected_size = None):
 		"""Return the Download object currently downloading 'url'.
 		If no download for this URL has been started, start one now (and
 		start monitoring it).
 		If the download failed and force is False, return it anyway.
 		If force is True, abort any current or failed download and start
 		a new one.
+		@param expected_size: the size of the resource, if known (set before starting a new download, so
+		that it can resume an earlier attempt; since 1.1)
+		@type expected_size: int | None
 		@rtype: L{download.Download}
 		"""
 		if self.dry_run:
@@ -102,6 +112,8 @@ class Handler(object):
 				dl = download.Download(url, hint)
 			else:
 				dl = factory(url, hint)
+			if expected_size is not None:
+				dl.expected_size = expected_size
 			self.monitor_download(dl)
 		return dl
 
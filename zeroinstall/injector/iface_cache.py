@@ -65,16 +65,21 @@ class PendingFeed(object):
 	@since: 0.25"""
 	__slots__ = ['url', 'signed_data', 'sigs', 'new_xml']
 
-	def __init__(self, url, signed_data):
+	def __init__(self, url, signed_data, checked = None):
 		"""Downloaded data is a GPG-signed message.
 		@param url: the URL of the downloaded feed
 		@type url: str
 		@param signed_data: the downloaded data (not yet trusted)
 		@type signed_data: stream
+		@param checked: the result of L{gpg.check_stream} on signed_data, if already known (since 1.1)
+		@type checked: (stream, [L{gpg.Signature}]) | None
 		@raise SafeException: if the data is not signed, and logs the actual data"""
 		self.url = url
 		self.signed_data = signed_data
-		self.recheck()
+		if checked is None:
+			self.recheck()
+		else:
+			self._set_checked(*checked)
 
 	def download_keys(self, handler, feed_hint = None, key_mirror = None):
 		"""Download any required GPG keys not already on our keyring.
@@ -85,84 +90,143 @@ class PendingFeed(object):
 		@param key_mirror: URL of directory containing keys, or None to use feed's directory
 		@type key_mirror: str
 		"""
-		downloads = {}
-		blockers = []
-		for x in self.sigs:
+		for x in download_keys([self], handler, feed_hint, key_mirror):
+			yield x
+
+	def recheck(self):
+		"""Set new_xml and sigs by reading signed_data.
+		You need to call this when previously-missing keys are added to the GPG keyring."""
+		from . import gpg
+		try:
+			self.signed_data.seek(0)
+			stream, sigs = gpg.check_stream(self.signed_data)
+		except:
+			self._log_data()
+			raise
+		self._set_checked(stream, sigs)
+
+	def _set_checked(self, stream, sigs):
+		assert sigs
+
+		data = stream.read()
+		if stream is not self.signed_data:
+			stream.close()
+
+		self.new_xml = data
+		self.sigs = sigs
+
+	def _log_data(self):
+		self.signed_data.seek(0)
+		info(_("Failed to check GPG signature. Data received was:\n") + repr(self.signed_data.read()))
+
+def download_keys(pending_feeds, handler, feed_hint = None, key_mirror = None):
+	"""Download any GPG keys not already on our keyring which are needed by these feeds.
+	Each key is downloaded only once, even if several feeds need it. When all downloads
+	are done (successful or otherwise), add the new keys to the keyring together and
+	check all the feeds again. Run this as a task.
+	@param pending_feeds: the feeds which need keys
+	@type pending_feeds: [L{PendingFeed}]
+	@param handler: handler to manage the downloads
+	@type handler: L{handler.Handler}
+	@param key_mirror: URL of directory containing keys, or None to use each feed's directory
+	@type key_mirror: str
+	@raise SafeException: if keys were needed but none could be downloaded
+	@since: 1.1"""
+	import urlparse
+	from zeroinstall.support import tasks
+	from . import gpg
+
+	downloads = {}		# Blocker -> (key URL, feed URL, stream)
+	key_urls = set()
+	blockers = []
+	for pending in pending_feeds:
+		for x in pending.sigs:
 			key_id = x.need_key()
 			if key_id:
-				import urlparse
-				key_url = urlparse.urljoin(key_mirror or self.url, '%s.gpg' % key_id)
+				key_url = urlparse.urljoin(key_mirror or pending.url, '%s.gpg' % key_id)
+				if key_url in key_urls: continue
+				key_urls.add(key_url)
 				info(_("Fetching key from %s"), key_url)
 				dl = handler.get_download(key_url, hint = feed_hint)
-				downloads[dl.downloaded] = (dl, dl.tempfile)
+				downloads[dl.downloaded] = (key_url, pending.url, dl.tempfile)
 				blockers.append(dl.downloaded)
 
-		exception = None
-		any_success = False
-
-		from zeroinstall.support import tasks
-
-		while blockers:
-			yield blockers
-
-			old_blockers = blockers
-			blockers = []
-
-			for b in old_blockers:
-				try:
-					tasks.check(b)
-					if b.happened:
-						dl, stream = downloads[b]
-						stream.seek(0)
-						self._downloaded_key(stream)
-						any_success = True
-					else:
-						blockers.append(b)
-				except Exception:
-					_type, exception, tb = sys.exc_info()
-					warn(_("Failed to import key for '%(url)s': %(exception)s"), {'url': self.url, 'exception': str(exception)})
-
-		if exception and not any_success:
-			raise exception, None, tb
+	if not blockers:
+		return
 
-		self.recheck()
+	exception = None
+	keys = []		# (feed URL, stream) for each key downloaded
 
-	def _downloaded_key(self, stream):
-		import shutil, tempfile
-		from zeroinstall.injector import gpg
+	while blockers:
+		yield blockers
 
-		info(_("Importing key for feed '%s'"), self.url)
+		old_blockers = blockers
+		blockers = []
 
-		# Python2.4: can't call fileno() on stream, so save to tmp file instead
-		tmpfile = tempfile.TemporaryFile(prefix = 'injector-dl-data-')
-		try:
+		for b in old_blockers:
+			try:
+				tasks.check(b)
+				if b.happened:
+					key_url, feed_url, stream = downloads[b]
+					keys.append((feed_url, stream))
+				else:
+					blockers.append(b)
+			except Exception:
+				_type, exception, tb = sys.exc_info()
+				key_url, feed_url, stream = downloads[b]
+				warn(_("Failed to import key for '%(url)s': %(exception)s"), {'url': feed_url, 'exception': str(exception)})
+
+	if keys:
+		_import_keys(keys)
+	elif exception:
+		raise exception, None, tb
+
+	results = gpg.check_streams([pending.signed_data for pending in pending_feeds])
+	for pending, result in zip(pending_feeds, results):
+		if isinstance(result, Exception):
+			pending._log_data()
+			raise result
+		pending._set_checked(*result)
+
+def _import_keys(keys):
+	"""Add some downloaded keys to the keyring, using a single gpg process if possible.
+	@param keys: the feed that needed each key, and the key data
+	@type keys: [(str, stream)]
+	@raise SafeException: if none of them could be imported"""
+	import shutil, tempfile
+	from zeroinstall.injector import gpg
+
+	for feed_url, stream in keys:
+		info(_("Importing key for feed '%s'"), feed_url)
+
+	# Python2.4: can't call fileno() on stream, so save to tmp file instead
+	tmpfile = tempfile.TemporaryFile(prefix = 'injector-dl-data-')
+	try:
+		for feed_url, stream in keys:
+			stream.seek(0)
 			shutil.copyfileobj(stream, tmpfile)
-			tmpfile.flush()
+			tmpfile.write('\n')
+		tmpfile.flush()
 
-			tmpfile.seek(0)
-			gpg.import_key(tmpfile)
-		finally:
-			tmpfile.close()
-
-	def recheck(self):
-		"""Set new_xml and sigs by reading signed_data.
-		You need to call this when previously-missing keys are added to the GPG keyring."""
-		from . import gpg
-		try:
-			self.signed_data.seek(0)
-			stream, sigs = gpg.check_stream(self.signed_data)
-			assert sigs
-
-			data = stream.read()
-			if stream is not self.signed_data:
-				stream.close()
-
-			self.new_xml = data
-			self.sigs = sigs
-		except:
-			self.signed_data.seek(0)
-			info(_("Failed to check GPG signature. Data received was:\n") + repr(self.signed_data.read()))
+		tmpfile.seek(0)
+		gpg.import_key(tmpfile)
+	except SafeException as ex:
+		if len(keys) == 1:
 			raise
+		# Find out which ones are bad
+		info(_("Failed to import keys together (%s); trying one at a time"), ex)
+		any_success = False
+		for key in keys:
+			try:
+				_import_keys([key])
+				any_success = True
+			except SafeException:
+				_type, exception, tb = sys.exc_info()
+				warn(_("Failed to import key for '%(url)s': %(exception)s"), {'url': key[0], 'exception': str(exception)})
+		if not any_success:
+			raise exception, None, tb
+	finally:
+		tmpfile.close()
 
 class IfaceCache(object):
 	"""
@@ -455,6 +519,60 @@ class IfaceCache(object):
 			return os.stat(timestamp_path).st_mtime
 		return None
 
+	def _get_cached_feed_state(self, url):
+		cached = basedir.load_first_cache(config_site, 'interfaces', escape(url))
+		if cached is None:
+			return None
+		st = os.stat(cached)
+		return '%d %d' % (st.st_size, st.st_mtime)
+
+	def get_feed_validators(self, url):
+		"""Get the HTTP validators (ETag and Last-Modified headers) sent with the cached copy of a feed.
+		These can be used to ask the server for the feed only if it has changed.
+		They are ignored if the cached copy has been replaced since they were recorded.
+		@see: L{set_feed_validators}
+		@return: (etag, last_modified), or None if we don't have any
+		@rtype: (str | None, str | None) | None
+		@since: 1.1"""
+		path = basedir.load_first_cache(config_site, config_prog, 'feed-validators', model._pretty_escape(url))
+		if path is None:
+			return None
+		try:
+			lines = file(path).read().split('\n')
+			state, etag, last_modified = lines[:3]
+		except (IOError, ValueError) as ex:
+			warn(_("Failed to read validators for %(url)s: %(exception)s"), {'url': url, 'exception': ex})
+			return None
+		if state != self._get_cached_feed_state(url):
+			debug(_("Cached copy of %s has changed; ignoring its validators"), url)
+			return None
+		if not (etag or last_modified):
+			return None
+		return (etag or None, last_modified or None)
+
+	def set_feed_validators(self, url, etag, last_modified):
+		"""Record the HTTP validators sent with the copy of a feed that is now in the cache.
+		If both are None, any existing validators are removed.
+		@see: L{get_feed_validators}
+		@since: 1.1"""
+		if os.path.isabs(url):
+			return
+		state = self._get_cached_feed_state(url)
+		if state is None or not (etag or last_modified):
+			path = basedir.load_first_cache(config_site, config_prog, 'feed-validators', model._pretty_escape(url))
+			if path is not None:
+				os.unlink(path)
+			return
+		for value in (etag, last_modified):
+			if value and '\n' in value:
+				raise SafeException(_("Invalid HTTP header value: %s") % repr(value))
+		validators_dir = basedir.save_cache_path(config_site, config_prog, 'feed-validators')
+		path = os.path.join(validators_dir, model._pretty_escape(url))
+		stream = file(path + '.new', 'w')
+		stream.write('\n'.join([state, etag or '', last_modified or '']) + '\n')
+		stream.close()
+		os.rename(path + '.new', path)
+
 	def get_feed_imports(self, iface):
 		"""Get all feeds that add to this interface.
 		This is the feeds explicitly added by the user, feeds added by the distribution,
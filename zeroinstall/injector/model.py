@@ -115,6 +115,11 @@ class Stability(object):
 	def __repr__(self):
 		return _("<Stability: %s>") % self.description
 
+	def __reduce__(self):
+		# Each level is a module global with the same name, so pickle
+		# it by reference to keep them unique.
+		return self.name
+
 def process_binding(e):
 	"""Internal"""
 	if e.name == 'environment':
@@ -486,6 +491,68 @@ class DownloadSource(RetrievalMethod):
 					start_offset = self.start_offset or 0)
 		return StepCommand()
 
+	def prepare_with_manifest(self, fetcher, destination, alg, force = False, impl_hint = None):
+		"""Download the archive and unpack it into the empty directory destination, recording
+		the details needed for the manifest as the files are written (see
+		L{unpack.unpack_archive_with_manifest}). Tar archives are unpacked while they are
+		still being downloaded.
+		@param alg: the algorithm that will be used for the manifest
+		@type alg: L{zerostore.manifest.Algorithm}
+		@return: a command whose blocker triggers when it's done; its builder attribute is then the
+		result for L{zerostore.Store.check_manifest_and_rename}
+		@since: 1.1"""
+
+		class UnpackCommand(object):
+			__slots__ = ['blocker', 'builder']
+
+		command = UnpackCommand()
+		command.builder = None
+
+		@tasks.async
+		def run():
+			dl = self._download(fetcher, force, impl_hint)
+			stream = dl.tempfile
+			extract = self.extract or None
+			type = self.type or unpack.type_from_url(self.url)
+
+			unpacker = None
+			if stream is not None and unpack.can_stream(type, alg):
+				pipe = dl.open_stream(skip = self.start_offset or 0)
+				if pipe is not None:
+					# The unpacking thread only gets to run while the main loop is
+					# waiting for events if the main loop releases the GIL
+					import gobject
+					gobject.threads_init()
+					unpacker = unpack.StreamUnpacker(self.url, pipe, destination, alg, extract, type)
+
+			yield dl.downloaded
+
+			if unpacker is not None:
+				# Even if the download failed, we must wait for the thread to stop
+				# writing to destination before our caller can delete it.
+				yield tasks.InputBlocker(unpacker.done, "unpack " + self.url)
+				try:
+					builder = unpacker.get_result()
+				except:
+					tasks.check(dl.downloaded)	# (report download errors in preference)
+					raise
+				tasks.check(dl.downloaded)
+				if builder is not None:
+					command.builder = builder
+					return
+				# Couldn't do it while streaming; unpack the complete archive instead
+			else:
+				tasks.check(dl.downloaded)
+
+			stream.seek(0)
+			command.builder = unpack.unpack_archive_with_manifest(self.url, stream, destination, alg,
+				extract = extract,
+				type = type,
+				start_offset = self.start_offset or 0)
+
+		command.blocker = run()
+		return command
+
 	def download(self, fetcher, force = False, impl_hint = None):
 		"""Fetch an archive. You should normally call L{Implementation.retrieve}
 		instead, since it handles other kinds of retrieval method too."""
@@ -503,9 +570,12 @@ class DownloadSource(RetrievalMethod):
 		if not mime_type:
 			raise SafeException(_("No 'type' attribute on archive, and I can't guess from the name (%s)") % self.url)
 		unpack.check_type_ok(mime_type)
-		dl = fetcher.handler.get_download(self.url, force = force, hint = impl_hint)
+		expected_size = None
 		if self.size:
-			dl.expected_size = self.size + (self.start_offset or 0)
+			expected_size = self.size + (self.start_offset or 0)
+		dl = fetcher.handler.get_download(self.url, force = force, hint = impl_hint, expected_size = expected_size)
+		if expected_size is not None:
+			dl.expected_size = expected_size
 		return dl
 
 	@tasks.async
@@ -1003,12 +1073,22 @@ class ZeroInstallImplementation(Implementation):
 			tmpdir = store.get_tmp_dir_for(required_digest)
 
 			try:
-				blocker = retrieval_method.retrieve(fetcher, tmpdir, force, impl_hint = self)
-				yield blocker
-				tasks.check(blocker)
+				if isinstance(retrieval_method, DownloadSource):
+					# A single archive. Unpack it straight into tmpdir, digesting the
+					# files as they are written so that we don't have to read them again.
+					command = retrieval_method.prepare_with_manifest(fetcher, tmpdir, alg, force, impl_hint = self)
+					yield command.blocker
+					tasks.check(command.blocker)
+					extract = retrieval_method.extract or None
+					builder = command.builder
+				else:
+					blocker = retrieval_method.retrieve(fetcher, tmpdir, force, impl_hint = self)
+					yield blocker
+					tasks.check(blocker)
+					extract = builder = None
 
 				# Check that the result is correct and store it in the cache
-				store.check_manifest_and_rename(required_digest, tmpdir)
+				store.check_manifest_and_rename(required_digest, tmpdir, extract, builder = builder)
 
 				tmpdir = None
 			finally:
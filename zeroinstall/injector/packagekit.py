@@ -28,6 +28,7 @@ class PackageKit(object):
 		self._pk = False
 
 		self._candidates = {}	# { package_name : (version, arch, size) | Blocker }
+		self._next_batch = None	# ([package_name], Blocker) to be resolved on the next tick
 
 	@property
 	def available(self):
@@ -95,48 +96,71 @@ class PackageKit(object):
 		package_names = [p for p in package_names if p not in self._candidates]
 
 		if package_names:
-			versions = {}
+			# Feeds are usually fetched by several tasks started together. Rather than
+			# starting a transaction for each one, add our packages to a batch and resolve
+			# the whole batch in one transaction once they've all had a chance to join it.
+			if self._next_batch is None:
+				self._next_batch = ([], tasks.Blocker('PackageKit batch'))
+			batch = self._next_batch
+			batch_names, blocker = batch
+			for package in package_names:
+				if package not in self._candidates:
+					batch_names.append(package)
+					self._candidates[package] = blocker
+			if blocker not in in_progress:
+				in_progress.append(blocker)
 
-			blocker = None
+			yield
 
-			def error_cb(sender):
-				# Note: probably just means the package wasn't found
-				_logger_pk.info(_('Transaction failed: %s(%s)'), sender.error_code, sender.error_details)
-				blocker.trigger()
+			if self._next_batch is batch:
+				self._next_batch = None
+				blocker.name = 'PackageKit %s' % batch_names
+				self._resolve(batch_names, blocker)
 
-			def details_cb(sender):
-				for packagekit_id, info in versions.items():
-					if packagekit_id in sender.details:
-						info.update(sender.details[packagekit_id])
-						info['packagekit_id'] = packagekit_id
-						self._candidates[info['name']] = info
-					else:
-						_logger_pk.info(_('Empty details for %s'), packagekit_id)
-				blocker.trigger()
+		while in_progress:
+			yield in_progress
+			in_progress = [b for b in in_progress if not b.happened]
+
+	def _resolve(self, package_names, blocker):
+		"""Resolve package_names and get their details, then trigger blocker."""
+		versions = {}
 
-			def resolve_cb(sender):
-				if sender.package:
-					versions.update(sender.package)
-					tran = _PackageKitTransaction(self.pk, details_cb, error_cb)
-					tran.proxy.GetDetails(versions.keys())
+		def error_cb(sender):
+			# Note: probably just means the package wasn't found
+			_logger_pk.info(_('Transaction failed: %s(%s)'), sender.error_code, sender.error_details)
+			blocker.trigger()
+
+		def details_cb(sender):
+			for packagekit_id, info in versions.items():
+				if packagekit_id in sender.details:
+					info.update(sender.details[packagekit_id])
+					info['packagekit_id'] = packagekit_id
+					self._candidates[info['name']] = info
 				else:
-					_logger_pk.info(_('Empty resolve for %s'), package_names)
-					blocker.trigger()
+					_logger_pk.info(_('Empty details for %s'), packagekit_id)
+			blocker.trigger()
+
+		def resolve_cb(sender):
+			if sender.package:
+				versions.update(sender.package)
+				tran = _PackageKitTransaction(self.pk, details_cb, error_cb)
+				tran.proxy.GetDetails(versions.keys())
+			else:
+				_logger_pk.info(_('Empty resolve for %s'), package_names)
+				blocker.trigger()
 
-			# Send queries
-			blocker = tasks.Blocker('PackageKit %s' % package_names)
-			for package in package_names:
-				self._candidates[package] = blocker
+		def resolve_error_cb(sender):
+			# With several packages, one missing package shouldn't lose the others
+			_logger_pk.info(_('Transaction failed: %s(%s)'), sender.error_code, sender.error_details)
+			resolve_cb(sender)
 
-			_logger_pk.debug(_('Ask for %s'), package_names)
-			tran = _PackageKitTransaction(self.pk, resolve_cb, error_cb)
+		_logger_pk.debug(_('Ask for %s'), package_names)
+		try:
+			tran = _PackageKitTransaction(self.pk, resolve_cb, resolve_error_cb)
 			tran.proxy.Resolve('none', package_names)
-
-			in_progress.append(blocker)
-
-		while in_progress:
-			yield in_progress
-			in_progress = [b for b in in_progress if not b.happened]
+		except:
+			blocker.trigger()
+			raise
 
 class PackageKitDownload(download.Download):
 	def __init__(self, url, hint, pk, packagekit_id):
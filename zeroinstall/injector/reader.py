@@ -7,6 +7,7 @@ Parses an XML feed into a Python representation. You should probably use L{iface
 
 from zeroinstall import _
 import os
+import cPickle
 from logging import debug, info, warn
 
 from zeroinstall.support import basedir
@@ -18,6 +19,59 @@ from zeroinstall.injector import model
 class MissingLocalFeed(InvalidInterface):
 	pass
 
+# Increase this if the layout of the model classes changes in a way that would
+# break old pickles.
+_parsed_feed_format = 1
+
+def _get_source_details(source):
+	"""Return the details of source that must match for a parsed copy to be used."""
+	from zeroinstall import version
+	details = os.stat(source)
+	return (_parsed_feed_format, version, source, int(details.st_mtime), details.st_size, details.st_ino)
+
+def _load_parsed_feed(url, source):
+	"""Load the pre-parsed copy of the cached feed source, if it is still up-to-date.
+	@return: the feed, or None if there is no usable parsed copy
+	@rtype: L{model.ZeroInstallFeed} | None"""
+	parsed = basedir.load_first_cache(config_site, config_prog, 'parsed-feeds', escape(url))
+	if parsed is None:
+		return None
+	try:
+		stream = file(parsed, 'rb')
+		try:
+			unpickler = cPickle.Unpickler(stream)
+			if unpickler.load() != _get_source_details(source):
+				debug(_("Parsed copy of %s is out-of-date"), url)
+				return None
+			return unpickler.load()
+		finally:
+			stream.close()
+	except Exception as ex:
+		info(_("Failed to load parsed copy of %(url)s: %(exception)s"), {'url': url, 'exception': ex})
+		return None
+
+def _save_parsed_feed(url, source, feed):
+	"""Save a pre-parsed copy of the cached feed source, so that later processes
+	don't need to parse the XML again. Failures are logged and otherwise ignored."""
+	import tempfile
+	try:
+		cache_dir = basedir.save_cache_path(config_site, config_prog, 'parsed-feeds')
+		tmp_fd, tmp_name = tempfile.mkstemp(dir = cache_dir, prefix = 'tmp-')
+		try:
+			stream = os.fdopen(tmp_fd, 'wb')
+			try:
+				pickler = cPickle.Pickler(stream, cPickle.HIGHEST_PROTOCOL)
+				pickler.dump(_get_source_details(source))
+				pickler.dump(feed)
+			finally:
+				stream.close()
+			os.rename(tmp_name, os.path.join(cache_dir, escape(url)))
+		except:
+			os.unlink(tmp_name)
+			raise
+	except Exception as ex:
+		info(_("Failed to save parsed copy of %(url)s: %(exception)s"), {'url': url, 'exception': ex})
+
 def update_from_cache(interface, iface_cache = None):
 	"""Read a cached interface and any native feeds or user overrides.
 	@param interface: the interface object to update
@@ -49,6 +103,7 @@ def update_from_cache(interface, iface_cache = None):
 
 def load_feed_from_cache(url, selections_ok = False):
 	"""Load a feed. If the feed is remote, load from the cache. If local, load it directly.
+	For remote feeds, a pre-parsed copy of the cached file is used if it is still up-to-date.
 	@return: the feed, or None if it's remote and not cached."""
 	try:
 		if os.path.isabs(url):
@@ -58,7 +113,11 @@ def load_feed_from_cache(url, selections_ok = False):
 			cached = basedir.load_first_cache(config_site, 'interfaces', escape(url))
 			if cached:
 				debug(_("Loading cached information for %(interface)s from %(cached)s"), {'interface': url, 'cached': cached})
-				return load_feed(cached, local = False)
+				feed = _load_parsed_feed(url, cached)
+				if feed is None:
+					feed = load_feed(cached, local = False)
+					_save_parsed_feed(url, cached, feed)
+				return feed
 			else:
 				return None
 	except InvalidInterface as ex:
@@ -18,6 +18,11 @@ This is not part of the public API.
 # - We add an AtMostOneClause (the paper suggests this in the Excercises, and
 #   it's very useful for our purposes).
 
+from collections import deque
+
+# Note: debug messages in the inner loops (propagation and assignment), and
+# those that name literals, are commented out, as formatting them costs more
+# than the solve itself.
 def debug(msg, *args):
 	return
 	print "SAT:", msg % args
@@ -39,9 +44,12 @@ def watch_index(lit):
 
 def makeAtMostOneClause(solver):
 	class AtMostOneClause:
-		def __init__(self, lits):
+		derived_from = given = ()	# (see SATProblem.explain_failure)
+
+		def __init__(self, lits, label = None):
 			"""Preferred literals come first."""
 			self.lits = lits
+			self.label = label
 
 			# The single literal from our set that is True.
 			# We store this explicitly because the decider needs to know quickly.
@@ -75,7 +83,7 @@ def makeAtMostOneClause(solver):
 			for l in self.lits:
 				value = solver.lit_value(l)
 				#debug("Value of %s is %s" % (solver.name_lit(l), value))
-				if value is True and l is not lit:
+				if value is True and l != lit:
 					# Due to queuing, we might get called with current = None
 					# and two versions already selected.
 					debug("CONFLICT: already selected %s" % solver.name_lit(l))
@@ -84,13 +92,13 @@ def makeAtMostOneClause(solver):
 					# Since one of our lits is already true, all unknown ones
 					# can be set to False.
 					if not solver.enqueue(neg(l), self):
-						debug("CONFLICT: enqueue failed for %s", solver.name_lit(neg(l)))
+						#debug("CONFLICT: enqueue failed for %s", solver.name_lit(neg(l)))
 						return False	# Conflict; abort
 
 			return True
 
 		def undo(self, lit):
-			debug("(backtracking: no longer selected %s)" % solver.name_lit(lit))
+			#debug("(backtracking: no longer selected %s)" % solver.name_lit(lit))
 			assert lit == self.current
 			self.current = None
 
@@ -105,14 +113,15 @@ def makeAtMostOneClause(solver):
 						trues.append(l)
 						if len(trues) == 2: return trues
 			else:
-				for l in self.lits:
-					if l is not lit and solver.lit_value(l) is True:
-						return [l]
-				# Find one True literal
+				# We set lit (which is not(l) for one of our lits) to True
+				# because current was already True. current was assigned
+				# before lit, so it is still True while lit is.
+				assert self.current is not None
+				return [self.current]
 			assert 0	# don't know why!
 
 		def best_undecided(self):
-			debug("best_undecided: %s" % (solver.name_lits(self.lits)))
+			#debug("best_undecided: %s" % (solver.name_lits(self.lits)))
 			for lit in self.lits:
 				#debug("%s = %s" % (solver.name_lit(lit), solver.lit_value(lit)))
 				if solver.lit_value(lit) is None:
@@ -126,8 +135,11 @@ def makeAtMostOneClause(solver):
 
 def makeUnionClause(solver):
 	class UnionClause:
-		def __init__(self, lits):
+		def __init__(self, lits, label = None, derived_from = (), given = ()):
 			self.lits = lits
+			self.label = label		# For explaining failures (see SATProblem.explain_failure)
+			self.derived_from = derived_from
+			self.given = given
 		
 		# Try to infer new facts.
 		# We can do this only when all of our literals are False except one,
@@ -181,15 +193,34 @@ def makeUnionClause(solver):
 		# Why is lit True?
 		# Or, why are we causing a conflict (if lit is None)?
 		def cacl_reason(self, lit):
-			assert lit is None or lit is self.lits[0]
+			assert lit is None or lit == self.lits[0]
 
 			# The cause is everything except lit.
-			return [neg(l) for l in self.lits if l is not lit]
+			return [neg(l) for l in self.lits if l != lit]
 
 		def __repr__(self):
 			return "<some: %s>" % (', '.join(solver.name_lits(self.lits)))
 	return UnionClause
 
+class Fact(object):
+	"""A literal made True at the top level without a clause to watch for it:
+	the only literal left in a clause added before the solve, or a learnt clause
+	with only one literal. Also records a clause with no literals left, which makes
+	the problem impossible."""
+	__slots__ = ['label', 'derived_from', 'given']
+
+	def __init__(self, label, derived_from = (), given = ()):
+		self.label = label
+		self.derived_from = derived_from
+		self.given = given
+
+	def cacl_reason(self, lit):
+		# Nothing else at the top level needs to be True
+		return []
+
+	def __repr__(self):
+		return "<fact: %s>" % (self.label,)
+
 # Using an array of VarInfo objects is less efficient than using multiple arrays, but
 # easier for me to understand.
 class VarInfo(object):
@@ -212,7 +243,7 @@ class SATProblem(object):
 	def __init__(self):
 		# Propagation
 		self.watches = []		# watches[2i,2i+1] = constraints to check when literal[i] becomes True/False
-		self.propQ = []			# propagation queue
+		self.propQ = deque()		# propagation queue
 
 		# Assignments
 		self.assigns = []		# [VarInfo]
@@ -220,6 +251,7 @@ class SATProblem(object):
 		self.trail_lim = []		# decision levels
 
 		self.toplevel_conflict = False
+		self.conflict = None		# The clause or Fact that made run_solver fail
 
 		self.makeAtMostOneClause = makeAtMostOneClause(self)
 		self.makeUnionClause = makeUnionClause(self)
@@ -239,7 +271,7 @@ class SATProblem(object):
 	# reason is the clause that is asserting this
 	# Returns False if this immediately causes a conflict.
 	def enqueue(self, lit, reason):
-		debug("%s => %s" % (reason, self.name_lit(lit)))
+		#debug("%s => %s" % (reason, self.name_lit(lit)))
 		old_value = self.lit_value(lit)
 		if old_value is not None:
 			if old_value is False:
@@ -266,7 +298,7 @@ class SATProblem(object):
 	# Pop most recent assignment from self.trail
 	def undo_one(self):
 		lit = self.trail[-1]
-		debug("(pop %s)", self.name_lit(lit))
+		#debug("(pop %s)", self.name_lit(lit))
 		var_info = self.get_varinfo_for_lit(lit)
 		var_info.value = None
 		var_info.reason = None
@@ -293,18 +325,21 @@ class SATProblem(object):
 	# Returns None when done, or the clause that caused a conflict.
 	def propagate(self):
 		#debug("propagate: queue length = %d", len(self.propQ))
-		while self.propQ:
-			lit = self.propQ[0]
-			del self.propQ[0]
+		propQ = self.propQ
+		while propQ:
+			lit = propQ.popleft()
 			wi = watch_index(lit)
+
+			# Each watcher either re-adds itself to this list or moves
+			# to watching one of its other literals (see UnionClause).
+			# Either way, each watcher is visited only once per assignment.
 			watches = self.watches[wi]
 			self.watches[wi] = []
 
-			debug("%s -> True : watches: %s" % (self.name_lit(lit), watches))
+			#debug("%s -> True : watches: %s" % (self.name_lit(lit), watches))
 
 			# Notifiy all watchers
-			for i in range(len(watches)):
-				clause = watches[i]
+			for i, clause in enumerate(watches):
 				if not clause.propagate(lit):
 					# Conflict
 
@@ -313,13 +348,15 @@ class SATProblem(object):
 					
 					# No point processing the rest of the queue as
 					# we'll have to backtrack now.
-					self.propQ = []
+					propQ.clear()
 
 					return clause
 		return None
 	
-	def impossible(self):
+	def impossible(self, label = None):
 		self.toplevel_conflict = True
+		if self.conflict is None:
+			self.conflict = Fact(label)
 
 	def get_varinfo_for_lit(self, lit):
 		if lit >= 0:
@@ -347,21 +384,23 @@ class SATProblem(object):
 	# Returns the new clause if one was added, True if none was added
 	# because this clause is trivially True, or False if the clause is
 	# False.
-	def _add_clause(self, lits, learnt):
+	# label, derived_from and given are recorded for explain_failure:
+	# derived_from is the clauses a learnt clause was deduced from, and given
+	# is the literals already True at the top level that were needed for that
+	# (or that made some of an original clause's literals False).
+	def _add_clause(self, lits, learnt, label = None, derived_from = (), given = ()):
 		if not lits:
 			assert not learnt
 			self.toplevel_conflict = True
+			if self.conflict is None:
+				self.conflict = Fact(label, derived_from, given)
 			return False
 		elif len(lits) == 1:
 			# A clause with only a single literal is represented
 			# as an assignment rather than as a clause.
-			if learnt:
-				reason = "learnt"
-			else:
-				reason = "top-level"
-			return self.enqueue(lits[0], reason)
+			return self.enqueue(lits[0], Fact(label, derived_from, given))
 
-		clause = self.makeUnionClause(lits)
+		clause = self.makeUnionClause(lits, label, derived_from, given)
 		clause.learnt = learnt
 
 		if learnt:
@@ -393,11 +432,13 @@ class SATProblem(object):
 			return self.assigns[lit].name
 		return "not(%s)" % self.assigns[neg(lit)].name
 	
-	def add_clause(self, lits):
+	def add_clause(self, lits, label = None):
 		# Public interface. Only used before the solve starts.
+		# label is returned by explain_failure if this clause is part of the reason
+		# why there is no solution.
 		assert lits
 
-		debug("add_clause([%s])" % ', '.join(self.name_lits(lits)))
+		#debug("add_clause([%s])" % ', '.join(self.name_lits(lits)))
 
 		if any(self.lit_value(l) == True for l in lits):
 			# Trivially true already.
@@ -409,16 +450,20 @@ class SATProblem(object):
 				return True
 		# Remove duplicates and values known to be False
 		lits = [l for l in lit_set if self.lit_value(l) != False]
+		if len(lits) < len(lit_set):
+			given = [neg(l) for l in lit_set if self.lit_value(l) == False]
+		else:
+			given = ()
 
-		retval = self._add_clause(lits, learnt = False)
+		retval = self._add_clause(lits, learnt = False, label = label, given = given)
 		if not retval:
 			self.toplevel_conflict = True
 		return retval
 
-	def at_most_one(self, lits):
+	def at_most_one(self, lits, label = None):
 		assert lits
 
-		debug("at_most_one(%s)" % ', '.join(self.name_lits(lits)))
+		#debug("at_most_one(%s)" % ', '.join(self.name_lits(lits)))
 
 		# If we have zero or one literals then we're trivially true
 		# and not really needed for the solve. However, Zero Install
@@ -436,7 +481,7 @@ class SATProblem(object):
 		# soon.
 		lits = [l for l in lits if self.lit_value(l) != False]
 
-		clause = self.makeAtMostOneClause(lits)
+		clause = self.makeAtMostOneClause(lits, label)
 
 		for lit in lits:
 			self.watch_lit(lit, clause)
@@ -491,6 +536,8 @@ class SATProblem(object):
 		btlevel = 0		# The deepest decision in learnt
 		p = None		# The literal we want to expand now
 		seen = set()		# The variables involved in the conflict
+		derived_from = []	# The clauses we expanded (for explain_failure)
+		given = []		# The top-level assignments we relied on
 
 		counter = 0
 
@@ -499,13 +546,15 @@ class SATProblem(object):
 			# The first time, p is None, which requests the reason
 			# why it is conflicting.
 			if p is None:
-				debug("Why did %s make us fail?" % cause)
+				#debug("Why did %s make us fail?" % cause)
 				p_reason = cause.cacl_reason(p)
-				debug("Because: %s => conflict" % (' and '.join(self.name_lits(p_reason))))
+				#debug("Because: %s => conflict" % (' and '.join(self.name_lits(p_reason))))
 			else:
-				debug("Why did %s lead to %s?" % (cause, self.name_lit(p)))
+				#debug("Why did %s lead to %s?" % (cause, self.name_lit(p)))
 				p_reason = cause.cacl_reason(p)
-				debug("Because: %s => %s" % (' and '.join(self.name_lits(p_reason)), self.name_lit(p)))
+				#debug("Because: %s => %s" % (' and '.join(self.name_lits(p_reason)), self.name_lit(p)))
+
+			derived_from.append(cause)
 
 			# p_reason is in the form (A and B and ...)
 			# p_reason => p
@@ -531,6 +580,9 @@ class SATProblem(object):
 						# apparently not doing so is useful)
 						learnt.append(neg(lit))
 						btlevel = max(btlevel, var_info.level)
+					else:
+						# Known at the top level, so not needed in learnt
+						given.append(lit)
 				# else we already considered the cause of this assignment
 
 			# At this point, counter is the number of assigned
@@ -575,9 +627,43 @@ class SATProblem(object):
 		# directly to the learnt clause.
 		learnt[0] = neg(p)
 
-		debug("Learnt: %s" % (' or '.join(self.name_lits(learnt))))
+		#debug("Learnt: %s" % (' or '.join(self.name_lits(learnt))))
+
+		return learnt, btlevel, derived_from, given
 
-		return learnt, btlevel
+	def explain_failure(self):
+		"""After run_solver has returned False, find a set of the original clauses
+		which can't all be satisfied. Starting from the final conflict, we follow
+		the reason for each top-level assignment involved, and replace each learnt
+		clause with the clauses it was deduced from.
+		@return: the labels of those clauses which were given one, in the order found
+		@rtype: list"""
+		assert self.conflict is not None
+
+		labels = []
+		seen_reasons = set()
+		seen_vars = set()
+
+		reasons = [self.conflict]			# Clauses whose own premises we need
+		lits = self.conflict.cacl_reason(None)		# Top-level assignments we need the reasons for
+		while reasons or lits:
+			if lits:
+				lit = lits.pop()
+				var_info = self.get_varinfo_for_lit(lit)
+				if var_info in seen_vars: continue
+				seen_vars.add(var_info)
+				assert var_info.level == 0, var_info
+				lits.extend(var_info.reason.cacl_reason(lit))
+				reasons.append(var_info.reason)
+			else:
+				reason = reasons.pop()
+				if reason in seen_reasons: continue
+				seen_reasons.add(reason)
+				if reason.label is not None:
+					labels.append(reason.label)
+				reasons.extend(reason.derived_from)
+				lits.extend(reason.given)
+		return labels
 
 	def run_solver(self, decide):
 		# Check whether we detected a trivial problem
@@ -591,8 +677,9 @@ class SATProblem(object):
 			# and assign literals where there is only one possibility.
 			conflicting_clause = self.propagate()
 			if not conflicting_clause:
-				debug("new state: %s", self.assigns)
-				if all(info.value != None for info in self.assigns):
+				#debug("new state: %s", self.assigns)
+				# Every assigned variable is on the trail exactly once
+				if len(self.trail) == len(self.assigns):
 					# Everything is assigned without conflicts
 					debug("SUCCESS!")
 					return True
@@ -610,14 +697,15 @@ class SATProblem(object):
 			else:
 				if self.get_decision_level() == 0:
 					debug("FAIL: conflict found at top level")
+					self.conflict = conflicting_clause
 					return False
 				else:
 					# Figure out the root cause of this failure.
-					learnt, backtrack_level = self.analyse(conflicting_clause)
+					learnt, backtrack_level, derived_from, given = self.analyse(conflicting_clause)
 
 					self.cancel_until(backtrack_level)
 
-					c = self._add_clause(learnt, learnt = True)
+					c = self._add_clause(learnt, learnt = True, derived_from = derived_from, given = given)
 
 					if c is not True:
 						# Everything except the first literal in learnt is known to
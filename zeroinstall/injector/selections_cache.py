@@ -0,0 +1,155 @@
+"""
+Remembers the result of the last successful solve for each set of requirements, so that
+later runs can skip the solver if nothing that could affect the choice has changed.
+"""
+
+# Copyright (C) 2011, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+from zeroinstall import _
+import os, time, locale
+import cPickle
+from cStringIO import StringIO
+from logging import debug, info
+
+from zeroinstall.support import basedir
+from zeroinstall.injector import model, qdom, selections
+from zeroinstall.injector.namespaces import config_site, config_prog
+
+# Increase this if the format of the cache files changes
+_cache_format = 1
+
+def _get_key(requirements):
+	"""The requirements which affect the choice of implementations (everything except the message)."""
+	r = requirements
+	return (r.interface_uri, r.command, r.source, r.before, r.not_before, r.os, r.cpu)
+
+def _get_cache_path(requirements):
+	import hashlib
+	leaf = hashlib.sha1(repr(_get_key(requirements))).hexdigest()
+	return os.path.join(basedir.save_cache_path(config_site, config_prog, 'selections'), leaf)
+
+def _stat(path):
+	if path is None:
+		return None
+	try:
+		details = os.stat(path)
+	except OSError:
+		return None
+	return (details.st_mtime, details.st_size, details.st_ino)
+
+def _get_fingerprint(config, requirements, feeds_used):
+	"""Collect everything (apart from distribution packages) that could change
+	the solver's choice: the settings, the feeds and the user's overrides for them,
+	and the contents of the implementation stores.
+	Changes to a store directory's mtime indicate that something was added or removed."""
+	from zeroinstall import version
+
+	files = []
+	for url in sorted(feeds_used):
+		if url.startswith('distribution:'):
+			continue
+		if os.path.isabs(url):
+			files.append(url)
+		else:
+			files.append(basedir.load_first_cache(config_site, 'interfaces', model.escape(url)))
+		files.append(basedir.load_first_config(config_site, config_prog, 'interfaces', model._pretty_escape(url)))
+		files.append(basedir.load_first_config(config_site, config_prog, 'feeds', model._pretty_escape(url)))
+		files.append(basedir.load_first_config(config_site, config_prog, 'user_overrides', model.escape(url)))
+		files.append(basedir.load_first_data(config_site, 'native_feeds', model._pretty_escape(url)))
+
+	stores = [store.dir for store in config.stores.stores]
+
+	return (_cache_format, version, _get_key(requirements),
+		config.network_use, config.help_with_testing, config.freshness, locale.getlocale()[0],
+		[(path, _stat(path)) for path in files],
+		[(path, _stat(path)) for path in stores])
+
+def _get_distro_impls(iface_cache, feeds_used):
+	"""For each distribution feed, the IDs of the implementations it currently provides."""
+	distro_impls = []
+	for url in sorted(feeds_used):
+		if url.startswith('distribution:'):
+			feed = iface_cache.get_feed(url)
+			distro_impls.append((url, feed and sorted(feed.implementations)))
+	return distro_impls
+
+def save_selections(config, requirements, solver):
+	"""Remember the solver's (ready) selections for these requirements.
+	Only call this if all the feeds used are fresh and every selected implementation is available.
+	Failures are logged and otherwise ignored.
+	@type config: L{config.Config}
+	@type requirements: L{requirements.Requirements}
+	@type solver: L{solver.Solver}"""
+	assert solver.ready
+
+	try:
+		iface_cache = config.iface_cache
+
+		# Find the time when we'll next need to check for updates
+		stale_after = None
+		if config.freshness > 0:
+			for url in solver.feeds_used:
+				if os.path.isabs(url) or url.startswith('distribution:'):
+					continue
+				feed = iface_cache.get_feed(url)
+				if feed is None:
+					continue
+				feed_stale_after = (feed.last_checked or 0) + config.freshness
+				if stale_after is None or feed_stale_after < stale_after:
+					stale_after = feed_stale_after
+
+		doc = solver.selections.toDOM()
+
+		entry = (_get_fingerprint(config, requirements, solver.feeds_used),
+			 stale_after,
+			 list(solver.feeds_used),
+			 _get_distro_impls(iface_cache, solver.feeds_used),
+			 doc.toxml('utf-8'))
+
+		import tempfile
+		path = _get_cache_path(requirements)
+		tmp_fd, tmp_name = tempfile.mkstemp(dir = os.path.dirname(path), prefix = 'tmp-')
+		try:
+			stream = os.fdopen(tmp_fd, 'wb')
+			try:
+				cPickle.dump(entry, stream, cPickle.HIGHEST_PROTOCOL)
+			finally:
+				stream.close()
+			os.rename(tmp_name, path)
+		except:
+			os.unlink(tmp_name)
+			raise
+	except Exception as ex:
+		info(_("Failed to save selections for %(uri)s: %(exception)s"), {'uri': requirements.interface_uri, 'exception': ex})
+
+def load_selections(config, requirements):
+	"""Get the selections saved by L{save_selections} for these requirements, if they are still valid.
+	@return: the selections, or None if we need to solve again
+	@rtype: L{selections.Selections} | None"""
+	path = _get_cache_path(requirements)
+	if not os.path.exists(path):
+		return None
+	try:
+		stream = file(path, 'rb')
+		try:
+			fingerprint, stale_after, feeds_used, distro_impls, xml = cPickle.load(stream)
+		finally:
+			stream.close()
+
+		if stale_after is not None and time.time() >= stale_after:
+			debug(_("Saved selections for %s are due for an update check"), requirements.interface_uri)
+			return None
+
+		if fingerprint != _get_fingerprint(config, requirements, feeds_used):
+			debug(_("Saved selections for %s are out-of-date"), requirements.interface_uri)
+			return None
+
+		if distro_impls != _get_distro_impls(config.iface_cache, feeds_used):
+			debug(_("Installed distribution packages for %s have changed"), requirements.interface_uri)
+			return None
+
+		return selections.Selections(qdom.parse(StringIO(xml)))
+	except Exception as ex:
+		info(_("Failed to load saved selections for %(uri)s: %(exception)s"), {'uri': requirements.interface_uri, 'exception': ex})
+		return None
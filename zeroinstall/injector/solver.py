@@ -7,6 +7,7 @@ Chooses a set of components to make a running program.
 
 from zeroinstall import _
 import locale
+from bisect import bisect_left, bisect_right
 from logging import debug, warn, info
 
 from zeroinstall.injector.reader import MissingLocalFeed
@@ -27,10 +28,11 @@ class CommandInfo:
 class ImplInfo:
 	is_dummy = False
 
-	def __init__(self, iface, impl, arch, dummy = False):
+	def __init__(self, iface, impl, arch, dummy = False, deps = None):
 		self.iface = iface
 		self.impl = impl
 		self.arch = arch
+		self.deps = deps or []		# The dependencies of impl in use for arch
 		if dummy:
 			self.is_dummy = True
 
@@ -38,6 +40,78 @@ class ImplInfo:
 		name = "%s_%s_%s" % (self.impl.feed.get_name(), self.impl.get_version(), self.impl.arch)
 		return name.replace('-', '_').replace('.', '_')
 
+def _invert_rank(rank):
+	"""Convert an OS or machine rank (lower is better) to a key part (higher is better).
+	Unknown types (None) are ranked first, as they would be by cmp."""
+	if rank is None:
+		return (True, 0)
+	return (False, -rank)
+
+def _restrictions_key(restrictions):
+	"""Return a value which changes if any of these restrictions are changed,
+	or None if we don't know how to tell."""
+	key = []
+	for r in restrictions:
+		if isinstance(r, model.VersionRangeRestriction):
+			key.append((r.before, r.not_before))
+		elif isinstance(r, model.VersionRestriction):
+			key.append(r.version)
+		else:
+			return None
+	return tuple(key)
+
+class _IfaceEncoding(object):
+	"""How an interface was added to the SAT problem by an earlier solve.
+	This is reused by later solves until any of its inputs change.
+	@ivar inputs: the feeds, implementation states and preferences used
+	@ivar ranked: every implementation, best first, with the reason it can't be used (or None)
+	@ivar infos: an L{ImplInfo} for each usable implementation, in the same order
+	@ivar matching: cached candidates for dependencies of these implementations
+	@type matching: {L{model.Dependency}: (L{_IfaceEncoding}, tuple, set(L{model.Implementation}))}
+	@ivar by_version: the versions of the usable implementations in order, and the implementations in the same order (created when first needed)
+	@type by_version: ([tuple], [L{model.Implementation}])"""
+	__slots__ = ['inputs', 'ranked', 'infos', 'matching', 'by_version']
+
+	def __init__(self, inputs, ranked, infos):
+		self.inputs = inputs
+		self.ranked = ranked
+		self.infos = infos
+		self.matching = {}
+		self.by_version = None
+
+	def get_meeting(self, restrictions):
+		"""Return the usable implementations which meet all of these restrictions.
+		Version and version range restrictions are checked by bisecting the
+		implementations sorted by version; any other kind is asked about each
+		remaining implementation.
+		@type restrictions: [L{model.Restriction}]
+		@rtype: set(L{model.Implementation})"""
+		if self.by_version is None:
+			by_version = sorted([(info.impl.version, i, info.impl) for i, info in enumerate(self.infos)])
+			self.by_version = ([version for version, i, impl in by_version], [impl for version, i, impl in by_version])
+		versions, impls = self.by_version
+
+		low = 0
+		high = len(versions)
+		others = []
+		for r in restrictions:
+			# (a subclass might override meets_restriction, so check the exact type)
+			if r.__class__ is model.VersionRangeRestriction:
+				if r.not_before:
+					low = max(low, bisect_left(versions, r.not_before))
+				if r.before:
+					high = min(high, bisect_left(versions, r.before))
+			elif r.__class__ is model.VersionRestriction:
+				low = max(low, bisect_left(versions, r.version))
+				high = min(high, bisect_right(versions, r.version))
+			else:
+				others.append(r)
+
+		matching = set(impls[low:high])
+		for r in others:
+			matching = set(impl for impl in matching if r.meets_restriction(impl))
+		return matching
+
 def _get_command_name(runner):
 	"""Returns the 'command' attribute of a <runner>, or 'run' if there isn't one."""
 	return runner.qdom.attrs.get('command', 'run')
@@ -100,7 +174,8 @@ class SATSolver(Solver):
 	@ivar langs: the preferred languages (e.g. ["es_ES", "en"]). Initialised to the current locale.
 	@type langs: str"""
 
-	__slots__ = ['_failure_reason', 'config', 'extra_restrictions', '_lang_ranks', '_langs']
+	__slots__ = ['_failure_reason', 'config', 'extra_restrictions', '_lang_ranks', '_langs', '_encodings', '_encodings_settings',
+		     '_selections', '_closest_match_args']
 
 	@property
 	def iface_cache(self):
@@ -113,10 +188,13 @@ class SATSolver(Solver):
 		@param extra_restrictions: extra restrictions on the chosen implementations
 		@type extra_restrictions: {L{model.Interface}: [L{model.Restriction}]}
 		"""
+		self._closest_match_args = None
 		Solver.__init__(self)
 		assert not isinstance(config, str), "API change!"
 		self.config = config
 		self.extra_restrictions = extra_restrictions or {}
+		self._encodings = {}		# Reused by the next solve (see _IfaceEncoding)
+		self._encodings_settings = None
 
 		# By default, prefer the current locale's language first and English second
 		self.langs = [locale.getlocale()[0] or 'en', 'en']
@@ -142,37 +220,60 @@ class SATSolver(Solver):
 
 	langs = property(lambda self: self._langs, set_langs)
 
+	def _get_selections(self):
+		args = self._closest_match_args
+		if args is not None:
+			# The last solve failed. Now that the selections are wanted, do a
+			# closest match solve to find them (keeping the original failure reason).
+			failure_reason = self._failure_reason
+			self.solve(*args, closest_match = True)
+			self._failure_reason = failure_reason
+		return self._selections
+
+	def _set_selections(self, selections):
+		self._closest_match_args = None
+		self._selections = selections
+
+	selections = property(_get_selections, _set_selections, doc = """The chosen implementation of each interface.
+		If the last solve failed, this is the closest match we could find, which
+		is only worked out the first time it is needed.""")
+
 	def compare(self, interface, b, a, arch):
 		"""Compare a and b to see which would be chosen first.
 		Does not consider whether the implementations are usable (check for that yourself first).
 		@param interface: The interface we are trying to resolve, which may
 		not be the interface of a or b if they are from feeds.
 		@rtype: int"""
+		return cmp(self.get_rank_key(interface, a, arch), self.get_rank_key(interface, b, arch))
+
+	def get_rank_key(self, interface, impl, arch, is_available = None):
+		"""Get a value which can be compared with the keys of other implementations
+		to see which would be chosen first. Implementations with greater keys are preferred.
+		Does not consider whether the implementation is usable (check for that yourself first).
+		@param interface: The interface we are trying to resolve, which may
+		not be the interface of impl if it comes from a feed.
+		@param is_available: function to check whether impl is cached, or None to check the stores
+		@type is_available: L{model.Implementation} -> bool
+		@rtype: tuple"""
+		if is_available is None:
+			stores = self.config.stores
+			is_available = lambda impl: impl.is_available(stores)
+
+		network_full = self.config.network_use == model.network_full
 
 		# Languages we understand come first
-		a_langs = (a.langs or 'en').split()
-		b_langs = (b.langs or 'en').split()
+		langs = (impl.langs or 'en').split()
 		my_langs = self._lang_ranks
+		lang_rank = max(my_langs.get(l.split('-')[0], -1) for l in langs)
 
-		r = cmp(max(my_langs.get(l.split('-')[0], -1) for l in a_langs),
-			max(my_langs.get(l.split('-')[0], -1) for l in b_langs))
-		if r: return r
-
-		a_stab = a.get_stability()
-		b_stab = b.get_stability()
+		stab = impl.get_stability()
 
 		# Preferred versions come first
-		r = cmp(a_stab == model.preferred, b_stab == model.preferred)
-		if r: return r
-
-		stores = self.config.stores
-		if self.config.network_use != model.network_full:
-			r = cmp(a.is_available(stores), b.is_available(stores))
-			if r: return r
+		preferred = stab == model.preferred
 
-		# Packages that require admin access to install come last
-		r = cmp(b.requires_root_install, a.requires_root_install)
-		if r: return r
+		# Unless we can download freely, cached versions come next
+		available = is_available(impl)
+		cached_first = not network_full and available
 
 		# Stability
 		stab_policy = interface.stability_policy
@@ -180,46 +281,26 @@ class SATSolver(Solver):
 			if self.config.help_with_testing: stab_policy = model.testing
 			else: stab_policy = model.stable
 
-		if a_stab >= stab_policy: a_stab = model.preferred
-		if b_stab >= stab_policy: b_stab = model.preferred
-
-		r = cmp(a_stab, b_stab)
-		if r: return r
-
-		# Newer versions come before older ones
-		if a.id.startswith('package:') != b.id.startswith('package:'):
-			# If one of packages is native, do not compare full versions since
-			# it is useless to compare native and 0install version revisions
-			r = cmp(a.version[0], b.version[0])
-			if r: return r
-			# Othewise, prefer native package
-			return cmp(a.id.startswith('package:'), b.id.startswith('package:'))
-		else:
-			r = cmp(a.version, b.version)
-			if r: return r
-
-		# Get best OS
-		r = cmp(arch.os_ranks.get(b.os, None),
-			arch.os_ranks.get(a.os, None))
-		if r: return r
-
-		# Get best machine
-		r = cmp(arch.machine_ranks.get(b.machine, None),
-			arch.machine_ranks.get(a.machine, None))
-		if r: return r
-
-		# Slightly prefer languages specialised to our country
-		# (we know a and b have the same base language at this point)
-		r = cmp(max(my_langs.get(l, -1) for l in a_langs),
-			max(my_langs.get(l, -1) for l in b_langs))
-		if r: return r
-
-		# Slightly prefer cached versions
-		if self.config.network_use == model.network_full:
-			r = cmp(a.is_available(stores), b.is_available(stores))
-			if r: return r
-
-		return cmp(a.id, b.id)
+		if stab >= stab_policy: stab = model.preferred
+
+		# Newer versions come before older ones.
+		# If one of the implementations being compared is a native package,
+		# the other's version modifiers are not compared; the native package
+		# is preferred if the main parts are equal.
+		version = impl.version
+		is_package = impl.id.startswith('package:')
+
+		return (lang_rank,
+			preferred,
+			cached_first,
+			not impl.requires_root_install,		# Packages that require admin access to install come last
+			stab,
+			version[0], is_package, version[1:],
+			_invert_rank(arch.os_ranks.get(impl.os, None)),		# Get best OS
+			_invert_rank(arch.machine_ranks.get(impl.machine, None)),	# Get best machine
+			max(my_langs.get(l, -1) for l in langs),		# Slightly prefer languages specialised to our country
+			network_full and available,	# Slightly prefer cached versions
+			impl.id)
 
 	def solve(self, root_interface, root_arch, command_name = 'run', closest_match = False):
 		# closest_match is used internally. It adds a lowest-ranked
@@ -233,6 +314,16 @@ class SATSolver(Solver):
 		# selects that.
 		iface_cache = self.config.iface_cache
 
+		# The encodings from the last solve can be reused only if these are the same
+		settings = (self.config.network_use, self.config.help_with_testing, tuple(self._langs))
+		if settings != self._encodings_settings:
+			self._encodings = {}
+			self._encodings_settings = settings
+		old_encodings = self._encodings
+		new_encodings = {}	# (Iface URI, arch key) -> _IfaceEncoding
+		encoding_for_iface = {}	# Iface -> _IfaceEncoding
+		arch_keys = {}		# Arch -> key
+
 		problem = sat.SATProblem()
 
 		impl_to_var = {}	# Impl -> sat var
@@ -271,20 +362,25 @@ class SATSolver(Solver):
 		#   matching 'dependency' must also be selected.
 		# If dependency is optional:
 		#   Require that no incompatible version is selected.
-		def find_dependency_candidates(requiring_impl_var, dependency):
-			def meets_restrictions(candidate):
-				for r in dependency.restrictions:
-					if not r.meets_restriction(candidate):
-						#warn("%s rejected due to %s", candidate.get_version(), r)
-						return False
-				return True
-
+		# requiring_encoding is the encoding of the interface with the dependency; the
+		# candidates which meet the restrictions are cached there for the next solve.
+		def find_dependency_candidates(requiring_impl_var, dependency, requiring_encoding):
 			essential = dependency.importance == model.Dependency.Essential
 
 			dep_iface = iface_cache.get_interface(dependency.interface)
+			dep_encoding = encoding_for_iface[dep_iface]
+			restrictions_key = _restrictions_key(dependency.restrictions)
+			cached = requiring_encoding.matching.get(dependency, None)
+			if cached is not None and cached[0] is dep_encoding and restrictions_key is not None and cached[1] == restrictions_key:
+				matching = cached[2]
+			else:
+				matching = dep_encoding.get_meeting(dependency.restrictions)
+				requiring_encoding.matching[dependency] = (dep_encoding, restrictions_key, matching)
+
+			label = ('requires', requiring_impl_var, dependency)	# (see describe_conflict)
 			dep_union = [sat.neg(requiring_impl_var)]	# Either requiring_impl_var is False, or ...
 			for candidate in impls_for_iface[dep_iface]:
-				if (candidate.__class__ is _DummyImpl) or meets_restrictions(candidate):
+				if (candidate.__class__ is _DummyImpl) or candidate in matching:
 					if essential:
 						c_var = impl_to_var.get(candidate, None)
 						if c_var is not None:
@@ -299,11 +395,11 @@ class SATSolver(Solver):
 					if not essential:
 						c_var = impl_to_var.get(candidate, None)
 						if c_var is not None:
-							problem.add_clause(dep_union + [sat.neg(c_var)])
+							problem.add_clause(dep_union + [sat.neg(c_var)], label)
 						# else we filtered that version out, so ignore it
 
 			if essential:
-				problem.add_clause(dep_union)
+				problem.add_clause(dep_union, label)
 
 		def is_unusable(impl, restrictions, arch):
 			"""@return: whether this implementation is unusable.
@@ -324,7 +420,7 @@ class SATSolver(Solver):
 			stability = impl.get_stability()
 			if stability <= model.buggy:
 				return stability.name
-			if (self.config.network_use == model.network_offline or not impl.download_sources) and not impl.is_available(self.config.stores):
+			if (self.config.network_use == model.network_offline or not impl.download_sources) and not is_available(impl):
 				if not impl.download_sources:
 					return _("No retrieval methods")
 				return _("Not cached and we are off-line")
@@ -336,6 +432,14 @@ class SATSolver(Solver):
 				return _("Unsupported machine type")
 			return None
 
+		available = {}		# Impl -> bool
+		def is_available(impl):
+			"""Check whether impl is cached, looking in the stores only once per implementation."""
+			result = available.get(impl, None)
+			if result is None:
+				result = available[impl] = impl.is_available(self.config.stores)
+			return result
+
 		def usable_feeds(iface, arch):
 			"""Return all feeds for iface that support arch.
 			@rtype: generator(ZeroInstallFeed)"""
@@ -350,6 +454,12 @@ class SATSolver(Solver):
 					debug(_("Skipping '%(feed)s'; unsupported architecture %(os)s-%(machine)s"),
 						{'feed': f, 'os': f.os, 'machine': f.machine})
 
+		def get_arch_key(arch):
+			key = arch_keys.get(arch, None)
+			if key is None:
+				key = arch_keys[arch] = (frozenset(arch.os_ranks.items()), frozenset(arch.machine_ranks.items()), arch.use)
+			return key
+
 		def add_iface(uri, arch):
 			"""Name implementations from feed and assert that only one can be selected."""
 			if uri in ifaces_processed: return
@@ -358,6 +468,7 @@ class SATSolver(Solver):
 			iface = iface_cache.get_interface(uri)
 
 			impls = []
+			feeds = []
 			for f in usable_feeds(iface, arch):
 				self.feeds_used.add(f)
 				debug(_("Processing feed %s"), f)
@@ -370,6 +481,7 @@ class SATSolver(Solver):
 
 					if feed.implementations:
 						impls.extend(feed.implementations.values())
+					feeds.append(feed)
 
 					distro_feed_url = feed.get_distro_feed()
 					if distro_feed_url:
@@ -377,6 +489,7 @@ class SATSolver(Solver):
 						distro_feed = iface_cache.get_feed(distro_feed_url)
 						if distro_feed.implementations:
 							impls.extend(distro_feed.implementations.values())
+						feeds.append(distro_feed)
 				except MissingLocalFeed as ex:
 					warn(_("Missing local feed; if it's no longer required, remove it with:") +
 							'\n0install remove-feed ' + iface.uri + ' ' + f,
@@ -385,39 +498,53 @@ class SATSolver(Solver):
 					warn(_("Failed to load feed %(feed)s for %(interface)s: %(exception)s"), {'feed': f, 'interface': iface, 'exception': ex})
 					#raise
 
-			impls.sort(lambda a, b: self.compare(iface, a, b, arch))
+			my_extra_restrictions = self.extra_restrictions.get(iface, [])
 
-			impls_for_iface[iface] = filtered_impls = []
+			# If none of the feeds, implementations or preferences have changed since the
+			# last solve, the implementations will be ranked and filtered in the same way.
+			arch_key = get_arch_key(arch)
+			stability_policy = iface.stability_policy
+			restrictions_key = _restrictions_key(my_extra_restrictions)
+			inputs = (stability_policy and stability_policy.level, restrictions_key, tuple(feeds),
+				  tuple([(impl.get_stability().level, impl.version, impl.os, impl.machine, impl.langs,
+					  tuple(impl.requires), bool(impl.download_sources), is_available(impl)) for impl in impls]))
+			encoding = old_encodings.get((uri, arch_key), None)
+			if encoding is None or encoding.inputs != inputs:
+				impls.sort(key = lambda impl: self.get_rank_key(iface, impl, arch, is_available), reverse = True)
+				ranked = [(impl, get_unusable_reason(impl, my_extra_restrictions, arch)) for impl in impls]
+				infos = [ImplInfo(iface, impl, arch, deps = list(deps_in_use(impl, arch)))
+					 for impl, reason in ranked if reason is None]
+				encoding = _IfaceEncoding(inputs, ranked, infos)
+			else:
+				debug(_("Reusing implementations of %s from last solve"), uri)
+			if restrictions_key is not None:
+				new_encodings[(uri, arch_key)] = encoding
+			encoding_for_iface[iface] = encoding
 
-			my_extra_restrictions = self.extra_restrictions.get(iface, [])
+			impls_for_iface[iface] = filtered_impls = [info.impl for info in encoding.infos]
 
 			if self.record_details:
-				self.details[iface] = [(impl, get_unusable_reason(impl, my_extra_restrictions, arch)) for impl in impls]
+				self.details[iface] = list(encoding.ranked)
 
-			rank = 1
 			var_names = []
-			for impl in impls:
-				if is_unusable(impl, my_extra_restrictions, arch):
-					continue
-
-				filtered_impls.append(impl)
+			for impl_info in encoding.infos:
+				impl = impl_info.impl
 
 				assert impl not in impl_to_var
-				v = problem.add_variable(ImplInfo(iface, impl, arch))
+				v = problem.add_variable(impl_info)
 				impl_to_var[impl] = v
-				rank += 1
 				var_names.append(v)
 
 				if impl.machine and impl.machine != 'src':
 					impls_for_machine_group[machine_groups.get(impl.machine, 0)].append(v)
 
-				for d in deps_in_use(impl, arch):
+				for d in impl_info.deps:
 					debug(_("Considering dependency %s"), d)
 
 					add_iface(d.interface, arch.child_arch)
 
 					# Must choose one version of d if impl is selected
-					find_dependency_candidates(v, d)
+					find_dependency_candidates(v, d, encoding)
 
 			if closest_match:
 				dummy_impl = _DummyImpl()
@@ -429,13 +556,13 @@ class SATSolver(Solver):
 			# Only one implementation of this interface can be selected
 			if uri == root_interface:
 				if var_names:
-					clause = problem.at_most_one(var_names)
-					problem.add_clause(var_names)	# at least one
+					clause = problem.at_most_one(var_names, ('one-of', uri))
+					problem.add_clause(var_names, ('root', uri, None))	# at least one
 				else:
-					problem.impossible()
+					problem.impossible(('root', uri, None))
 					clause = False
 			elif var_names:
-				clause = problem.at_most_one(var_names)
+				clause = problem.at_most_one(var_names, ('one-of', uri))
 			else:
 				# Don't need to add to group_clause_for because we should
 				# never get a possible selection involving this.
@@ -464,6 +591,7 @@ class SATSolver(Solver):
 
 			iface = iface_cache.get_interface(uri)
 			filtered_impls = impls_for_iface[iface]
+			encoding = encoding_for_iface[iface]
 
 			var_names = []
 			for impl in filtered_impls:
@@ -471,7 +599,7 @@ class SATSolver(Solver):
 				if not command:
 					if not isinstance(impl, _DummyImpl):
 						# Mark implementation as unselectable
-						problem.add_clause([sat.neg(impl_to_var[impl])])
+						problem.add_clause([sat.neg(impl_to_var[impl])], ('no-command', impl_to_var[impl], command_name))
 					continue
 
 				# We have a candidate <command>. Require that if it's selected
@@ -492,13 +620,13 @@ class SATSolver(Solver):
 
 						# If the parent command is chosen, one of the candidate runner commands
 						# must be too. If there aren't any, then this command is unselectable.
-						problem.add_clause([sat.neg(command_var)] + runner_vars)
+						problem.add_clause([sat.neg(command_var)] + runner_vars, ('requires', command_var, d))
 					else:
 						debug(_("Considering command dependency %s"), d)
 						add_iface(d.interface, arch.child_arch)
 
 					# Must choose one version of d if impl is selected
-					find_dependency_candidates(command_var, d)
+					find_dependency_candidates(command_var, d, encoding)
 
 			# Tell the user why we couldn't use this version
 			if self.record_details:
@@ -525,7 +653,7 @@ class SATSolver(Solver):
 			commands = add_command_iface(root_interface, root_arch, command_name)
 			if len(commands) > int(closest_match):
 				# (we have at least one non-dummy command)
-				problem.add_clause(commands)		# At least one
+				problem.add_clause(commands, ('root', root_interface, command_name))		# At least one
 			else:
 				# (note: might be because we haven't cached it yet)
 				info("No %s <command> in %s", command_name, root_interface)
@@ -551,10 +679,10 @@ class SATSolver(Solver):
 			group_var = problem.add_variable(m_group)
 			if impls:
 				for impl in impls:
-					problem.add_clause([group_var, sat.neg(impl)])
+					problem.add_clause([group_var, sat.neg(impl)], ('machine-groups',))
 			m_groups.append(group_var)
 		if m_groups:
-			m_groups_clause = problem.at_most_one(m_groups)
+			m_groups_clause = problem.at_most_one(m_groups, ('machine-groups',))
 		else:
 			m_groups_clause = None
 
@@ -562,9 +690,9 @@ class SATSolver(Solver):
 			"""Recurse through the current selections until we get to an interface with
 			no chosen version, then tell the solver to try the best version from that."""
 
-			def find_undecided_dep(impl_or_command, arch):
-				# Check for undecided dependencies of impl_or_command
-				for dep in deps_in_use(impl_or_command, arch):
+			def find_undecided_dep(deps):
+				# Check for undecided dependencies of an implementation or command
+				for dep in deps:
 					if dep.qdom.name == 'runner':
 						dep_lit = find_undecided_command(dep.interface, _get_command_name(dep))
 					else:
@@ -588,7 +716,7 @@ class SATSolver(Solver):
 
 				# Check for undecided dependencies
 				lit_info = problem.get_varinfo_for_lit(lit).obj
-				return find_undecided_dep(lit_info.impl, lit_info.arch)
+				return find_undecided_dep(lit_info.deps)
 
 			def find_undecided_command(uri, name):
 				if name is None: return find_undecided(uri)
@@ -605,8 +733,8 @@ class SATSolver(Solver):
 				if lit_info is None:
 					assert closest_match
 					return None	# (a dummy command added for better diagnostics; has no dependencies)
-				return find_undecided_dep(lit_info.command, lit_info.arch) or \
-				       find_undecided_dep(lit_info.impl, lit_info.arch)
+				return find_undecided_dep(deps_in_use(lit_info.command, lit_info.arch)) or \
+				       find_undecided_dep(problem.assigns[impl_to_var[lit_info.impl]].obj.deps)
 
 			best = find_undecided_command(root_interface, command_name)
 			if best is not None:
@@ -622,13 +750,97 @@ class SATSolver(Solver):
 
 			return None			# Failed to find any valid combination
 
+		def describe_conflict(labels):
+			"""Explain why the solve failed, given the labels of the clauses
+			which conflicted (see L{sat.SATProblem.explain_failure})."""
+			def impl_for_var(var):
+				return problem.assigns[var].obj.impl
+
+			def iface_for_var(var):
+				info = problem.assigns[var].obj
+				if isinstance(info, CommandInfo):
+					info = problem.assigns[impl_to_var[info.impl]].obj
+				return info.iface.uri
+
+			def format_versions(impls):
+				return ', '.join([impl.get_version() for impl in sorted(impls, key = lambda impl: impl.version)])
+
+			def usable_versions(uri):
+				impls = impls_for_iface.get(iface_cache.get_interface(uri), [])
+				if impls:
+					return _("usable versions: %s") % format_versions(set(impls))
+				return _("no usable versions")
+
+			groups = {}		# Key -> [Implementation]
+			keys = []		# Keys in the order found
+			for label in labels:
+				kind = label[0]
+				if kind == 'requires':
+					var, dependency = label[1:]
+					key = (kind, iface_for_var(var), dependency.interface,
+					       dependency.importance == model.Dependency.Essential,
+					       tuple([str(r) for r in dependency.restrictions]))
+				elif kind == 'no-command':
+					var, name = label[1:]
+					key = (kind, iface_for_var(var), name)
+				else:
+					var = None
+					key = label
+				if key not in groups:
+					groups[key] = []
+					keys.append(key)
+				if var is not None:
+					groups[key].append(impl_for_var(var))
+
+			# What we were asked for first, then the requirements, then the general rules
+			order = ['root', 'no-command', 'requires', 'one-of', 'machine-groups']
+			keys.sort(key = lambda key: order.index(key[0]))
+
+			lines = []
+			for key in keys:
+				kind = key[0]
+				if kind == 'requires':
+					uri, dep_uri, essential, restrictions = key[1:]
+					info = {'interface': uri, 'versions': format_versions(set(groups[key])),
+						'dependency': ' '.join((dep_uri,) + restrictions), 'usable': usable_versions(dep_uri)}
+					if essential:
+						lines.append(_("%(interface)s %(versions)s requires %(dependency)s (%(usable)s)") % info)
+					else:
+						lines.append(_("%(interface)s %(versions)s can only be used with %(dependency)s (%(usable)s)") % info)
+				elif kind == 'no-command':
+					uri, name = key[1:]
+					lines.append(_("%(interface)s %(versions)s has no '%(command)s' command") %
+							{'interface': uri, 'versions': format_versions(set(groups[key])), 'command': name})
+				elif kind == 'root':
+					uri, name = key[1:]
+					if name is None:
+						lines.append(_("%(interface)s must be selected (%(usable)s)") %
+								{'interface': uri, 'usable': usable_versions(uri)})
+					else:
+						lines.append(_("%(interface)s must be selected with a '%(command)s' command (%(usable)s)") %
+								{'interface': uri, 'command': name, 'usable': usable_versions(uri)})
+				elif kind == 'one-of':
+					lines.append(_("only one version of %s can be selected") % key[1])
+				elif kind == 'machine-groups':
+					lines.append(_("implementations for different processor types (e.g. 32-bit and 64-bit) can't be mixed"))
+				else:
+					assert 0, key
+
+			return _("Can't find all required implementations:") + '\n' + \
+				'\n'.join(["- " + line for line in lines])
+
+		self._encodings = new_encodings
+
 		ready = problem.run_solver(decide) is True
 
 		if not ready and not closest_match:
-			# We failed while trying to do a real solve.
-			# Try a closest match solve to get a better
-			# error report for the user.
-			self.solve(root_interface, root_arch, command_name = command_name, closest_match = True)
+			# We failed while trying to do a real solve. Explain why from the
+			# clauses which conflicted. The closest match solve, which shows the
+			# user what we could select, is only done if the selections are
+			# wanted (see _get_selections).
+			if self._failure_reason is None:
+				self._failure_reason = describe_conflict(problem.explain_failure())
+			self._closest_match_args = (root_interface, root_arch, command_name)
 		else:
 			self.ready = ready and not closest_match
 			self.selections = selections.Selections(None)
@@ -644,10 +856,8 @@ class SATSolver(Solver):
 					else:
 						impl = lit_info.impl
 
-						deps = self.requires[lit_info.iface] = []
-						for dep in deps_in_use(lit_info.impl, lit_info.arch):
-							deps.append(dep)
-	
+						deps = self.requires[lit_info.iface] = list(lit_info.deps)
+
 						sels[lit_info.iface.uri] = selections.ImplSelection(lit_info.iface.uri, impl, deps)
 
 			def add_command(iface, name):
@@ -6,7 +6,7 @@ Code for managing the implementation cache.
 # See the README file for details, or visit http://0install.net.
 
 from zeroinstall import _
-import os
+import os, time
 from logging import debug, info, warn
 
 from zeroinstall.support import basedir
@@ -50,6 +50,8 @@ class Store:
 		@param public: deprecated
 		@type public: bool"""
 		self.dir = dir
+		self._contents = None		# Names in self.dir, from the last listing
+		self._contents_mtime = None	# mtime of self.dir at the time of that listing
 	
 	def __str__(self):
 		return _("Store '%s'") % self.dir
@@ -64,10 +66,39 @@ class Store:
 			assert value not in ('', '.', '..')
 		except ValueError as ex:
 			raise BadDigest(_("Bad value for digest: %s") % str(ex))
+		return self._lookup(digest, self._get_contents())
+
+	def _lookup(self, digest, contents):
+		"""Find digest in this store, using a listing from L{_get_contents}."""
 		dir = os.path.join(self.dir, digest)
-		if os.path.isdir(dir):
+		if contents is None:
+			if os.path.isdir(dir):
+				return dir
+		elif digest in contents:
 			return dir
 		return None
+
+	def _get_contents(self):
+		"""Get the names of the items in this store. The directory is only listed again
+		if its mtime has changed since last time.
+		@return: the names, or None if we can't trust a listing (so check each item directly)
+		@rtype: set(str) | None"""
+		try:
+			mtime = os.stat(self.dir).st_mtime
+		except OSError:
+			return set()		# (store doesn't exist yet)
+		if mtime != self._contents_mtime:
+			if abs(time.time() - mtime) < 2:
+				# Changed very recently. The mtime may not change again if something
+				# else is added within the same second, so don't cache this yet.
+				return None
+			try:
+				self._contents = set(os.listdir(self.dir))
+			except OSError as ex:
+				info(_("Can't list %(store)s: %(exception)s"), {'store': self.dir, 'exception': ex})
+				return None
+			self._contents_mtime = mtime
+		return self._contents
 	
 	def get_tmp_dir_for(self, required_digest):
 		"""Create a temporary directory in the directory where we would store an implementation
@@ -93,16 +124,18 @@ class Store:
 			info(_("Not adding %s as it already exists!"), required_digest)
 			return
 
+		from . import manifest
+		alg = manifest.splitID(required_digest)[0]
+
 		tmp = self.get_tmp_dir_for(required_digest)
 		try:
-			unpack.unpack_archive(url, data, tmp, extract, type = type, start_offset = start_offset)
+			builder = unpack.unpack_archive_with_manifest(url, data, tmp, alg, extract, type = type, start_offset = start_offset)
 		except:
-			import shutil
-			shutil.rmtree(tmp)
+			support.ro_rmtree(tmp)
 			raise
 
 		try:
-			self.check_manifest_and_rename(required_digest, tmp, extract, try_helper = try_helper)
+			self.check_manifest_and_rename(required_digest, tmp, extract, try_helper = try_helper, builder = builder)
 		except Exception:
 			#warn(_("Leaving extracted directory as %s"), tmp)
 			support.ro_rmtree(tmp)
@@ -167,12 +200,14 @@ class Store:
 		info(_("Added succcessfully."))
 		return True
 
-	def check_manifest_and_rename(self, required_digest, tmp, extract = None, try_helper = False):
+	def check_manifest_and_rename(self, required_digest, tmp, extract = None, try_helper = False, builder = None):
 		"""Check that tmp[/extract] has the required_digest.
 		On success, rename the checked directory to the digest, and
 		make the whole tree read-only.
 		@param try_helper: attempt to use privileged helper to import to system cache first (since 0.26)
 		@type try_helper: bool
+		@param builder: details of the tree recorded while unpacking it, so it doesn't have to be read again (since 1.1)
+		@type builder: L{manifest.ManifestBuilder} | None
 		@raise BadDigest: if the input directory doesn't match the given digest"""
 		if extract:
 			extracted = os.path.join(tmp, extract)
@@ -183,10 +218,22 @@ class Store:
 
 		from . import manifest
 
-		manifest.fixup_permissions(extracted)
-
 		alg, required_value = manifest.splitID(required_digest)
-		actual_digest = alg.getID(manifest.add_manifest_file(extracted, alg))
+
+		if builder is not None:
+			builder.fixup_permissions(extracted)
+			actual_digest = alg.getID(manifest.add_manifest_file(extracted, alg, builder))
+			if actual_digest != required_digest:
+				# Probably a corrupted archive, but check the tree itself to be sure
+				info(_("Digest of unpacked files is %s; checking directory contents"), actual_digest)
+				os.chmod(extracted, 0o755)
+				os.unlink(os.path.join(extracted, '.manifest'))
+				builder = None
+
+		if builder is None:
+			manifest.fixup_permissions(extracted)
+			actual_digest = alg.getID(manifest.add_manifest_file(extracted, alg))
+
 		if actual_digest != required_digest:
 			raise BadDigest(_('Incorrect manifest -- archive is corrupted.\n'
 					'Required digest: %(required_digest)s\n'
@@ -269,12 +316,15 @@ class Stores(object):
 		"""Like lookup_any, but return None if it isn't found.
 		@since: 0.53"""
 		assert digests
+		contents = {}		# Store -> listing (each store is checked once per call)
 		for digest in digests:
 			assert digest
 			if '/' in digest or '=' not in digest:
 				raise BadDigest(_('Syntax error in digest (use ALG=VALUE, not %s)') % digest)
 			for store in self.stores:
-				path = store.lookup(digest)
+				if store not in contents:
+					contents[store] = store._get_contents()
+				path = store._lookup(digest, contents[store])
 				if path:
 					return path
 		return None
@@ -111,8 +111,25 @@ def do_optimise(args):
 		print _("Space freed up : %(size)s (%(percentage).2f%%)") % {'size': support.pretty_size(dup_size), 'percentage': perc}
 	print _("Optimisation complete.")
 
+def _parse_quick(args):
+	"""Remove a leading --quick option from args.
+	@return: whether it was present"""
+	if args and args[0] == '--quick':
+		del args[0]
+		return True
+	return False
+
+def _report_skipped(skipped_files, skipped_bytes, time_saved):
+	"""Tell the user how much work --quick saved."""
+	print _("Skipped %(files)d unchanged files (%(size)s)") % {'files': skipped_files, 'size': support.pretty_size(skipped_bytes)},
+	if time_saved is not None:
+		print _("(saved about %.1f seconds)") % time_saved
+	else:
+		print
+
 def do_verify(args):
-	"""verify (DIGEST | (DIRECTORY [DIGEST])"""
+	"""verify [--quick] (DIGEST | (DIRECTORY [DIGEST])"""
+	quick = _parse_quick(args)
 	if len(args) == 2:
 		required_digest = args[1]
 		root = args[0]
@@ -124,8 +141,10 @@ def do_verify(args):
 
 	print _("Verifying"), root
 	try:
-		verify(root, required_digest)
+		index = verify(root, required_digest, quick = quick)
 		print _("OK")
+		if index is not None:
+			_report_skipped(index.skipped_files, index.skipped_bytes, index.get_time_saved())
 	except zerostore.BadDigest as ex:
 		print str(ex)
 		if ex.detail:
@@ -134,7 +153,8 @@ def do_verify(args):
 			sys.exit(1)
 
 def do_audit(args):
-	"""audit [DIRECTORY]"""
+	"""audit [--quick] [DIRECTORY]"""
+	quick = _parse_quick(args)
 	if len(args) == 0:
 		audit_stores = stores.stores
 	else:
@@ -153,6 +173,8 @@ def do_audit(args):
 	verified = 0
 	failures = []
 	i = 0
+	skipped_files = skipped_bytes = 0
+	time_saved = 0.0
 	for root, impls in audit_ls:
 		print _("Scanning %s") % root
 		for required_digest in impls:
@@ -165,7 +187,17 @@ def do_audit(args):
 				msg = _("[%(done)d / %(total)d] Verifying %(digest)s") % {'done': i, 'total': total, 'digest': required_digest}
 				print msg,
 				sys.stdout.flush()
-				verify(path, required_digest)
+				index = verify(path, required_digest, quick = quick)
+				if index is not None:
+					skipped_files += index.skipped_files
+					skipped_bytes += index.skipped_bytes
+					if time_saved is not None:
+						item_time_saved = index.get_time_saved()
+						if item_time_saved is None:
+							if index.skipped_files:
+								time_saved = None	# (unknown)
+						else:
+							time_saved += item_time_saved
 				print "\r" + (" " * len(msg)) + "\r",
 				verified += 1
 			except zerostore.BadDigest as ex:
@@ -183,6 +215,8 @@ def do_audit(args):
 	print _("Checked %d items") % i
 	print _("Successfully verified implementations: %d") % verified
 	print _("Corrupted or modified implementations: %d") % len(failures)
+	if quick:
+		_report_skipped(skipped_files, skipped_bytes, time_saved)
 	if failures:
 		sys.exit(1)
 
@@ -25,7 +25,8 @@ A top-level ".manifest" file is ignored.
 # See the README file for details, or visit http://0install.net.
 
 
-import os, stat
+import os, stat, time
+from collections import deque
 from zeroinstall import SafeException, _
 from zeroinstall.zerostore import BadDigest
 
@@ -93,7 +94,7 @@ class OldSHA1(Algorithm):
 			assert sub[1:]
 			leaf = os.path.basename(sub[1:])
 			if stat.S_ISREG(m):
-				d = sha1_new(file(full).read()).hexdigest()
+				d = _digest_file(sha1_new, full)
 				if m & 0o111:
 					yield "X %s %s %s %s" % (d, int(info.st_mtime) ,info.st_size, leaf)
 				else:
@@ -127,13 +128,15 @@ def generate_manifest(root, alg = 'sha1'):
 	"""@deprecated: use L{get_algorithm} and L{Algorithm.generate_manifest} instead."""
 	return get_algorithm(alg).generate_manifest(root)
 	
-def add_manifest_file(dir, digest_or_alg):
+def add_manifest_file(dir, digest_or_alg, builder = None):
 	"""Writes a .manifest file into 'dir', and returns the digest.
 	You should call fixup_permissions before this to ensure that the permissions are correct.
 	On exit, dir itself has mode 555. Subdirectories are not changed.
 	@param dir: root of the implementation
 	@param digest_or_alg: should be an instance of Algorithm. Passing a digest
-	here is deprecated."""
+	here is deprecated.
+	@param builder: details of the tree recorded while it was written, used instead of walking it (since 1.1)
+	@type builder: L{ManifestBuilder}"""
 	mfile = os.path.join(dir, '.manifest')
 	if os.path.islink(mfile) or os.path.exists(mfile):
 		raise SafeException(_("Directory '%s' already contains a .manifest file!") % dir)
@@ -144,7 +147,12 @@ def add_manifest_file(dir, digest_or_alg):
 	else:
 		digest = digest_or_alg
 		alg = get_algorithm('sha1')
-	for line in alg.generate_manifest(dir):
+	if builder is None:
+		lines = alg.generate_manifest(dir)
+	else:
+		assert builder.alg is alg
+		lines = builder.generate_manifest()
+	for line in lines:
 		manifest += line + '\n'
 	digest.update(manifest)
 
@@ -184,7 +192,7 @@ def copy_with_verify(src, dest, mode, alg, required_digest):
 	try:
 		digest = alg.new_digest()
 		while True:
-			data = src_obj.read(256)
+			data = src_obj.read(_chunk_size)
 			if not data: break
 			digest.update(data)
 			while data:
@@ -201,20 +209,129 @@ def copy_with_verify(src, dest, mode, alg, required_digest):
 			 "Expected: %(required_digest)s\n"
 			 "Actual:   %(actual_digest)s") % {'src': src, 'required_digest': required_digest, 'actual_digest': actual})
 
-def verify(root, required_digest = None):
+class VerifyIndex:
+	"""Records the digest of each file in an implementation, together with its
+	inode number, size, mtime and ctime. When verifying again, files whose details
+	haven't changed are not hashed again. This makes verification much faster, but
+	it will not detect corruption that doesn't change the metadata (e.g. disk errors).
+	The index is saved in the cache directory, in a file named after the path of the
+	implementation.
+	@ivar skipped_files: number of files whose previous digest was reused
+	@ivar skipped_bytes: total size of those files
+	@ivar hashed_files: number of files which were hashed
+	@ivar hashed_bytes: total size of those files
+	@since: 1.1"""
+
+	_format = 1
+
+	def __init__(self, root, alg):
+		"""Load the index for the implementation at root, if there is one.
+		@param alg: the algorithm being used (indexes for other algorithms are ignored)
+		@type alg: L{HashLibAlgorithm}"""
+		import hashlib
+		from zeroinstall.support import basedir
+		self.alg_name = alg.name
+		leaf = hashlib.sha1(os.path.realpath(root)).hexdigest()
+		self.path = os.path.join(basedir.save_cache_path('0install.net', 'verify-index'), leaf)
+
+		self.skipped_files = self.skipped_bytes = 0
+		self.hashed_files = self.hashed_bytes = 0
+		self._hash_time = 0.0
+
+		self._old = {}		# Relative path -> (ino, size, mtime, ctime, digest)
+		self._new = {}		# Details of the files found on this run
+		self._rate = None	# Bytes hashed per second (from a previous run)
+
+		if os.path.exists(self.path):
+			import cPickle
+			from logging import info
+			try:
+				stream = file(self.path, 'rb')
+				try:
+					format, alg_name, rate, files = cPickle.load(stream)
+				finally:
+					stream.close()
+				if format == self._format and alg_name == self.alg_name:
+					self._old = files
+					self._rate = rate
+			except Exception as ex:
+				info(_("Failed to load verification index %(path)s: %(exception)s"), {'path': self.path, 'exception': ex})
+
+	def lookup(self, rel, info):
+		"""Get the recorded digest for this file, if its metadata hasn't changed.
+		@param rel: path of the file, relative to the implementation root
+		@param info: the result of lstat on the file
+		@return: the hex digest, or None if the file must be hashed"""
+		key = (info.st_ino, info.st_size, info.st_mtime, info.st_ctime)
+		entry = self._old.get(rel, None)
+		if entry is None or entry[:4] != key:
+			return None
+		self._new[rel] = entry
+		self.skipped_files += 1
+		self.skipped_bytes += info.st_size
+		return entry[4]
+
+	def record(self, rel, info, hexdigest, elapsed):
+		"""Record the digest of a file which has just been hashed."""
+		self._new[rel] = (info.st_ino, info.st_size, info.st_mtime, info.st_ctime, hexdigest)
+		self.hashed_files += 1
+		self.hashed_bytes += info.st_size
+		self._hash_time += elapsed or 0
+
+	def get_time_saved(self):
+		"""Estimate how long it would have taken to hash the skipped files.
+		@return: the number of seconds, or None if we don't know how fast hashing is
+		@rtype: float | None"""
+		rate = self._get_rate()
+		if rate is None:
+			return None
+		return self.skipped_bytes / rate
+
+	def _get_rate(self):
+		if self.hashed_bytes >= 1024 * 1024 and self._hash_time > 0:
+			return self.hashed_bytes / self._hash_time
+		return self._rate
+
+	def save(self):
+		"""Save the details recorded during this run, replacing the old index."""
+		import cPickle, tempfile
+		tmp_fd, tmp_name = tempfile.mkstemp(dir = os.path.dirname(self.path), prefix = 'tmp-')
+		try:
+			stream = os.fdopen(tmp_fd, 'wb')
+			try:
+				cPickle.dump((self._format, self.alg_name, self._get_rate(), self._new), stream, cPickle.HIGHEST_PROTOCOL)
+			finally:
+				stream.close()
+			os.rename(tmp_name, self.path)
+		except:
+			os.unlink(tmp_name)
+			raise
+
+def verify(root, required_digest = None, quick = False):
 	"""Ensure that directory 'dir' generates the given digest.
 	For a non-error return:
 	 - Dir's name must be a digest (in the form "alg=value")
 	 - The calculated digest of the contents must match this name.
 	 - If there is a .manifest file, then its digest must also match.
+	@param quick: only hash files which have changed since the last successful quick verify (see L{VerifyIndex})
+	@type quick: bool
+	@return: the index used, if quick is set and the algorithm supports it
+	@rtype: L{VerifyIndex} | None
 	@raise BadDigest: if verification fails."""
 	if required_digest is None:
 		required_digest = os.path.basename(root)
 	alg = splitID(required_digest)[0]
 
+	if quick and isinstance(alg, HashLibAlgorithm):
+		index = VerifyIndex(root, alg)
+		manifest_lines = alg.generate_manifest(root, index)
+	else:
+		index = None
+		manifest_lines = alg.generate_manifest(root)
+
 	digest = alg.new_digest()
 	lines = []
-	for line in alg.generate_manifest(root):
+	for line in manifest_lines:
 		line += '\n'
 		digest.update(line)
 		lines.append(line)
@@ -229,7 +346,9 @@ def verify(root, required_digest = None):
 		manifest_digest = None
 
 	if required_digest == actual_digest == manifest_digest:
-		return
+		if index is not None:
+			index.save()
+		return index
 
 	error = BadDigest(_("Cached item does NOT verify."))
 	
@@ -419,6 +538,173 @@ def _copy_files(alg, wanted, source, target):
 		else:
 			raise SafeException(_("Unknown manifest type %(type)s for '%(path)s'") % {'type': type, 'path': path})
 
+# Files at least this big are hashed by a pool of worker threads (hashlib
+# releases the GIL while hashing, so this uses all the CPUs). Smaller files
+# are quicker to do directly.
+_parallel_threshold = 256 * 1024
+
+# Files are read and hashed this many bytes at a time.
+_chunk_size = 1024 * 1024
+
+# Maximum number of threads to use for hashing (None for one per CPU)
+max_workers = None
+
+def _get_n_workers():
+	if max_workers is not None:
+		return max_workers
+	try:
+		import multiprocessing
+		return multiprocessing.cpu_count()
+	except (ImportError, NotImplementedError):
+		return 1
+
+def _digest_file(new_digest, path):
+	"""Get the hex digest of the file at path, reading it in chunks."""
+	digest = new_digest()
+	stream = file(path)
+	try:
+		while True:
+			data = stream.read(_chunk_size)
+			if not data: break
+			digest.update(data)
+	finally:
+		stream.close()
+	return digest.hexdigest()
+
+class _DigestJob:
+	"""A file waiting to be hashed by a L{_DigestPool} worker."""
+	def __init__(self, path):
+		self.path = path
+		self.hexdigest = None
+		self.elapsed = None		# Time taken to hash the file
+		self.exc_info = None
+		self.cancelled = False
+
+		import threading
+		self.done = threading.Event()
+
+	def get_hexdigest(self):
+		"""Wait for the job to finish and return the digest.
+		Exceptions from the worker are re-raised here."""
+		self.done.wait()
+		if self.exc_info:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+		return self.hexdigest
+
+class _DigestPool:
+	"""Some threads which hash files."""
+	def __init__(self, new_digest, n_workers):
+		import threading, Queue
+		self.new_digest = new_digest
+		self.queue = Queue.Queue()
+		self.threads = []
+		for i in range(n_workers):
+			thread = threading.Thread(target = self._work)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def _work(self):
+		import sys
+		while True:
+			job = self.queue.get()
+			if job is None:
+				return
+			if not job.cancelled:
+				try:
+					start = time.time()
+					job.hexdigest = _digest_file(self.new_digest, job.path)
+					job.elapsed = time.time() - start
+				except:
+					job.exc_info = sys.exc_info()
+			job.done.set()
+
+	def add(self, path):
+		job = _DigestJob(path)
+		self.queue.put(job)
+		return job
+
+	def close(self):
+		for thread in self.threads:
+			self.queue.put(None)
+
+def _add_digests(entries, new_digest, index = None):
+	"""Turn the output of a tree walk into manifest lines.
+	Each entry is either a finished line, or a tuple (type, path, info, leaf, rel)
+	for a regular file that needs to be hashed. Large files are hashed in parallel,
+	but the lines are generated in the same order as the entries.
+	@param index: digests of files hashed previously, which are reused if the file is unchanged
+	@type index: L{VerifyIndex} | None"""
+	n_workers = _get_n_workers()
+	max_pending = n_workers * 4	# Don't get too far ahead of the consumer
+
+	pool = None
+	pending = deque()		# (line or (job, type, info, leaf, rel)) in order
+	n_jobs = 0			# Number of jobs in pending
+
+	def make_line(type, d, info, leaf):
+		return "%s %s %s %s %s" % (type, d, int(info.st_mtime), info.st_size, leaf)
+
+	def resolve(item):
+		if not isinstance(item, tuple):
+			return item
+		job, type, info, leaf, rel = item
+		d = job.get_hexdigest()
+		if index is not None:
+			index.record(rel, info, d, job.elapsed)
+		return make_line(type, d, info, leaf)
+
+	try:
+		for entry in entries:
+			if not isinstance(entry, tuple):
+				if pending:
+					pending.append(entry)
+				else:
+					yield entry
+				continue
+
+			type, path, info, leaf, rel = entry
+			d = None
+			if index is not None:
+				d = index.lookup(rel, info)
+			if d is None and (info.st_size < _parallel_threshold or n_workers < 2):
+				start = time.time()
+				d = _digest_file(new_digest, path)
+				if index is not None:
+					index.record(rel, info, d, time.time() - start)
+			if d is not None:
+				line = make_line(type, d, info, leaf)
+				if pending:
+					pending.append(line)
+				else:
+					yield line
+				continue
+
+			if pool is None:
+				pool = _DigestPool(new_digest, n_workers)
+			pending.append((pool.add(path), type, info, leaf, rel))
+			n_jobs += 1
+
+			# Output everything up to the oldest unfinished job.
+			# If too many jobs are outstanding, wait for it.
+			while pending:
+				item = pending[0]
+				if isinstance(item, tuple):
+					if n_jobs <= max_pending and not item[0].done.isSet():
+						break
+					n_jobs -= 1
+				pending.popleft()
+				yield resolve(item)
+
+		while pending:
+			yield resolve(pending.popleft())
+	finally:
+		if pool is not None:
+			for item in pending:
+				if isinstance(item, tuple):
+					item[0].cancelled = True
+			pool.close()
+
 class HashLibAlgorithm(Algorithm):
 	new_digest = None		# Constructor for digest objects
 
@@ -431,7 +717,11 @@ class HashLibAlgorithm(Algorithm):
 			self.name = name
 		self.rating = rating
 
-	def generate_manifest(self, root):
+	def generate_manifest(self, root, index = None):
+		"""@param index: reuse digests of unchanged files from here, and record new ones
+		@type index: L{VerifyIndex} | None"""
+		new_digest = self.new_digest
+
 		def recurse(sub):
 			# To ensure that a line-by-line comparison of the manifests
 			# is possible, we require that filenames don't contain newlines.
@@ -442,7 +732,6 @@ class HashLibAlgorithm(Algorithm):
 
 			full = os.path.join(root, sub[1:])
 			info = os.lstat(full)
-			new_digest = self.new_digest
 			
 			m = info.st_mode
 			if not stat.S_ISDIR(m): raise Exception(_('Not a directory: "%s"') % full)
@@ -459,11 +748,12 @@ class HashLibAlgorithm(Algorithm):
 				if stat.S_ISREG(m):
 					if leaf == '.manifest': continue
 
-					d = new_digest(file(path).read()).hexdigest()
+					# (the digest is added by _add_digests)
+					rel = sub.rstrip('/') + '/' + leaf
 					if m & 0o111:
-						yield "X %s %s %s %s" % (d, int(info.st_mtime), info.st_size, leaf)
+						yield ("X", path, info, leaf, rel)
 					else:
-						yield "F %s %s %s %s" % (d, int(info.st_mtime), info.st_size, leaf)
+						yield ("F", path, info, leaf, rel)
 				elif stat.S_ISLNK(m):
 					target = os.readlink(path)
 					d = new_digest(target).hexdigest()
@@ -483,7 +773,7 @@ class HashLibAlgorithm(Algorithm):
 				for y in recurse(sub + x): yield y
 			return
 
-		for x in recurse('/'): yield x
+		return _add_digests(recurse('/'), new_digest, index)
 
 	def getID(self, digest):
 		return self.name + '=' + digest.hexdigest()
@@ -516,3 +806,89 @@ def fixup_permissions(root):
 				os.chmod(full, 0o555)
 			else:
 				os.chmod(full, 0o444)
+
+class ManifestBuilder:
+	"""Records the details of a tree while it is being written (e.g. while unpacking
+	an archive), so that its manifest can be generated afterwards without walking the
+	tree and reading every file back again. The lines are the same as
+	L{HashLibAlgorithm.generate_manifest} would produce for the finished tree.
+	Paths are relative to the root of the tree, using '/' as the separator.
+	@ivar alg: the algorithm used to digest the files
+	@type alg: L{HashLibAlgorithm}
+	@since: 1.1"""
+
+	def __init__(self, alg):
+		assert isinstance(alg, HashLibAlgorithm), alg
+		self.alg = alg
+		self._dirs = {'': {}}		# Relative path -> {leaf: manifest line, or None for a subdirectory}
+
+	def _get_dir(self, rel):
+		"""Get the contents of directory rel, adding it (and its parents) if it's new."""
+		contents = self._dirs.get(rel, None)
+		if contents is None:
+			if '\n' in rel: raise BadDigest(_("Newline in filename '%s'") % ('/' + rel))
+			parent, leaf = _split_path(rel)
+			parent_contents = self._get_dir(parent)
+			if parent_contents.get(leaf, None) is not None:
+				raise SafeException(_("'%s' is not a directory") % rel)
+			parent_contents[leaf] = None
+			contents = self._dirs[rel] = {}
+		return contents
+
+	def _add(self, rel, line):
+		parent, leaf = _split_path(rel)
+		contents = self._get_dir(parent)
+		if leaf in contents and contents[leaf] is None:
+			raise SafeException(_("'%s' is a directory") % rel)
+		contents[leaf] = line + leaf
+
+	def add_dir(self, rel):
+		"""Record a directory (its parents are added automatically)."""
+		self._get_dir(rel)
+
+	def add_file(self, rel, hexdigest, info):
+		"""Record a regular file, replacing any previous entry with the same name.
+		@param hexdigest: the digest of the file's contents, made with L{alg}
+		@param info: the result of lstat on the finished file (after setting its permissions and mtime)"""
+		if info.st_mode & 0o111:
+			type = 'X'
+		else:
+			type = 'F'
+		self._add(rel, "%s %s %s %s " % (type, hexdigest, int(info.st_mtime), info.st_size))
+
+	def add_symlink(self, rel, target):
+		"""Record a symlink, replacing any previous entry with the same name."""
+		d = self.alg.new_digest(target).hexdigest()
+		self._add(rel, "S %s %s " % (d, len(target)))
+
+	def fixup_permissions(self, root):
+		"""Make the recorded directories under root read-only. This does the same as
+		L{fixup_permissions} for a tree whose files were given their final permissions
+		when they were written."""
+		for rel in self._dirs:
+			os.chmod(os.path.join(root, rel), 0o555)
+
+	def generate_manifest(self):
+		"""Returns an iterator that yields each line of the manifest."""
+		def recurse(rel):
+			if rel:
+				yield "D /" + rel
+			contents = self._dirs[rel]
+			dirs = []
+			for leaf in sorted(contents):
+				line = contents[leaf]
+				if line is None:
+					dirs.append(leaf)
+				elif leaf == '.manifest' and line[0] != 'S':
+					continue
+				else:
+					yield line
+			for leaf in dirs:
+				for y in recurse(rel and rel + '/' + leaf or leaf): yield y
+		return recurse('')
+
+def _split_path(rel):
+	"""Split a relative path into its parent directory and leaf ('' for the top level)."""
+	if '/' in rel:
+		return rel.rsplit('/', 1)
+	return '', rel
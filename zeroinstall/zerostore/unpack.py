@@ -4,7 +4,7 @@
 # See the README file for details, or visit http://0install.net.
 
 from zeroinstall import _
-import os, subprocess
+import os, subprocess, stat
 import shutil
 import glob
 import traceback
@@ -128,6 +128,20 @@ def check_type_ok(mime_type):
 		from zeroinstall import version
 		raise SafeException(_("Unsupported archive type '%(type)s' (for injector version %(version)s)") % {'type': mime_type, 'version': version})
 
+def _check_extract(extract):
+	if extract:
+		# Limit the characters we accept, to avoid sending dodgy
+		# strings to tar or unzip
+		if not re.match('^[a-zA-Z0-9][- _a-zA-Z0-9.]*$', extract):
+			raise SafeException(_('Illegal character in extract attribute'))
+
+def _find_decompressor(prog):
+	"""Find 'unlzma' or 'unxz' in $PATH, or use our own (slower) Python version."""
+	path = find_in_path(prog)
+	if not path:
+		path = os.path.abspath(os.path.join(os.path.dirname(__file__), '_' + prog))
+	return path
+
 def _exec_maybe_sandboxed(writable, prog, *args):
 	"""execlp prog, with (only) the 'writable' directory writable if sandboxing is available.
 	If no sandbox is available, run without a sandbox."""
@@ -234,6 +248,401 @@ def unpack_archive(url, data, destdir, extract = None, type = None, start_offset
 	else:
 		raise SafeException(_('Unknown MIME type "%(type)s" for "%(url)s"') % {'type': type, 'url': archive})
 
+# Compression used by each type of tar archive (for unpack_archive_with_manifest)
+_tar_types = {
+	'application/x-tar': None,
+	'application/x-compressed-tar': 'gzip',
+	'application/x-bzip-compressed-tar': 'bzip2',
+	'application/x-lzma-compressed-tar': 'lzma',
+	'application/x-xz-compressed-tar': 'xz',
+}
+
+# Files are read and written this many bytes at a time
+_chunk_size = 64 * 1024
+
+class _Unsupported(Exception):
+	"""The archive uses a feature that unpack_archive_with_manifest can't reproduce exactly."""
+
+def unpack_archive_with_manifest(url, data, destdir, alg, extract = None, type = None, start_offset = 0):
+	"""Like L{unpack_archive}, but tar and zip archives are unpacked using Python's
+	tarfile and zipfile modules. Each file is hashed and given its final (read-only)
+	permissions as it is written, and the details are recorded so that the manifest
+	can be generated without reading the tree back from disk. The result is exactly
+	the same as unpacking with L{unpack_archive} and then using
+	L{manifest.fixup_permissions} and L{manifest.add_manifest_file}.
+	Other types of archive (and archives using features which we can't reproduce
+	exactly this way) are unpacked with L{unpack_archive}, and None is returned.
+	@param destdir: the directory to unpack into, which must be empty
+	@param alg: the algorithm that will be used for the manifest
+	@type alg: L{manifest.Algorithm}
+	@return: the details of destdir (or destdir/extract), for L{manifest.add_manifest_file}
+	@rtype: L{manifest.ManifestBuilder} | None
+	@since: 1.1"""
+	from zeroinstall.zerostore import manifest
+
+	if type is None: type = type_from_url(url)
+	if isinstance(alg, manifest.HashLibAlgorithm) and (type in _tar_types or type == 'application/zip'):
+		data.seek(start_offset)
+		builder = _unpack_with_manifest(url, data, destdir, alg, extract, type)
+		if builder is not None:
+			return builder
+
+	unpack_archive(url, data, destdir, extract, type, start_offset)
+	return None
+
+def can_stream(type, alg):
+	"""Check whether L{StreamUnpacker} can unpack archives of this type
+	(i.e. they can be unpacked in a single pass while reading them sequentially).
+	@param alg: the algorithm that will be used for the manifest
+	@type alg: L{manifest.Algorithm}
+	@since: 1.1"""
+	from zeroinstall.zerostore import manifest
+	return type in _tar_types and isinstance(alg, manifest.HashLibAlgorithm)
+
+class StreamUnpacker:
+	"""Unpacks a tar archive from a stream which can't seek, such as a pipe receiving
+	the data from a download which is still in progress. This is done in a separate
+	thread, and works like L{unpack_archive_with_manifest}. If the archive can't be
+	unpacked in a single pass, we stop reading the stream and leave destdir empty;
+	the caller should then unpack the complete archive with L{unpack_archive_with_manifest}.
+	If a GLib main loop runs while the thread is unpacking, call gobject.threads_init() first;
+	otherwise the main loop holds the GIL while it waits for events, and the thread is starved.
+	@ivar done: a file descriptor which becomes readable when the thread has finished
+	@type done: int
+	@since: 1.1"""
+
+	def __init__(self, url, stream, destdir, alg, extract = None, type = None):
+		"""Start unpacking stream into destdir, which must be empty.
+		The stream is closed when we have finished with it.
+		@see: L{can_stream}"""
+		import threading
+		if type is None: type = type_from_url(url)
+		assert can_stream(type, alg), type
+		self._result = None
+		self.done, self._done_w = os.pipe()
+		try:
+			import fcntl
+			fcntl.fcntl(self._done_w, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+		except ImportError:
+			pass
+		self._thread = threading.Thread(target = self._run, args = (url, stream, destdir, alg, extract, type))
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _run(self, *args):
+		import sys
+		stream = args[1]
+		try:
+			try:
+				self._result = (_unpack_with_manifest(*args), None)
+			except:
+				self._result = (None, sys.exc_info())
+		finally:
+			stream.close()
+			os.close(self._done_w)
+
+	def get_result(self):
+		"""Wait for the thread to finish and get the details of the unpacked tree.
+		Exceptions raised while unpacking are re-raised here.
+		@return: the result for L{manifest.add_manifest_file}, or None if the archive couldn't be unpacked in a single pass
+		@rtype: L{manifest.ManifestBuilder} | None"""
+		self._thread.join()
+		if self.done is not None:
+			os.close(self.done)
+			self.done = None
+		builder, exc_info = self._result
+		if exc_info:
+			raise exc_info[0], exc_info[1], exc_info[2]
+		return builder
+
+def _unpack_with_manifest(url, stream, destdir, alg, extract, type):
+	"""Unpack a tar or zip archive, starting from the current position in stream.
+	@return: the details of the tree, or None if we can't get the same results as unpack_archive (destdir is left empty)"""
+	from zeroinstall.zerostore import manifest
+	_check_extract(extract)
+	builder = manifest.ManifestBuilder(alg)
+	try:
+		writer = _TreeWriter(destdir, extract, builder)
+		if type == 'application/zip':
+			_unzip_with_manifest(stream, writer)
+		else:
+			_untar_with_manifest(stream, _tar_types[type], writer)
+		writer.finish()
+		return builder
+	except _Unsupported as ex:
+		debug(_("Can't unpack %(url)s in a single pass (%(reason)s); unpacking in the usual way"), {'url': url, 'reason': ex})
+		for item in os.listdir(destdir):
+			path = os.path.join(destdir, item)
+			if os.path.isdir(path) and not os.path.islink(path):
+				ro_rmtree(path)
+			else:
+				os.unlink(path)
+		return None
+
+def _untar_with_manifest(stream, decompress, writer):
+	import tarfile, zlib
+
+	child = None
+	if decompress in ('lzma', 'xz'):
+		child = subprocess.Popen([_find_decompressor('un' + decompress)], stdin = stream, stdout = subprocess.PIPE,
+				close_fds = True)
+		stream = child.stdout
+		rmode = 'r|'
+	else:
+		rmode = {None: 'r|', 'gzip': 'r|gz', 'bzip2': 'r|bz2'}[decompress]
+
+	try:
+		try:
+			# Python 2.5.1 crashes if name is None; see Python bug #1706850
+			tar = tarfile.open(name = '', mode = rmode, fileobj = stream, bufsize = _chunk_size)
+			for tarinfo in tar:
+				rel = writer.get_path(tarinfo.name)
+				if rel is None:
+					continue
+				if tarinfo.isdir():
+					writer.add_dir(rel, tarinfo.mtime)
+				elif tarinfo.issym():
+					writer.add_symlink(rel, tarinfo.linkname)
+				elif tarinfo.isreg() and not tarinfo.issparse():
+					# (the umask is applied as for GNU tar's --no-same-permissions)
+					writer.add_file(rel, tar.extractfile(tarinfo), tarinfo.mode & ~writer.umask & 0o111, tarinfo.mtime)
+				else:
+					raise _Unsupported(_("'%s' is not a regular file, directory or symlink") % tarinfo.name)
+			tar.close()
+		except (tarfile.TarError, EnvironmentError, EOFError, UnicodeError, zlib.error) as ex:
+			raise _Unsupported(str(ex))
+	except:
+		if child is not None:
+			child.kill()
+			child.wait()
+		raise
+
+	if child is not None:
+		child.stdout.close()
+		status = child.wait()
+		if status:
+			raise _Unsupported(_("decompressor exited with code %d") % status)
+
+def _unzip_with_manifest(stream, writer):
+	import zipfile, struct
+
+	try:
+		archive = zipfile.ZipFile(stream)
+		infolist = archive.infolist()
+	except (zipfile.BadZipfile, EnvironmentError) as ex:
+		raise _Unsupported(str(ex))
+
+	# Check that we can get the same results as unzip for everything first
+	members = []
+	seen = set()
+	for info in infolist:
+		try:
+			name = info.filename.encode('ascii')
+		except UnicodeError:
+			raise _Unsupported(_("non-ASCII name %s") % repr(info.filename))
+		if name in seen:
+			raise _Unsupported(_("duplicate entry for '%s'") % name)
+		seen.add(name)
+		if re.search('[\\x00-\\x1f\\x7f]', name):
+			raise _Unsupported(_("control character in name %s") % repr(name))	# (unzip escapes these)
+		if writer.extract and not name.startswith(writer.extract + '/'):
+			continue		# (unzip only matches "extract/*")
+		rel = writer.get_path(name)
+		if rel is None:
+			continue
+
+		mode = info.external_attr >> 16
+		if info.create_system != 3 or not mode:
+			raise _Unsupported(_("'%s' doesn't have Unix permissions") % name)
+		if info.flag_bits & 1:
+			raise _Unsupported(_("'%s' is encrypted") % name)
+		if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+			raise _Unsupported(_("'%s' uses an unsupported compression method") % name)
+		if name.endswith('/') or stat.S_ISDIR(mode):
+			kind = 'D'
+		elif stat.S_ISLNK(mode):
+			kind = 'S'
+		elif stat.S_ISREG(mode) or not stat.S_IFMT(mode):
+			kind = 'F'
+		else:
+			raise _Unsupported(_("'%s' is not a regular file, directory or symlink") % name)
+
+		# unzip uses the times in the local header, not the central directory
+		stream.seek(info.header_offset)
+		header = struct.unpack(zipfile.structFileHeader, stream.read(zipfile.sizeFileHeader))
+		if header[0] != zipfile.stringFileHeader:
+			raise _Unsupported(_("bad local header for '%s'") % name)
+		stream.seek(header[-2], 1)
+		mtime = _get_zip_mtime(header[5], header[6], stream.read(header[-1]))
+		if mtime is None:
+			raise _Unsupported(_("can't tell what mtime unzip would give '%s'") % name)
+
+		members.append((info, rel, kind, mode, mtime))
+
+	try:
+		for info, rel, kind, mode, mtime in members:
+			if kind == 'D':
+				writer.add_dir(rel, mtime)
+			elif kind == 'S':
+				writer.add_symlink(rel, archive.read(info))
+			else:
+				# (unzip doesn't apply the umask to Unix permissions)
+				src = archive.open(info)
+				writer.add_file(rel, src, mode & 0o111, mtime)
+				src.close()
+	except (zipfile.BadZipfile, EnvironmentError) as ex:
+		raise _Unsupported(str(ex))
+
+# Extra fields in zip archives which don't affect the mtime unzip gives a file:
+# Zip64, JAR marker, Info-ZIP Unix UID/GID ("Ux" and "ux")
+_zip_harmless_extras = (0x0001, 0xcafe, 0x7855, 0x7875)
+
+def _get_zip_mtime(dos_time, dos_date, extra):
+	"""Get the mtime that (Info-ZIP) unzip would set when extracting with TZ=GMT,
+	from the DOS time and date and the extra field of a local header.
+	@return: the time, or None if we aren't sure"""
+	import struct, calendar
+
+	ut_mtime = ux_mtime = None
+	while extra:
+		if len(extra) < 4:
+			return None
+		field_id, size = struct.unpack('<HH', extra[:4])
+		data = extra[4:4 + size]
+		extra = extra[4 + size:]
+		if len(data) != size:
+			return None
+		if field_id == 0x5455:		# Extended timestamp ("UT")
+			if not data or not ord(data[0]) & 1 or size < 5:
+				return None
+			ut_mtime, = struct.unpack('<l', data[1:5])
+		elif field_id == 0x5855:	# Old Info-ZIP Unix ("UX")
+			if size < 8:
+				return None
+			ux_mtime, = struct.unpack('<l', data[4:8])
+		elif field_id not in _zip_harmless_extras:
+			return None
+
+	if ut_mtime is not None:
+		mtime = ut_mtime
+	elif ux_mtime is not None:
+		mtime = ux_mtime
+	else:
+		year, month, day = (dos_date >> 9) + 1980, (dos_date >> 5) & 0xf, dos_date & 0x1f
+		hour, minute, second = dos_time >> 11, (dos_time >> 5) & 0x3f, (dos_time & 0x1f) * 2
+		if not (1 <= month <= 12 and 1 <= day <= 31 and hour < 24 and minute < 60 and second < 60):
+			return None
+		mtime = calendar.timegm((year, month, day, hour, minute, second))
+
+	if mtime < 0:
+		return None	# (unzip may treat these as unsigned)
+	return mtime
+
+class _TreeWriter:
+	"""Writes the members of an archive into a directory, recording the details of
+	each one in a L{manifest.ManifestBuilder} as it is written.
+	@ivar umask: the current umask"""
+
+	def __init__(self, destdir, extract, builder):
+		self.extract = extract
+		self.builder = builder
+		if extract:
+			self.root = os.path.join(destdir, extract)
+		else:
+			self.root = destdir
+		self.found = False
+		self.types = {}			# Relative path -> 'D', 'F' or 'S' for everything written
+		self.dir_mtimes = []		# (relative path, mtime) for each directory in the archive
+
+		self.umask = os.umask(0)
+		os.umask(self.umask)
+
+	def get_path(self, name):
+		"""Get the path of a member, relative to the root of the tree.
+		@return: the path, or None if it isn't part of the tree being extracted"""
+		if self.extract:
+			if name.rstrip('/') == self.extract:
+				name = ''
+			elif name.startswith(self.extract + '/'):
+				name = name[len(self.extract) + 1:]
+			else:
+				return None
+		elif name.startswith('/'):
+			raise _Unsupported(_("absolute path '%s'") % name)
+		parts = [p for p in name.split('/') if p not in ('', '.')]
+		if '..' in parts:
+			raise _Unsupported(_("'..' in path '%s'") % name)
+		self.found = True
+		return '/'.join(parts)
+
+	def _prepare(self, rel):
+		"""Create the parent directories of rel and remove any previous non-directory at rel."""
+		if not rel:
+			raise _Unsupported(_("top-level item isn't a directory"))
+		self._make_dir(rel.rsplit('/', 1)[0] if '/' in rel else '')
+		old = self.types.get(rel, None)
+		if old == 'D':
+			raise _Unsupported(_("'%s' replaces a directory") % rel)
+		elif old is not None:
+			os.unlink(os.path.join(self.root, rel))
+		return os.path.join(self.root, rel)
+
+	def _make_dir(self, rel):
+		old = self.types.get(rel, None)
+		if old == 'D':
+			return
+		if old is not None:
+			raise _Unsupported(_("'%s' is used as a directory but isn't one") % rel)
+		if rel:
+			self._make_dir(rel.rsplit('/', 1)[0] if '/' in rel else '')
+		path = os.path.join(self.root, rel)
+		if rel or self.extract:
+			os.mkdir(path)
+		self.builder.add_dir(rel)
+		self.types[rel] = 'D'
+
+	def add_dir(self, rel, mtime):
+		self._make_dir(rel)
+		self.dir_mtimes.append((rel, mtime))
+
+	def add_symlink(self, rel, target):
+		path = self._prepare(rel)
+		os.symlink(target, path)
+		self.builder.add_symlink(rel, target)
+		self.types[rel] = 'S'
+
+	def add_file(self, rel, src, executable, mtime):
+		"""Copy src to rel, hashing it as we go. The new file is read-only.
+		@param executable: whether to make the file executable"""
+		path = self._prepare(rel)
+		digest = self.builder.alg.new_digest()
+		fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+		try:
+			while True:
+				data = src.read(_chunk_size)
+				if not data: break
+				digest.update(data)
+				while data:
+					written = os.write(fd, data)
+					data = data[written:]
+			if executable:
+				os.fchmod(fd, 0o555)
+			else:
+				os.fchmod(fd, 0o444)
+		finally:
+			os.close(fd)
+		os.utime(path, (mtime, mtime))
+		self.builder.add_file(rel, digest.hexdigest(), os.lstat(path))
+		self.types[rel] = 'F'
+
+	def finish(self):
+		if self.extract and not self.found:
+			raise SafeException(_('Unable to find specified file = %s in archive') % self.extract)
+		if not self.types:
+			self._make_dir('')	# (empty archive)
+		for rel, mtime in self.dir_mtimes:
+			os.utime(os.path.join(self.root, rel), (mtime, mtime))
+
 def extract_deb(stream, destdir, extract = None, start_offset = 0):
 	if extract:
 		raise SafeException(_('Sorry, but the "extract" attribute is not yet supported for Debs'))
@@ -358,11 +767,7 @@ def extract_dmg(stream, destdir, extract, start_offset = 0):
 	os.unlink(dmg_copy_name)
 
 def extract_zip(stream, destdir, extract, start_offset = 0):
-	if extract:
-		# Limit the characters we accept, to avoid sending dodgy
-		# strings to zip
-		if not re.match('^[a-zA-Z0-9][- _a-zA-Z0-9.]*$', extract):
-			raise SafeException(_('Illegal character in extract attribute'))
+	_check_extract(extract)
 
 	stream.seek(start_offset)
 	# unzip can't read from stdin, so make a copy...
@@ -380,11 +785,7 @@ def extract_zip(stream, destdir, extract, start_offset = 0):
 	os.unlink(zip_copy_name)
 
 def extract_tar(stream, destdir, extract, decompress, start_offset = 0):
-	if extract:
-		# Limit the characters we accept, to avoid sending dodgy
-		# strings to tar
-		if not re.match('^[a-zA-Z0-9][- _a-zA-Z0-9.]*$', extract):
-			raise SafeException(_('Illegal character in extract attribute'))
+	_check_extract(extract)
 
 	assert decompress in [None, 'bzip2', 'gzip', 'lzma', 'xz']
 
@@ -396,14 +797,10 @@ def extract_tar(stream, destdir, extract, decompress, start_offset = 0):
 			elif decompress == 'gzip':
 				ext_cmd.append('-z')
 			elif decompress == 'lzma':
-				unlzma = find_in_path('unlzma')
-				if not unlzma:
-					unlzma = os.path.abspath(os.path.join(os.path.dirname(__file__), '_unlzma'))
+				unlzma = _find_decompressor('unlzma')
 				ext_cmd.append('--use-compress-program=' + unlzma)
 			elif decompress == 'xz':
-				unxz = find_in_path('unxz')
-				if not unxz:
-					unxz = os.path.abspath(os.path.join(os.path.dirname(__file__), '_unxz'))
+				unxz = _find_decompressor('unxz')
 				ext_cmd.append('--use-compress-program=' + unxz)
 
 		if recent_gnu_tar():
@@ -429,17 +826,13 @@ def extract_tar(stream, destdir, extract, decompress, start_offset = 0):
 		elif decompress == 'gzip':
 			rmode = 'r|gz'
 		elif decompress == 'lzma':
-			unlzma = find_in_path('unlzma')
-			if not unlzma:
-				unlzma = os.path.abspath(os.path.join(os.path.dirname(__file__), '_unlzma'))
+			unlzma = _find_decompressor('unlzma')
 			temp = tempfile.NamedTemporaryFile(suffix='.tar')
 			subprocess.check_call((unlzma), stdin=stream, stdout=temp)
 			rmode = 'r|'
 			stream = temp
 		elif decompress == 'xz':
-			unxz = find_in_path('unxz')
-			if not unxz:
-				unxz = os.path.abspath(os.path.join(os.path.dirname(__file__), '_unxz'))
+			unxz = _find_decompressor('unxz')
 			temp = tempfile.NamedTemporaryFile(suffix='.tar')
 			subprocess.check_call((unxz), stdin=stream, stdout=temp)
 			rmode = 'r|'